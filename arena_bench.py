@@ -0,0 +1,454 @@
+# End to end benchmark of cam_motor_sync (motor_cam_sync.py) with many users, without ARENA or hardware.
+#
+# The app runs unchanged against a stand-in `arena` module: its Scene plays the MQTT feed of N synthetic
+# users walking around video_ball with scripted head motion, FEED_RATE_HZ pose messages per user, and runs
+# the app's run_forever tasks on the same thread. The stand is a sim:// bus (dyna_sim.py) given to the app
+# through KUBI_PORT.
+#
+#   python arena_bench.py --users 50 --duration 10
+#   python arena_bench.py --save-baseline bench_baseline.json
+#   python arena_bench.py --baseline bench_baseline.json            exits 1 when a metric regressed
+#
+# Reported, after BENCH_WARMUP seconds:
+#   tick_cpu_ms_*          CPU time of one feed tick on the ARENA thread (every callback and task of that tick)
+#   tick_overruns          feed ticks that took longer than their period
+#   controller_*           Servo_Controller ticks, missed deadlines and CPU per control tick (Linux)
+#   *_per_s                packets and bytes on the servo bus
+#   pose_to_goal_ms_*      from a pose message of a user inside video_ball being handed to the app until the
+#                          first goal write computed from the target it produced (or a later one) goes out on
+#                          the bus. poses that produce no new target are not counted
+#
+# Writes after the app's start are all goal writes in the apps (init is done by then), so the bus listener
+# does not decode addresses.
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+import dyna_sim
+from dynamixel_sdk import INST_WRITE, INST_SYNC_WRITE
+from servo_controller import Servo_Controller
+from kubi_fleet import Kubi_Fleet
+
+BENCH_APP                   = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'motor_cam_sync.py')
+BENCH_PORT                  = 'sim://kubi?timing=realtime'
+BENCH_USERS                 = 50
+BENCH_DURATION              = 10.0              # s measured, after the warmup
+BENCH_WARMUP                = 1.0               # s of feed before measuring
+BENCH_SEED                  = 1
+FEED_RATE_HZ                = 10                # pose messages per user per second, what an ARENA client sends
+BALL_POSITION               = (0.0, 0.0, -3.0)
+BALL_RADIUS                 = 2.0               # about half the users walk inside it
+GOAL_INSTRUCTIONS           = (INST_WRITE, INST_SYNC_WRITE)
+
+REGRESSION_TOLERANCE        = 0.2               # relative slack before a metric counts as regressed
+# lower is better for all of these; value: absolute slack on top of the relative one, for noisy small numbers
+BASELINE_METRICS = {
+    'tick_cpu_ms_p50':              0.1,
+    'tick_cpu_ms_p99':              0.5,
+    'tick_overruns':                2,
+    'controller_missed_deadlines':  5,
+    'controller_cpu_per_tick_ms':   0.02,
+    'process_cpu_percent':          5.0,
+    'pose_to_goal_ms_p50':          1.0,
+    'pose_to_goal_ms_p99':          2.0,
+}
+
+
+# ---- stand-in for the arena-py names the apps use ----
+
+class Position:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def distance_to(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+
+class Rotation:
+    def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.w = w
+
+
+class Object_Data:
+    def __init__(self, position, rotation):
+        self.position = position
+        self.rotation = rotation
+
+
+class Object:
+    def __init__(self, object_id=None, position=(0, 0, 0), rotation=(0, 0, 0, 1), **options):
+        self.object_id = object_id
+        self.data = Object_Data(Position(*position), Rotation(*rotation) if len(rotation) == 4 else Rotation())
+        self.options = options
+
+
+class Camera(Object):
+    def __init__(self, object_id, displayName):
+        Object.__init__(self, object_id)
+        self.displayName = displayName
+
+
+def Color(red=0, green=0, blue=0):
+    return (red, green, blue)
+
+
+class Bench_Scene:
+    benchmark = None                            # the Benchmark whose feed run_tasks plays
+
+    def __init__(self, host=None, scene=None, **options):
+        self.host = host
+        self.scene = scene
+        self.all_objects = {}
+        self.tasks = []                         # [(interval s, function)]
+        self.user_join_callback = None
+        self.user_left_callback = None
+        self.delete_obj_callback = None
+        self.on_msg_callback = None
+        self.updates = 0
+
+    def run_forever(self, interval_ms):
+        def register(function):
+            self.tasks.append((interval_ms / 1000.0, function))
+            return function
+        return register
+
+    def add_object(self, obj):
+        self.all_objects[obj.object_id] = obj
+
+    def update_object(self, obj, **options):
+        self.updates += 1
+
+    def delete_object(self, obj):
+        self.all_objects.pop(obj.object_id, None)
+
+    def run_tasks(self):
+        self.benchmark.run_Feed(self)
+
+
+def make_Arena_Module():
+    arena = types.ModuleType('arena')
+    for name, value in (('Scene', Bench_Scene), ('Object', Object), ('Camera', Camera), ('Color', Color),
+                        ('Position', Position), ('Rotation', Rotation)):
+        setattr(arena, name, value)
+    arena.__all__ = ['Scene', 'Object', 'Camera', 'Color', 'Position', 'Rotation']
+    return arena
+
+
+# ---- synthetic users ----
+
+class Synthetic_User:
+    # walks a circle around video_ball looking at it, sweeping the head left / right and up / down
+    def __init__(self, index, rng):
+        self.camera = Camera("camera_bench_%d" % index, "bench user %d" % index)
+        self.orbit_radius = rng.uniform(0.5, 2.0 * BALL_RADIUS)
+        self.orbit_speed = rng.uniform(-0.3, 0.3)               # rad / s
+        self.phase = rng.uniform(0.0, 2.0 * math.pi)
+        self.sweep = rng.uniform(10.0, 40.0)                    # degrees
+        self.sweep_rate = rng.uniform(0.1, 0.5)                 # Hz
+        self.pitch = rng.uniform(0.0, 15.0)
+        self.pitch_rate = rng.uniform(0.1, 0.3)
+
+    def move(self, t):
+        # sets the camera pose at time t, returns True when the user is inside video_ball
+        angle = self.phase + self.orbit_speed * t
+        x = BALL_POSITION[0] + self.orbit_radius * math.cos(angle)
+        z = BALL_POSITION[2] + self.orbit_radius * math.sin(angle)
+        yaw = math.degrees(math.atan2(x - BALL_POSITION[0], z - BALL_POSITION[2]))
+        yaw += self.sweep * math.sin(2.0 * math.pi * self.sweep_rate * t)
+        pitch = self.pitch * math.sin(2.0 * math.pi * self.pitch_rate * t)
+
+        data = self.camera.data
+        data.position.x, data.position.y, data.position.z = x, 1.6, z
+        # yaw about y, then pitch about x
+        cy, sy = math.cos(math.radians(yaw) / 2.0), math.sin(math.radians(yaw) / 2.0)
+        cp, sp = math.cos(math.radians(pitch) / 2.0), math.sin(math.radians(pitch) / 2.0)
+        rotation = data.rotation
+        rotation.x, rotation.y, rotation.z, rotation.w = cy * sp, sy * cp, -sy * sp, cy * cp
+        return self.orbit_radius <= BALL_RADIUS
+
+
+# ---- benchmark ----
+
+def find_Controllers(namespace):
+    controllers = []
+    for value in list(namespace.values()):
+        if isinstance(value, Servo_Controller):
+            controllers.append(value)
+        elif isinstance(value, Kubi_Fleet):
+            controllers.extend(stand.controller for stand in value.stands if stand.controller is not None)
+    return controllers
+
+
+def thread_Cpu_Time(thread):
+    # CPU seconds of another thread, None where the platform cannot tell
+    if thread is None or not hasattr(time, 'pthread_getcpuclockid'):
+        return None
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (OSError, TypeError):
+        return None
+
+
+def percentiles(values, prefix, points=(50, 90, 99)):
+    results = {}
+    for point in points:
+        results["%s_p%d" % (prefix, point)] = float(np.percentile(values, point)) if len(values) else None
+    results[prefix + "_max"] = float(max(values)) if len(values) else None
+    return results
+
+
+class Benchmark:
+    def __init__(self, users=BENCH_USERS, duration=BENCH_DURATION, warmup=BENCH_WARMUP, feed_rate_hz=FEED_RATE_HZ,
+                 port=BENCH_PORT, seed=BENCH_SEED, app_path=BENCH_APP):
+        self.users = users
+        self.duration = duration
+        self.warmup = warmup
+        self.feed_rate_hz = feed_rate_hz
+        self.port = port
+        self.seed = seed
+        self.app_path = app_path
+        self.app = {}                           # the app's module globals while it runs
+        self.results = None
+
+        self.lock = threading.Lock()
+        self.measuring = False
+        self.pending_poses = []                 # (perf_counter time, target seq) of poses whose target is not on the bus yet
+        self.controller = None                  # the Servo_Controller driving the benchmark port
+        self.latencies = []
+
+    def run(self):
+        # runs the app until the feed ends, returns the results dict
+        saved_arena = sys.modules.get('arena')
+        saved_port = os.environ.get('KUBI_PORT')
+        sys.modules['arena'] = make_Arena_Module()
+        os.environ['KUBI_PORT'] = self.port
+        Bench_Scene.benchmark = self
+        bus = dyna_sim.get_Sim_Bus(self.port)
+        bus.listener = self.__on_Packet
+        try:
+            with open(self.app_path) as source:
+                code = compile(source.read(), self.app_path, 'exec')
+            self.app = {'__name__': 'arena_bench_app', '__file__': self.app_path}
+            exec(code, self.app)
+        finally:
+            for controller in find_Controllers(self.app):
+                controller.stop()
+            bus.listener = None
+            Bench_Scene.benchmark = None
+            if saved_arena is None:
+                sys.modules.pop('arena', None)
+            else:
+                sys.modules['arena'] = saved_arena
+            if saved_port is None:
+                os.environ.pop('KUBI_PORT', None)
+            else:
+                os.environ['KUBI_PORT'] = saved_port
+        return self.results
+
+    def __on_Packet(self, dxl_id, instruction, params):
+        # on the controller thread, as the packet is written
+        if instruction not in GOAL_INSTRUCTIONS or not self.measuring:
+            return
+        if self.controller is None:
+            return
+        now = time.perf_counter()
+        # the listener runs inside the controller's step, so step_seq is the target this write was computed from
+        step_seq = self.controller.step_seq
+        with self.lock:
+            answered = [t for t, seq in self.pending_poses if seq <= step_seq]
+            self.pending_poses = [(t, seq) for t, seq in self.pending_poses if seq > step_seq]
+        self.latencies.extend(now - t for t in answered)
+
+    def run_Feed(self, scene):
+        rng = random.Random(self.seed)
+        users = [Synthetic_User(index, rng) for index in range(self.users)]
+        period = 1.0 / self.feed_rate_hz
+
+        ball = Object(object_id="video_ball", position=BALL_POSITION)
+        ball.data.radius = BALL_RADIUS
+        scene.add_object(ball)
+        for user in users:
+            user.move(0.0)
+            scene.add_object(user.camera)
+            if scene.user_join_callback is not None:
+                scene.user_join_callback(scene, user.camera, {"object_id": user.camera.object_id, "action": "create"})
+        scene.on_msg_callback(scene, ball, {"object_id": "video_ball", "action": "update"})
+
+        controllers = find_Controllers(self.app)
+        self.controller = next((controller for controller in controllers if controller.servo.port == self.port), None)
+        bus = dyna_sim.get_Sim_Bus(self.port)
+        tick_cpu = []
+        overruns = 0
+        snapshot = None
+
+        start = time.perf_counter()
+        measure_start = start + self.warmup
+        end = measure_start + self.duration
+        next_tick = start
+        task_due = [start + interval for interval, _ in scene.tasks]
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if snapshot is None and now >= measure_start:
+                snapshot = self.__snapshot(controllers, bus, now)
+                tick_cpu = []
+                overruns = 0
+                with self.lock:
+                    self.pending_poses = []
+                self.latencies = []
+                self.measuring = True
+            if now < next_tick:
+                time.sleep(next_tick - now)
+                continue
+
+            cpu_start = time.thread_time()
+            t = now - start
+            for user in users:
+                inside = user.move(t)
+                handed = time.perf_counter()
+                seq = self.controller.target.get()[0] if self.controller is not None else None
+                scene.on_msg_callback(scene, user.camera, {"object_id": user.camera.object_id, "action": "update"})
+                if inside and self.measuring and seq is not None:
+                    # only a pose that posted a new target can reach the bus
+                    target_seq = self.controller.target.get()[0]
+                    if target_seq != seq:
+                        with self.lock:
+                            self.pending_poses.append((handed, target_seq))
+            for index, (interval, task) in enumerate(scene.tasks):
+                if now >= task_due[index]:
+                    task()
+                    task_due[index] += interval
+            tick_cpu.append(time.thread_time() - cpu_start)
+            if time.perf_counter() - now > period:
+                overruns += 1
+            # a late tick is not made up for, the next one is a period after it
+            next_tick = max(next_tick + period, now)
+
+        self.measuring = False
+        final = self.__snapshot(controllers, bus, time.perf_counter())
+        if snapshot is None:
+            snapshot = final
+        self.results = self.__results(snapshot, final, tick_cpu, overruns)
+
+    def __snapshot(self, controllers, bus, now):
+        cpu_times = [thread_Cpu_Time(controller.thread) for controller in controllers]
+        return {
+            "t": now,
+            "process_cpu": time.process_time(),
+            "packets": bus.packets,
+            "status_packets": bus.status_packets,
+            "wire_bytes": bus.wire_bytes,
+            "controller_ticks": sum(controller.ticks for controller in controllers),
+            "controller_missed": sum(controller.missed_deadlines for controller in controllers),
+            "controller_cpu": None if None in cpu_times else sum(cpu_times),
+        }
+
+    def __results(self, first, last, tick_cpu, overruns):
+        elapsed = (last["t"] - first["t"]) or 1.0
+        ticks = last["controller_ticks"] - first["controller_ticks"]
+        controller_cpu = None
+        if first["controller_cpu"] is not None and last["controller_cpu"] is not None and ticks:
+            controller_cpu = (last["controller_cpu"] - first["controller_cpu"]) / ticks * 1000.0
+        with self.lock:
+            unanswered = len(self.pending_poses)
+        results = {
+            "users": self.users,
+            "duration_s": round(elapsed, 3),
+            "feed_rate_hz": self.feed_rate_hz,
+            "port": self.port,
+            "feed_ticks": len(tick_cpu),
+            "tick_cpu_ms_mean": float(np.mean(tick_cpu)) * 1000.0 if tick_cpu else None,
+            "tick_overruns": overruns,
+            "controller_ticks": ticks,
+            "controller_missed_deadlines": last["controller_missed"] - first["controller_missed"],
+            "controller_cpu_per_tick_ms": controller_cpu,
+            "process_cpu_percent": (last["process_cpu"] - first["process_cpu"]) / elapsed * 100.0,
+            "packets_per_s": (last["packets"] - first["packets"]) / elapsed,
+            "status_packets_per_s": (last["status_packets"] - first["status_packets"]) / elapsed,
+            "bus_bytes_per_s": (last["wire_bytes"] - first["wire_bytes"]) / elapsed,
+            "poses_measured": len(self.latencies),
+            "poses_without_goal_write": unanswered,
+        }
+        results.update(percentiles([cpu * 1000.0 for cpu in tick_cpu], "tick_cpu_ms"))
+        results.update(percentiles([latency * 1000.0 for latency in self.latencies], "pose_to_goal_ms"))
+        return results
+
+
+def compare_Baseline(results, baseline):
+    # returns (report lines, names of the regressed metrics)
+    lines = []
+    regressed = []
+    for key in ('users', 'feed_rate_hz', 'port'):
+        if baseline.get(key) != results.get(key):
+            lines.append("warning: baseline %s is %r, this run %r" % (key, baseline.get(key), results.get(key)))
+    for name in sorted(results):
+        value, base = results[name], baseline.get(name)
+        if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or isinstance(value, bool):
+            continue
+        change = "%+.1f%%" % ((value - base) / base * 100.0) if base else ""
+        flag = ""
+        if name in BASELINE_METRICS and value > base * (1.0 + REGRESSION_TOLERANCE) + BASELINE_METRICS[name]:
+            flag = "  REGRESSED"
+            regressed.append(name)
+        lines.append("  %-30s %12.3f %12.3f  %8s%s" % (name, base, value, change, flag))
+    return lines, regressed
+
+
+def format_Results(results):
+    lines = []
+    for name in sorted(results):
+        value = results[name]
+        lines.append("  %-30s %s" % (name, "%.3f" % value if isinstance(value, float) else value))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark motor_cam_sync with synthetic users on a simulated stand")
+    parser.add_argument('--users', type=int, default=BENCH_USERS)
+    parser.add_argument('--duration', type=float, default=BENCH_DURATION, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=BENCH_WARMUP)
+    parser.add_argument('--rate', type=float, default=FEED_RATE_HZ, help="pose messages per user per second")
+    parser.add_argument('--port', default=BENCH_PORT, help="sim:// URL of the stand")
+    parser.add_argument('--seed', type=int, default=BENCH_SEED)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--baseline', help="compare against this results file, exit 1 on a regression")
+    parser.add_argument('--save-baseline', help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.users, args.duration, args.warmup, args.rate, args.port, args.seed)
+    results = benchmark.run()
+    if results is None:
+        sys.exit("the app returned before its scene ran")
+    print("%d users, %.1f s:" % (results["users"], results["duration_s"]))
+    print(format_Results(results))
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as output:
+                json.dump({name: round(value, 4) if isinstance(value, float) else value for name, value in results.items()},
+                          output, indent=2, sort_keys=True)
+                output.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressed = compare_Baseline(results, baseline)
+        print("against %s:%30s %12s" % (args.baseline, "baseline", "now"))
+        print("\n".join(lines))
+        if regressed:
+            sys.exit("regressed: " + ", ".join(regressed))
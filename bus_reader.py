@@ -0,0 +1,131 @@
+# Bus level reader: present position (and optionally velocity / load) of every motor on a port
+# in one Sync Read (protocol 2.0) or Bulk Read (protocol 1.0) transaction.
+#
+# Results land in a preallocated numpy array with one row per motor id and one column per field,
+# so the hot loop does not allocate.
+
+import numpy as np
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+
+# field name -> (control table address, byte length, signed encoding)
+#   'sign_magnitude' : bit 10 is the direction bit (protocol 1.0 / XL320 speed and load)
+#   'twos_complement': regular signed integer (X series)
+#   None             : unsigned
+FIELDS_PROTOCOL_1 = {
+    'position': (36, 2, None),
+    'velocity': (38, 2, 'sign_magnitude'),
+    'load':     (40, 2, 'sign_magnitude'),
+}
+
+FIELDS_XL320 = {
+    'position': (37, 2, None),
+    'velocity': (39, 2, 'sign_magnitude'),
+    'load':     (41, 2, 'sign_magnitude'),
+}
+
+FIELDS_X_SERIES = {
+    'load':     (126, 2, 'twos_complement'),     # Present Current / Present Load depending on the model
+    'velocity': (128, 4, 'twos_complement'),
+    'position': (132, 4, 'twos_complement'),     # signed in extended position control mode
+}
+
+SIGN_MAGNITUDE_BIT = 0x400
+
+
+def decode_Value(raw, length, encoding):
+    if encoding == 'sign_magnitude':
+        if raw & SIGN_MAGNITUDE_BIT:
+            return -(raw & (SIGN_MAGNITUDE_BIT - 1))
+        return raw & (SIGN_MAGNITUDE_BIT - 1)
+    if encoding == 'twos_complement':
+        sign_bit = 1 << (8 * length - 1)
+        if raw & sign_bit:
+            return raw - (sign_bit << 1)
+    return raw
+
+
+class Bus_Reader:
+    def __init__(self, portHandler, packetHandler, ids, fields=('position',), field_table=None, group_read=True):
+        self.portHandler = portHandler
+        self.packetHandler = packetHandler
+        self.ids = list(ids)
+        self.protocol = packetHandler.getProtocolVersion()
+
+        if field_table is None:
+            field_table = FIELDS_PROTOCOL_1 if self.protocol == 1.0 else FIELDS_X_SERIES
+        self.fields = [(name,) + field_table[name] for name in fields]
+
+        # one contiguous span covering every requested field, so each motor costs a single read
+        self.start_address = min(addr for _, addr, _, _ in self.fields)
+        self.data_length = max(addr + length for _, addr, length, _ in self.fields) - self.start_address
+
+        self.state = np.zeros((len(self.ids), len(self.fields)), dtype=np.int32)
+        self.columns = dict((name, col) for col, (name, _, _, _) in enumerate(self.fields))
+
+        # Sync Read only exists in protocol 2.0. Protocol 1.0 Bulk Read is MX only (AX answers nothing),
+        # so fall back to one read per motor when the first group read times out, or right away with group_read=False.
+        if self.protocol == 1.0:
+            self.groupRead = GroupBulkRead(portHandler, packetHandler)
+            for dxl_id in self.ids:
+                self.groupRead.addParam(dxl_id, self.start_address, self.data_length)
+        else:
+            self.groupRead = GroupSyncRead(portHandler, packetHandler, self.start_address, self.data_length)
+            for dxl_id in self.ids:
+                self.groupRead.addParam(dxl_id)
+        self.group_supported = group_read
+        self.group_verified = False
+
+    def column(self, name):
+        return self.state[:, self.columns[name]]
+
+    def read_State(self):
+        # returns (state array, comm result); rows that failed to read keep their previous value
+        if self.group_supported:
+            dxl_comm_result = self.__group_Read()
+            if dxl_comm_result == COMM_SUCCESS:
+                self.group_verified = True
+                for row, dxl_id in enumerate(self.ids):
+                    for col, (_, addr, length, encoding) in enumerate(self.fields):
+                        raw = self.groupRead.getData(dxl_id, addr, length)
+                        self.state[row, col] = decode_Value(raw, length, encoding)
+                return self.state, dxl_comm_result
+
+            if self.group_verified:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+                return self.state, dxl_comm_result
+
+            print("Group read not supported on this bus (%s), reading motors one at a time" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.group_supported = False
+
+        return self.__read_Each()
+
+    def __group_Read(self):
+        if self.protocol != 1.0:
+            return self.groupRead.txRxPacket()
+        # newer dynamixel_sdk GroupBulkRead.txPacket passes an extra argument the protocol 1.0
+        # bulkReadTx does not take, so send the request directly and let the group collect the replies
+        self.groupRead.makeParam()
+        dxl_comm_result = self.packetHandler.bulkReadTx(self.portHandler, self.groupRead.param, len(self.ids) * 3)
+        if dxl_comm_result != COMM_SUCCESS:
+            return dxl_comm_result
+        return self.groupRead.rxPacket()
+
+    def __read_Each(self):
+        result = COMM_SUCCESS
+        for row, dxl_id in enumerate(self.ids):
+            data, dxl_comm_result, dxl_error = self.packetHandler.readTxRx(self.portHandler, dxl_id, self.start_address, self.data_length)
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+                result = dxl_comm_result
+                continue
+            elif dxl_error != 0:
+                print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+
+            for col, (_, addr, length, encoding) in enumerate(self.fields):
+                idx = addr - self.start_address
+                raw = 0
+                for i in range(length):
+                    raw |= data[idx + i] << (8 * i)
+                self.state[row, col] = decode_Value(raw, length, encoding)
+        return self.state, result
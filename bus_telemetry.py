@@ -0,0 +1,231 @@
+# Bus level telemetry: round trip latency histograms, result / packet error counters and bytes on the wire,
+# per port, motor id and instruction.
+#
+# instrument_Packet_Handler swaps the txPacket / rxPacket / txRxPacket methods of one PacketHandler instance
+# for timed versions. Every SDK call (read*TxRx, write*TxRx, Sync / Bulk Read and Write, ping) goes through
+# those three, so the wrappers and Bus_Reader are covered without changing their call sites.
+#
+# pull the numbers with Bus_Telemetry.snapshot() or Bus_Telemetry.prometheus_Text()
+
+import threading
+import time
+from bisect import bisect_left
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+
+# upper bounds of the latency buckets in ms, the last bucket (+Inf) catches everything else
+LATENCY_BUCKETS_MS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0)
+
+INSTRUCTION_NAMES = {
+    0x01: 'ping',
+    0x02: 'read',
+    0x03: 'write',
+    0x04: 'reg_write',
+    0x05: 'action',
+    0x06: 'factory_reset',
+    0x08: 'reboot',
+    0x82: 'sync_read',
+    0x83: 'sync_write',
+    0x92: 'bulk_read',
+    0x93: 'bulk_write',
+}
+
+RESULT_NAMES = {
+    COMM_SUCCESS:      'success',
+    COMM_PORT_BUSY:    'port_busy',
+    COMM_TX_FAIL:      'tx_fail',
+    COMM_RX_FAIL:      'rx_fail',
+    COMM_TX_ERROR:     'tx_error',
+    COMM_RX_WAITING:   'rx_waiting',
+    COMM_RX_TIMEOUT:   'rx_timeout',
+    COMM_RX_CORRUPT:   'rx_corrupt',
+    COMM_NOT_AVAILABLE: 'not_available',
+}
+
+# instructions whose tx only half is followed by readRx calls for the replies
+REPLY_INSTRUCTIONS = (0x01, 0x02, 0x82, 0x92)
+
+# packet field offsets: (id, instruction, status error)
+PACKET_FIELDS = {
+    1.0: (2, 4, 4),
+    2.0: (4, 7, 8),
+}
+
+
+class Latency_Histogram:
+    __slots__ = ('counts', 'total_ms', 'count', 'max_ms')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.count = 0
+        self.max_ms = 0.0
+
+    def record(self, ms):
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.total_ms += ms
+        self.count += 1
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of samples, max_ms for the +Inf bucket
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max_ms
+
+
+class Bus_Stats:
+    __slots__ = ('latency', 'results', 'packet_errors', 'tx_bytes', 'rx_bytes')
+
+    def __init__(self):
+        self.latency = Latency_Histogram()
+        self.results = {}
+        self.packet_errors = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+
+
+class Bus_Telemetry:
+    # one instance can be shared by every port in a fleet, the port name is part of each key
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, port, dxl_id, instruction, ms, result, packet_error, tx_bytes, rx_bytes):
+        key = (port, dxl_id, instruction)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = Bus_Stats()
+            stats.latency.record(ms)
+            stats.results[result] = stats.results.get(result, 0) + 1
+            if packet_error:
+                stats.packet_errors += 1
+            stats.tx_bytes += tx_bytes
+            stats.rx_bytes += rx_bytes
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def snapshot(self):
+        # plain dict copy, keyed by (port, id, instruction name)
+        out = {}
+        with self.lock:
+            for (port, dxl_id, instruction), stats in self.stats.items():
+                latency = stats.latency
+                out[(port, dxl_id, INSTRUCTION_NAMES.get(instruction, hex(instruction)))] = {
+                    'count': latency.count,
+                    'mean_ms': latency.total_ms / latency.count if latency.count else 0.0,
+                    'p50_ms': latency.percentile(0.5),
+                    'p99_ms': latency.percentile(0.99),
+                    'max_ms': latency.max_ms,
+                    'buckets': list(latency.counts),
+                    'results': dict((RESULT_NAMES.get(result, str(result)), count) for result, count in stats.results.items()),
+                    'packet_errors': stats.packet_errors,
+                    'tx_bytes': stats.tx_bytes,
+                    'rx_bytes': stats.rx_bytes,
+                }
+        return out
+
+    def prometheus_Text(self):
+        lines = [
+            '# HELP dynamixel_transaction_seconds Dynamixel bus round trip time.',
+            '# TYPE dynamixel_transaction_seconds histogram',
+        ]
+        counters = []
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: (str(item[0][0]), item[0][1], item[0][2]))
+            for (port, dxl_id, instruction), stats in items:
+                labels = 'port="%s",id="%d",instruction="%s"' % (port, dxl_id, INSTRUCTION_NAMES.get(instruction, hex(instruction)))
+                latency = stats.latency
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS_MS, latency.counts):
+                    cumulative += count
+                    lines.append('dynamixel_transaction_seconds_bucket{%s,le="%g"} %d' % (labels, bound / 1000.0, cumulative))
+                lines.append('dynamixel_transaction_seconds_bucket{%s,le="+Inf"} %d' % (labels, latency.count))
+                lines.append('dynamixel_transaction_seconds_sum{%s} %.9f' % (labels, latency.total_ms / 1000.0))
+                lines.append('dynamixel_transaction_seconds_count{%s} %d' % (labels, latency.count))
+
+                for result, count in sorted(stats.results.items()):
+                    counters.append(('dynamixel_transactions_total', '%s,result="%s"' % (labels, RESULT_NAMES.get(result, str(result))), count))
+                counters.append(('dynamixel_packet_errors_total', labels, stats.packet_errors))
+                counters.append(('dynamixel_tx_bytes_total', labels, stats.tx_bytes))
+                counters.append(('dynamixel_rx_bytes_total', labels, stats.rx_bytes))
+
+        helps = {
+            'dynamixel_transactions_total': 'Dynamixel bus transactions by communication result.',
+            'dynamixel_packet_errors_total': 'Status packets with a non zero error byte.',
+            'dynamixel_tx_bytes_total': 'Bytes written to the bus.',
+            'dynamixel_rx_bytes_total': 'Bytes read from the bus.',
+        }
+        for name in ('dynamixel_transactions_total', 'dynamixel_packet_errors_total', 'dynamixel_tx_bytes_total', 'dynamixel_rx_bytes_total'):
+            lines.append('# HELP %s %s' % (name, helps[name]))
+            lines.append('# TYPE %s counter' % name)
+            for counter, labels, value in counters:
+                if counter == name:
+                    lines.append('%s{%s} %d' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_Packet_Handler(packetHandler, telemetry, port_name):
+    # PacketHandler() returns a fresh object per call, so patching the instance only affects this port
+    if getattr(packetHandler, 'telemetry', None) is not None:
+        return packetHandler
+    id_field, inst_field, error_field = PACKET_FIELDS[packetHandler.getProtocolVersion()]
+    tx_packet = packetHandler.txPacket
+    rx_packet = packetHandler.rxPacket
+    tx_rx_packet = packetHandler.txRxPacket
+    clock = time.perf_counter
+    local = threading.local()
+
+    def txPacket(port, txpacket):
+        start = clock()
+        result = tx_packet(port, txpacket)
+        if getattr(local, 'in_txrx', False):
+            return result
+        dxl_id, instruction = txpacket[id_field], txpacket[inst_field]
+        if result == COMM_SUCCESS and instruction in REPLY_INSTRUCTIONS:
+            # first half of a split read (readTx, Sync / Bulk Read), the replies are timed from here
+            local.last_tx = [start, dxl_id, instruction, len(txpacket)]
+        else:
+            telemetry.record(port_name, dxl_id, instruction, (clock() - start) * 1000.0, result, False, len(txpacket), 0)
+        return result
+
+    def rxPacket(port, *args):
+        rxpacket, result = rx_packet(port, *args)
+        if getattr(local, 'in_txrx', False):
+            return rxpacket, result
+        last_tx = getattr(local, 'last_tx', None)
+        if last_tx is None:
+            last_tx = [clock(), BROADCAST_ID, 0, 0]
+        start, tx_id, instruction, tx_bytes = last_tx
+        last_tx[3] = 0                          # the request bytes count once, against the first reply
+        dxl_id = rxpacket[id_field] if result == COMM_SUCCESS else tx_id
+        packet_error = result == COMM_SUCCESS and rxpacket[error_field] != 0
+        telemetry.record(port_name, dxl_id, instruction, (clock() - start) * 1000.0, result, packet_error, tx_bytes, len(rxpacket))
+        return rxpacket, result
+
+    def txRxPacket(port, txpacket):
+        start = clock()
+        local.in_txrx = True
+        try:
+            rxpacket, result, error = tx_rx_packet(port, txpacket)
+        finally:
+            local.in_txrx = False
+        rx_bytes = len(rxpacket) if rxpacket else 0
+        telemetry.record(port_name, txpacket[id_field], txpacket[inst_field], (clock() - start) * 1000.0, result, bool(error), len(txpacket), rx_bytes)
+        return rxpacket, result, error
+
+    packetHandler.txPacket = txPacket
+    packetHandler.rxPacket = rxPacket
+    packetHandler.txRxPacket = txRxPacket
+    packetHandler.telemetry = telemetry
+    return packetHandler
@@ -0,0 +1,248 @@
+# Per motor shadow of the Dynamixel control table, and declarative configuration profiles applied by diffing
+# against it.
+#
+# EEPROM values and RAM values only we change (goal, gains, return delay...) are cached after the first read
+# or write, so asking for them again costs no bus traffic and writing the value a register already holds is
+# skipped. Fields the servo changes by itself (present_*, moving, torque_enable...) are always read.
+#
+#   mirror = Control_Table_Mirror(portHandler, packetHandler, 1, CONTROL_TABLES['AX-12A'])
+#   apply_Profile(mirror, PROFILES['kubi_low_latency'])
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+
+# field name -> (address, byte length)
+AX_FIELDS = {
+    'model_number': (0, 2), 'firmware': (2, 1), 'id': (3, 1), 'baud_rate': (4, 1), 'return_delay': (5, 1),
+    'min_position': (6, 2), 'max_position': (8, 2), 'status_return_level': (16, 1),
+    'torque_enable': (24, 1), 'led': (25, 1), 'cw_compliance_margin': (26, 1), 'ccw_compliance_margin': (27, 1),
+    'cw_compliance_slope': (28, 1), 'ccw_compliance_slope': (29, 1),
+    'goal_position': (30, 2), 'moving_speed': (32, 2), 'torque_limit': (34, 2),
+    'present_position': (36, 2), 'present_speed': (38, 2), 'present_load': (40, 2),
+    'present_voltage': (42, 1), 'present_temperature': (43, 1), 'registered': (44, 1), 'moving': (46, 1),
+}
+
+MX_FIELDS = dict(AX_FIELDS)
+MX_FIELDS.update({'d_gain': (26, 1), 'i_gain': (27, 1), 'p_gain': (28, 1), 'goal_acceleration': (73, 1)})
+del MX_FIELDS['cw_compliance_margin'], MX_FIELDS['ccw_compliance_margin']
+del MX_FIELDS['cw_compliance_slope'], MX_FIELDS['ccw_compliance_slope']
+
+XL320_FIELDS = {
+    'model_number': (0, 2), 'firmware': (2, 1), 'id': (3, 1), 'baud_rate': (4, 1), 'return_delay': (5, 1),
+    'min_position': (6, 2), 'max_position': (8, 2), 'operating_mode': (11, 1), 'status_return_level': (17, 1),
+    'torque_enable': (24, 1), 'led': (25, 1), 'd_gain': (27, 1), 'i_gain': (28, 1), 'p_gain': (29, 1),
+    'goal_position': (30, 2), 'moving_speed': (32, 2), 'torque_limit': (35, 2),
+    'present_position': (37, 2), 'present_speed': (39, 2), 'present_load': (41, 2),
+    'present_voltage': (45, 1), 'present_temperature': (46, 1), 'registered': (47, 1), 'moving': (49, 1),
+    'hardware_error': (50, 1),
+}
+
+X_FIELDS = {
+    'model_number': (0, 2), 'model_information': (2, 4), 'firmware': (6, 1), 'id': (7, 1), 'baud_rate': (8, 1),
+    'return_delay': (9, 1), 'drive_mode': (10, 1), 'operating_mode': (11, 1),
+    'max_position': (48, 4), 'min_position': (52, 4),
+    'torque_enable': (64, 1), 'led': (65, 1), 'status_return_level': (68, 1), 'registered': (69, 1),
+    'hardware_error': (70, 1), 'velocity_i_gain': (76, 2), 'velocity_p_gain': (78, 2),
+    'position_d_gain': (80, 2), 'position_i_gain': (82, 2), 'position_p_gain': (84, 2),
+    'goal_current': (102, 2), 'goal_velocity': (104, 4), 'profile_acceleration': (108, 4),
+    'profile_velocity': (112, 4), 'goal_position': (116, 4), 'realtime_tick': (120, 2), 'moving': (122, 1),
+    'moving_status': (123, 1), 'present_pwm': (124, 2), 'present_load': (126, 2), 'present_speed': (128, 4),
+    'present_position': (132, 4), 'present_voltage': (144, 2), 'present_temperature': (146, 1),
+}
+
+# X series indirect addressing: Indirect Address n (2 bytes) holds the control table address whose byte
+# Indirect Data n mirrors, for reads and writes. (first Indirect Address, first Indirect Data, slots)
+# Like EEPROM, the Indirect Address registers only take writes with torque off.
+X_INDIRECT = (168, 224, 28)
+X_FIELDS.update(('indirect_address_%d' % (slot + 1), (X_INDIRECT[0] + 2 * slot, 2)) for slot in range(X_INDIRECT[2]))
+
+# fields holding signed values (the rest are unsigned)
+SIGNED_FIELDS = frozenset((
+    'goal_current', 'goal_velocity', 'goal_position', 'present_pwm', 'present_load', 'present_speed', 'present_position',
+))
+
+# fields the servo changes on its own, never served from the cache
+# (protocol 1.0 servos switch torque on when given a goal, and any servo drops it on an overload)
+VOLATILE_FIELDS = frozenset((
+    'torque_enable', 'registered', 'moving', 'moving_status', 'hardware_error', 'realtime_tick',
+    'present_position', 'present_speed', 'present_load', 'present_pwm', 'present_voltage', 'present_temperature',
+))
+
+
+class Control_Table:
+    def __init__(self, name, fields, eeprom_end, eeprom_locked, indirect=None):
+        self.name = name
+        self.fields = fields                    # name -> (address, length)
+        self.eeprom_end = eeprom_end            # first RAM address
+        self.eeprom_locked = eeprom_locked      # EEPROM only writable with torque off
+        self.indirect = indirect                # X_INDIRECT style region, None without indirect addressing
+
+    def is_EEPROM(self, name):
+        return self.fields[name][0] < self.eeprom_end
+
+    def is_Locked(self, name):
+        # registers eeprom_locked models only write with torque off: EEPROM and the Indirect Address registers
+        if self.is_EEPROM(name):
+            return True
+        if self.indirect is None:
+            return False
+        address_start, _, slots = self.indirect
+        return address_start <= self.fields[name][0] < address_start + 2 * slots
+
+
+CONTROL_TABLES = {
+    'AX-12A':     Control_Table('AX-12A', AX_FIELDS, 24, False),
+    'MX-28':      Control_Table('MX-28', MX_FIELDS, 24, False),
+    'XL-320':     Control_Table('XL-320', XL320_FIELDS, 24, True),
+    'XM430-W350': Control_Table('XM430-W350', X_FIELDS, 64, True, X_INDIRECT),
+}
+
+# Return Delay Time is in 2 us units and defaults to 250 (500 us), paid on every status packet.
+# Status Return Level 2 keeps write replies; the wrappers check them.
+PROFILES = {
+    'kubi_default':      {'return_delay': 250, 'status_return_level': 2},
+    'kubi_low_latency':  {'return_delay': 0, 'status_return_level': 2},
+    'x_default':         {'return_delay': 250, 'status_return_level': 2, 'position_p_gain': 800},
+    'x_low_latency':     {'return_delay': 0, 'status_return_level': 2},
+    'x_stiff':           {'return_delay': 0, 'status_return_level': 2, 'position_p_gain': 1200, 'position_d_gain': 200},
+}
+
+
+class Control_Table_Mirror:
+    def __init__(self, portHandler, packetHandler, dxl_id, table):
+        self.portHandler = portHandler
+        self.packetHandler = packetHandler
+        self.dxl_id = dxl_id
+        self.table = table
+        self.cache = {}
+        self.reads = 0
+        self.writes = 0
+        self.skipped = 0
+
+    def __mask(self, name, value):
+        return value & ((1 << (8 * self.table.fields[name][1])) - 1)
+
+    def cached(self, name):
+        return self.cache.get(name)
+
+    def note(self, name, value):
+        # record a write made around the mirror (Sync Write, a wrapper's own goal write)
+        if name not in VOLATILE_FIELDS:
+            self.cache[name] = self.__mask(name, value)
+
+    def invalidate(self, name=None):
+        # forget one field, or everything, e.g. after a reconnect or reboot
+        if name is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(name, None)
+
+    def load(self, start=0, end=None):
+        # fill the cache from one read of [start, end), by default the whole EEPROM area
+        if end is None:
+            end = self.table.eeprom_end
+        data, dxl_comm_result, dxl_error = self.packetHandler.readTxRx(self.portHandler, self.dxl_id, start, end - start)
+        self.reads += 1
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return False
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        for name, (addr, length) in self.table.fields.items():
+            if start <= addr and addr + length <= end and name not in VOLATILE_FIELDS:
+                self.cache[name] = int.from_bytes(bytes(data[addr - start:addr - start + length]), 'little')
+        return True
+
+    def read(self, name, refresh=False):
+        # returns the raw (unsigned) value, None if the read failed
+        if not refresh and name in self.cache:
+            return self.cache[name]
+        addr, length = self.table.fields[name]
+        if length == 1:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read1ByteTxRx(self.portHandler, self.dxl_id, addr)
+        elif length == 2:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, self.dxl_id, addr)
+        else:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read4ByteTxRx(self.portHandler, self.dxl_id, addr)
+        self.reads += 1
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        self.note(name, value)
+        return value
+
+    def write(self, name, value):
+        # returns True once the register holds value, writing only when the cache says it does not already
+        value = self.__mask(name, value)
+        if self.cache.get(name) == value:
+            self.skipped += 1
+            return True
+        addr, length = self.table.fields[name]
+        if length == 1:
+            dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, self.dxl_id, addr, value)
+        elif length == 2:
+            dxl_comm_result, dxl_error = self.packetHandler.write2ByteTxRx(self.portHandler, self.dxl_id, addr, value)
+        else:
+            dxl_comm_result, dxl_error = self.packetHandler.write4ByteTxRx(self.portHandler, self.dxl_id, addr, value)
+        self.writes += 1
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate(name)
+            return False
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+            self.invalidate(name)
+            return False
+        self.note(name, value)
+        return True
+
+
+def profile_Diff(mirror, profile):
+    # {field: wanted value} for every profile field the servo does not hold yet
+    diff = {}
+    for name, value in profile.items():
+        if name not in mirror.table.fields:
+            continue
+        if mirror.read(name) != (value & ((1 << (8 * mirror.table.fields[name][1])) - 1)):
+            diff[name] = value
+    return diff
+
+
+def apply_Profile(mirror, profile):
+    # writes only the fields that differ, EEPROM and the other torque locked registers first (with torque off where
+    # the model needs it), then RAM, torque_enable last. returns the names of the fields written
+    unknown = [name for name in profile if name not in mirror.table.fields]
+    if unknown:
+        print("%s has no %s, skipped" % (mirror.table.name, ", ".join(sorted(unknown))))
+
+    locked = [name for name in profile if name in mirror.table.fields and mirror.table.is_Locked(name)]
+    eeprom = [name for name in locked if mirror.table.is_EEPROM(name)]
+    for region in (eeprom, [name for name in locked if name not in eeprom]):
+        if region and not mirror.cache.keys() >= set(region):
+            # one read of just the span the region's fields cover, at 57600 baud every byte is ~0.17 ms
+            spans = [mirror.table.fields[name] for name in region]
+            mirror.load(min(addr for addr, _ in spans), max(addr + length for addr, length in spans))
+    diff = profile_Diff(mirror, profile)
+    if not diff:
+        return []
+
+    written = []
+    locked = [name for name in diff if mirror.table.is_Locked(name)]
+    ram = [name for name in diff if not mirror.table.is_Locked(name) and name != 'torque_enable']
+
+    turned_off = False
+    if locked and mirror.table.eeprom_locked and mirror.read('torque_enable'):
+        mirror.write('torque_enable', 0)
+        turned_off = True
+
+    for name in locked + ram:
+        if mirror.write(name, diff[name]):
+            written.append(name)
+
+    # torque goes back on after the locked writes unless the profile says otherwise
+    torque = profile.get('torque_enable', 1 if turned_off else None)
+    if torque is not None and ('torque_enable' in diff or turned_off):
+        if mirror.write('torque_enable', torque) and 'torque_enable' in profile:
+            written.append('torque_enable')
+    return written
@@ -0,0 +1,257 @@
+# asyncio transport for a Dynamixel bus, so servo traffic can share the ARENA Scene event loop without
+# blocking it (MQTT receive keeps running while a reply is on the wire).
+#
+# The serial port's file descriptor is registered with loop.add_reader and status packets are parsed as the
+# bytes arrive (dyna_packet.Packet_Parser); nothing ever waits on the port. Requests queue up and the next one
+# is sent straight from the reader callback once the reply in flight is complete, so a burst of reads and
+# writes (e.g. asyncio.gather of several reads) keeps the bus busy without a trip through the awaiting
+# coroutines. The bus is half duplex, so only one request with replies is in flight at a time; broadcast
+# packets (Sync Write) expect none and go out back to back.
+#
+# Results are the SDK's tuples; a reply that does not arrive in time gives COMM_RX_TIMEOUT. Like the SDK's txPacket,
+# the port input and the parser are cleared after a timeout and before every request that expects replies, and a
+# status packet of the wrong length is not taken as a reply, so a late reply cannot shift the ones after it.
+# An OSError from the port itself (adapter unplugged) is set on the pending futures, so it is raised where the
+# request is awaited as the blocking SDK calls raise it; the transport stops reading and fails every later request
+# the same way until it is detached and the port reopened.
+#
+#   transport = Async_Transport(portHandler, 1.0)          from a coroutine, or pass loop=
+#   data, dxl_comm_result, dxl_error = await transport.read(1, 36, 2)
+#
+# While attached, the transport holds the port (is_using), so a stray blocking SDK call gets COMM_PORT_BUSY
+# instead of stealing its replies. sim:// ports have no file descriptor and are polled every SIM_POLL_INTERVAL.
+
+import asyncio
+import os
+import time
+from collections import deque
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from dyna_packet import build_Packet, Packet_Parser, INST_STATUS
+
+SIM_POLL_INTERVAL           = 0.0005            # s between reads of a port without a file descriptor
+REPLY_TIMEOUT_MARGIN_MS     = 2.0               # on top of wire time and twice the adapter latency timer, as the SDK
+STATUS_OVERHEAD             = {1.0: 6, 2.0: 11} # status packet bytes besides its data
+
+
+class Async_Request:
+    __slots__ = ('packet', 'reply_ids', 'reply_length', 'instruction', 'replies', 'future', 'timer', 'sent')
+
+    def __init__(self, packet, reply_ids, reply_length, instruction, future):
+        self.packet = packet
+        self.reply_ids = reply_ids              # ids whose status packets complete the request, in bus order
+        self.reply_length = reply_length        # data bytes in each status packet
+        self.instruction = instruction
+        self.replies = []                       # [(data, status error)]
+        self.future = future
+        self.timer = None
+        self.sent = 0.0
+
+
+class Async_Transport:
+    def __init__(self, portHandler, protocol, loop=None, telemetry=None, port_name=None):
+        self.portHandler = portHandler
+        self.protocol = protocol
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.telemetry = telemetry              # bus_telemetry.Bus_Telemetry, optional
+        self.port_name = port_name if port_name is not None else portHandler.getPortName()
+        self.parser = Packet_Parser(protocol)
+        self.queue = deque()
+        self.current = None
+        self.stray_packets = 0
+        self.timeouts = 0
+        self.error = None                       # the OSError that ended the port, set on every later request
+        self.fd = None
+        self.poller = None
+
+        portHandler.is_using = True
+        ser = getattr(portHandler, 'ser', None)
+        if ser is not None and os.name != 'nt':
+            self.fd = ser.fileno()
+            self.loop.add_reader(self.fd, self.__on_Readable)
+        else:
+            self.poller = self.loop.create_task(self.__poll())
+
+    def close(self):
+        self.__stop_Reading()
+        queued = list(self.queue)
+        self.queue.clear()
+        if self.current is not None:
+            self.__finish(self.current, COMM_PORT_BUSY)
+        for request in queued:
+            self.__resolve(request, COMM_PORT_BUSY)
+        self.portHandler.is_using = False
+
+    def transmit(self, packet, reply_ids=(), reply_length=0):
+        # queues a finished packet, the future resolves to ([(data, status error)], comm result).
+        # the packet is copied, so prebuilt buffers (dyna_driver.Goal_Packet) can be refilled right away
+        future = self.loop.create_future()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        self.queue.append(Async_Request(bytes(packet), tuple(reply_ids), reply_length, packet[4 if self.protocol == 1.0 else 7], future))
+        if self.current is None:
+            self.__send_Next()
+        return future
+
+    async def read(self, dxl_id, address, length):
+        # returns (data, comm result, status error) like the SDK readTxRx
+        if self.protocol == 1.0:
+            params = bytes((address, length))
+        else:
+            params = bytes((address & 0xFF, address >> 8, length & 0xFF, length >> 8))
+        replies, dxl_comm_result = await self.transmit(build_Packet(self.protocol, dxl_id, INST_READ, params), (dxl_id,), length)
+        if dxl_comm_result != COMM_SUCCESS:
+            return b'', dxl_comm_result, 0
+        data, dxl_error = replies[0]
+        return data, dxl_comm_result, dxl_error
+
+    async def write(self, dxl_id, address, data):
+        # data: the register bytes, little endian. returns (comm result, status error) like the SDK writeTxRx
+        if self.protocol == 1.0:
+            params = bytes((address,)) + bytes(data)
+        else:
+            params = bytes((address & 0xFF, address >> 8)) + bytes(data)
+        return await self.write_Packet(build_Packet(self.protocol, dxl_id, INST_WRITE, params), dxl_id)
+
+    async def write_Packet(self, packet, dxl_id):
+        replies, dxl_comm_result = await self.transmit(packet, () if dxl_id == BROADCAST_ID else (dxl_id,))
+        return dxl_comm_result, replies[0][1] if replies else 0
+
+    async def sync_Write(self, address, length, entries):
+        # entries: [(id, data bytes)], every entry length bytes. returns the comm result
+        if self.protocol == 1.0:
+            params = bytearray((address, length))
+        else:
+            params = bytearray((address & 0xFF, address >> 8, length & 0xFF, length >> 8))
+        for dxl_id, data in entries:
+            params.append(dxl_id)
+            params += data
+        _, dxl_comm_result = await self.transmit(build_Packet(self.protocol, BROADCAST_ID, INST_SYNC_WRITE, params))
+        return dxl_comm_result
+
+    def __send_Next(self):
+        port = self.portHandler
+        while self.current is None and self.queue:
+            request = self.queue.popleft()
+            if request.future.cancelled():
+                continue
+            request.sent = time.perf_counter()
+            try:
+                if request.reply_ids:
+                    # nothing is in flight, anything waiting on the port is stray
+                    port.clearPort()
+                    self.parser.reset()
+                written = port.writePort(request.packet)
+            except OSError as error:
+                self.queue.appendleft(request)
+                self.__fail(error)
+                return
+            if written != len(request.packet):
+                self.__resolve(request, COMM_TX_FAIL)
+            elif not request.reply_ids:
+                self.__resolve(request, COMM_SUCCESS)
+            else:
+                self.current = request
+                request.timer = self.loop.call_later(self.__reply_Timeout(request), self.__timed_Out, request)
+
+    def __reply_Timeout(self, request):
+        # the SDK's setPacketTimeout arithmetic, stretched over every expected reply
+        reply_bytes = (STATUS_OVERHEAD[self.protocol] + request.reply_length) * len(request.reply_ids)
+        tx_ms = self.portHandler.tx_time_per_byte * (len(request.packet) + reply_bytes)
+        return (tx_ms + LATENCY_TIMER * 2.0 + REPLY_TIMEOUT_MARGIN_MS) / 1000.0
+
+    def __timed_Out(self, request):
+        if request is self.current:
+            self.timeouts += 1
+            # the reply may still be on its way, drop what has arrived of it
+            self.portHandler.clearPort()
+            self.parser.reset()
+            self.__finish(request, COMM_RX_TIMEOUT)
+
+    def __on_Readable(self):
+        port = self.portHandler
+        try:
+            data = port.readPort(port.getBytesAvailable() or 1)
+        except OSError as error:
+            self.__fail(error)
+            return
+        if data:
+            self.__received(data)
+
+    async def __poll(self):
+        port = self.portHandler
+        while True:
+            if self.current is not None:
+                # on a timing=virtual sim an empty readPort moves the clock on to the next reply
+                try:
+                    data = port.readPort(port.getBytesAvailable() or 1)
+                except OSError as error:
+                    self.poller = None
+                    self.__fail(error)
+                    return
+                if data:
+                    self.__received(data)
+                    continue
+            await asyncio.sleep(SIM_POLL_INTERVAL)
+
+    def __received(self, data):
+        for dxl_id, instruction, params in self.parser.feed(data):
+            request = self.current
+            if request is None or dxl_id != request.reply_ids[len(request.replies)]:
+                self.stray_packets += 1
+                continue
+            if self.protocol == 1.0:
+                reply = (params, instruction)
+            elif instruction == INST_STATUS:
+                reply = (params[1:], params[0])
+            else:
+                self.stray_packets += 1
+                continue
+            if len(reply[0]) != request.reply_length and (reply[0] or not reply[1]):
+                # a late reply to an earlier request of another length (an error status may come without data)
+                self.stray_packets += 1
+                continue
+            request.replies.append(reply)
+            if len(request.replies) == len(request.reply_ids):
+                self.__finish(request, COMM_SUCCESS)
+
+    def __stop_Reading(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+
+    def __fail(self, error):
+        # the port is gone: a dead descriptor would stay readable forever, so stop reading it, and raise the
+        # error in whatever awaits the request in flight or a queued one
+        self.error = error
+        self.__stop_Reading()
+        pending = list(self.queue)
+        self.queue.clear()
+        if self.current is not None:
+            if self.current.timer is not None:
+                self.current.timer.cancel()
+            pending.insert(0, self.current)
+            self.current = None
+        for request in pending:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+    def __finish(self, request, dxl_comm_result):
+        if request.timer is not None:
+            request.timer.cancel()
+        self.current = None
+        self.__resolve(request, dxl_comm_result)
+        self.__send_Next()
+
+    def __resolve(self, request, dxl_comm_result):
+        if self.telemetry is not None and request.sent:
+            dxl_id = request.reply_ids[0] if request.reply_ids else request.packet[2 if self.protocol == 1.0 else 4]
+            rx_bytes = sum(STATUS_OVERHEAD[self.protocol] + len(data) for data, _ in request.replies)
+            self.telemetry.record(self.port_name, dxl_id, request.instruction, (time.perf_counter() - request.sent) * 1000.0,
+                                  dxl_comm_result, any(error for _, error in request.replies), len(request.packet), rx_bytes)
+        if not request.future.done():
+            request.future.set_result((request.replies, dxl_comm_result))
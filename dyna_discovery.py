@@ -0,0 +1,285 @@
+# Servo discovery: find which ports, baud rates and ids have Dynamixels on them, and optionally move a bus
+# to the fastest baud rate both the servos and the USB adapter support.
+#
+# Protocol 2.0 servos are enumerated with one broadcast ping per baud rate. Protocol 1.0 has no broadcast
+# ping, so ids are pinged one at a time (PROTOCOL_1_SCAN_IDS unless the caller knows which ids to expect).
+#
+#   python dyna_discovery.py                      scan every serial port that looks like a USB adapter
+#   python dyna_discovery.py sim://mx28 --upgrade scan one port and raise its baud rate
+#
+# The baud rate register lives in EEPROM, so an upgraded rate survives a power cycle; connect with the
+# new rate (or discover=True in the wrappers) afterwards.
+
+import argparse
+import glob
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from dyna_sim import make_Port_Handler
+
+PORT_PATTERNS = ('/dev/ttyUSB*', '/dev/ttyACM*', '/dev/tty.usbserial-*', '/dev/tty.usbmodem*')
+
+# rates PortHandler.setBaudRate accepts, anything else is refused by the SDK
+SDK_BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 500000, 576000, 921600, 1000000, 1152000,
+                  2000000, 2500000, 3000000, 3500000, 4000000)
+SCAN_BAUD_RATES = (1000000, 57600, 115200, 2000000, 3000000, 4000000, 9600, 500000)    # most likely first
+ADAPTER_MAX_BAUD = 4000000                      # highest rate the SDK can set on a U2D2 / FTDI adapter
+BAUD_TOLERANCE = 0.03                           # servo rates within 3% of a port rate still decode
+BAUD_SWITCH_DELAY = 0.05                        # s, let the servos switch rate after the register write
+
+PROTOCOL_1_SCAN_IDS = range(0, 32)
+
+# baud rate register value -> bps
+PROTOCOL_1_BAUD_TABLE = {1: 1000000, 3: 500000, 4: 400000, 7: 250000, 9: 200000, 16: 117647, 34: 57143, 103: 19231, 207: 9615}
+MX_BAUD_TABLE = dict(PROTOCOL_1_BAUD_TABLE)
+MX_BAUD_TABLE.update({250: 2250000, 251: 2500000, 252: 3000000})
+XL320_BAUD_TABLE = {0: 9600, 1: 57600, 2: 115200, 3: 1000000}
+X_BAUD_TABLE = {0: 9600, 1: 57600, 2: 115200, 3: 1000000, 4: 2000000, 5: 3000000, 6: 4000000, 7: 4500000}
+
+Model_Info = namedtuple('Model_Info', 'name protocol baud_address baud_table torque_address eeprom_locked')
+
+# model number -> Model_Info
+MODEL_INFO = {
+    12:   Model_Info('AX-12A', 1.0, 4, PROTOCOL_1_BAUD_TABLE, 24, False),
+    18:   Model_Info('AX-18A', 1.0, 4, PROTOCOL_1_BAUD_TABLE, 24, False),
+    300:  Model_Info('AX-12W', 1.0, 4, PROTOCOL_1_BAUD_TABLE, 24, False),
+    29:   Model_Info('MX-28', 1.0, 4, MX_BAUD_TABLE, 24, False),
+    310:  Model_Info('MX-64', 1.0, 4, MX_BAUD_TABLE, 24, False),
+    320:  Model_Info('MX-106', 1.0, 4, MX_BAUD_TABLE, 24, False),
+    350:  Model_Info('XL-320', 2.0, 4, XL320_BAUD_TABLE, 24, True),
+    1060: Model_Info('XL430-W250', 2.0, 8, X_BAUD_TABLE, 64, True),
+    1020: Model_Info('XM430-W350', 2.0, 8, X_BAUD_TABLE, 64, True),
+    1030: Model_Info('XM430-W210', 2.0, 8, X_BAUD_TABLE, 64, True),
+    1010: Model_Info('XH430-W350', 2.0, 8, X_BAUD_TABLE, 64, True),
+}
+
+Discovered_Servo = namedtuple('Discovered_Servo', 'port protocol baudrate dxl_id model_number firmware')
+
+
+def candidate_Ports():
+    if os.name == 'nt':
+        from serial.tools import list_ports
+        return sorted(port.device for port in list_ports.comports())
+    ports = []
+    for pattern in PORT_PATTERNS:
+        ports += glob.glob(pattern)
+    return sorted(ports)
+
+
+def port_Rate(rate):
+    # the SDK port rate a servo rate decodes at, None if there is none
+    for port_rate in SDK_BAUD_RATES:
+        if abs(port_rate - rate) <= BAUD_TOLERANCE * port_rate:
+            return port_rate
+    return None
+
+
+def ping_Bus(portHandler, packetHandler, ids=None):
+    # returns [(id, model number, firmware)] answering at the port's current rate, firmware is None on protocol 1.0
+    if packetHandler.getProtocolVersion() == 2.0 and ids is None:
+        data_list, dxl_comm_result = packetHandler.broadcastPing(portHandler)
+        if dxl_comm_result != COMM_SUCCESS or not data_list:
+            return []
+        return sorted((dxl_id, model_number, firmware) for dxl_id, (model_number, firmware) in data_list.items())
+
+    found = []
+    for dxl_id in (PROTOCOL_1_SCAN_IDS if ids is None else ids):
+        model_number, dxl_comm_result, dxl_error = packetHandler.ping(portHandler, dxl_id)
+        if dxl_comm_result == COMM_SUCCESS:
+            found.append((dxl_id, model_number, None))
+    return found
+
+
+def scan_Bus(portHandler, packetHandler, baud_rates=SCAN_BAUD_RATES, ids=None, all_rates=False):
+    # tries each rate on an open port until servos answer (every rate with all_rates), leaves the port at the
+    # rate the first servos were found on
+    servos = []
+    found_rate = None
+    protocol = packetHandler.getProtocolVersion()
+    for baudrate in baud_rates:
+        if not portHandler.setBaudRate(baudrate):
+            continue
+        found = ping_Bus(portHandler, packetHandler, ids)
+        for dxl_id, model_number, firmware in found:
+            servos.append(Discovered_Servo(portHandler.getPortName(), protocol, baudrate, dxl_id, model_number, firmware))
+        if found and found_rate is None:
+            found_rate = baudrate
+            if not all_rates:
+                break
+
+    if found_rate is not None:
+        portHandler.setBaudRate(found_rate)
+    return servos
+
+
+def scan_Port(port, protocols=(1.0, 2.0), baud_rates=SCAN_BAUD_RATES, ids=None, all_rates=False):
+    portHandler = make_Port_Handler(port)
+    if not portHandler.openPort():
+        print("Failed to open %s" % port)
+        return []
+    try:
+        servos = []
+        for protocol in protocols:
+            servos += scan_Bus(portHandler, PacketHandler(protocol), baud_rates, ids, all_rates)
+        return servos
+    finally:
+        portHandler.closePort()
+
+
+def discover(ports=None, protocols=(1.0, 2.0), baud_rates=SCAN_BAUD_RATES, ids=None, all_rates=False):
+    # every port is scanned in parallel, a scan mostly waits on ping timeouts
+    if ports is None:
+        ports = candidate_Ports()
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        scans = [pool.submit(scan_Port, port, protocols, baud_rates, ids, all_rates) for port in ports]
+        return [servo for scan in scans for servo in scan.result()]
+
+
+def best_Baud(model_numbers, max_baud=ADAPTER_MAX_BAUD):
+    # returns (port rate, {model number: register value}) for the fastest rate every model supports, or None
+    choices = None
+    for model_number in set(model_numbers):
+        info = MODEL_INFO.get(model_number)
+        if info is None:
+            return None
+        rates = {}
+        for value, rate in info.baud_table.items():
+            port_rate = port_Rate(rate)
+            if port_rate is not None and port_rate <= max_baud:
+                rates[port_rate] = value
+        if choices is None:
+            choices = dict((port_rate, {}) for port_rate in rates)
+        for port_rate in list(choices):
+            if port_rate in rates:
+                choices[port_rate][model_number] = rates[port_rate]
+            else:
+                del choices[port_rate]
+    if not choices:
+        return None
+    port_rate = max(choices)
+    return port_rate, choices[port_rate]
+
+
+def upgrade_Baud(portHandler, packetHandler, servos, max_baud=ADAPTER_MAX_BAUD):
+    # writes the fastest common rate into every servo's baud register and moves the port along.
+    # returns the port rate the bus now runs at, or None when the bus could not be moved; then every servo is
+    # written back to its old rate and the port stays on it. torque the EEPROM write needed off is turned back on
+    current = portHandler.getBaudRate()
+    best = best_Baud([servo.model_number for servo in servos], max_baud)
+    if best is None:
+        print("No common baud rate for models %s" % sorted(set(servo.model_number for servo in servos)))
+        return None
+    target, values = best
+    if target <= current:
+        return current
+
+    # make sure the adapter takes the new rate before any servo is moved to it
+    if not portHandler.setBaudRate(target):
+        print("Port refused %d baud" % target)
+        portHandler.setBaudRate(current)
+        return None
+    portHandler.setBaudRate(current)
+
+    old_values = {}                             # id -> baud register value to restore on failure
+    torque_on = []                              # ids whose torque was turned off for the EEPROM write
+    for servo in servos:
+        info = MODEL_INFO[servo.model_number]
+        value, result, error = packetHandler.read1ByteTxRx(portHandler, servo.dxl_id, info.baud_address)
+        if result != COMM_SUCCESS:
+            print("Dynamixel %d baud register could not be read, bus left at %d baud" % (servo.dxl_id, current))
+            restore_Torque(portHandler, packetHandler, servos, torque_on)
+            return None
+        old_values[servo.dxl_id] = value
+        if info.eeprom_locked:
+            # the baud register is in EEPROM, which these models only accept with torque off
+            torque, result, error = packetHandler.read1ByteTxRx(portHandler, servo.dxl_id, info.torque_address)
+            if result == COMM_SUCCESS and torque:
+                torque_on.append(servo.dxl_id)
+            packetHandler.write1ByteTxRx(portHandler, servo.dxl_id, info.torque_address, 0)
+
+    for servo in servos:
+        # the status packet may already come back at the new rate, so a failed reply is not conclusive
+        packetHandler.write1ByteTxRx(portHandler, servo.dxl_id, MODEL_INFO[servo.model_number].baud_address,
+                                     values[servo.model_number])
+
+    time.sleep(BAUD_SWITCH_DELAY)
+    if not portHandler.setBaudRate(target):
+        print("Port refused %d baud" % target)
+        restore_Baud(portHandler, packetHandler, servos, old_values, current, target)
+        restore_Torque(portHandler, packetHandler, servos, torque_on)
+        return None
+
+    missing = [servo.dxl_id for servo in servos if packetHandler.ping(portHandler, servo.dxl_id)[1] != COMM_SUCCESS]
+    if missing:
+        print("Dynamixel %s did not answer at %d baud, moving the bus back to %d" % (missing, target, current))
+        restore_Baud(portHandler, packetHandler, servos, old_values, current, target)
+        restore_Torque(portHandler, packetHandler, servos, torque_on)
+        return None
+
+    restore_Torque(portHandler, packetHandler, servos, torque_on)
+    print("Bus moved from %d to %d baud" % (current, target))
+    return target
+
+
+def restore_Baud(portHandler, packetHandler, servos, old_values, current, target):
+    # the servos that did switch have the new rate in EEPROM: write their old register value back at the new
+    # rate, so the next launch finds them where it left them, then return the port to the old rate
+    if portHandler.setBaudRate(target):
+        for servo in servos:
+            packetHandler.write1ByteTxRx(portHandler, servo.dxl_id, MODEL_INFO[servo.model_number].baud_address,
+                                         old_values[servo.dxl_id])
+        time.sleep(BAUD_SWITCH_DELAY)
+    portHandler.setBaudRate(current)
+    stranded = [servo.dxl_id for servo in servos if packetHandler.ping(portHandler, servo.dxl_id)[1] != COMM_SUCCESS]
+    if stranded:
+        print("Dynamixel %s stayed at %d baud, rescan with python dyna_discovery.py" % (stranded, target))
+
+
+def restore_Torque(portHandler, packetHandler, servos, torque_on):
+    # turns torque back on for the servos upgrade_Baud turned it off on, at whatever rate the port is on now
+    for servo in servos:
+        if servo.dxl_id in torque_on:
+            packetHandler.write1ByteTxRx(portHandler, servo.dxl_id, MODEL_INFO[servo.model_number].torque_address, 1)
+
+
+def upgrade_Port(port, servos, max_baud=ADAPTER_MAX_BAUD):
+    # servos: the Discovered_Servo entries found on this port, all on one protocol and rate
+    portHandler = make_Port_Handler(port)
+    if not portHandler.openPort():
+        print("Failed to open %s" % port)
+        return None
+    try:
+        portHandler.setBaudRate(servos[0].baudrate)
+        return upgrade_Baud(portHandler, PacketHandler(servos[0].protocol), servos, max_baud)
+    finally:
+        portHandler.closePort()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="find Dynamixel servos and optionally raise the bus baud rate")
+    parser.add_argument('ports', nargs='*', help="ports to scan, default: every USB serial adapter")
+    parser.add_argument('--protocol', type=float, choices=(1.0, 2.0), help="only scan one protocol")
+    parser.add_argument('--upgrade', action='store_true', help="move each bus to the fastest supported baud rate")
+    parser.add_argument('--max-baud', type=int, default=ADAPTER_MAX_BAUD, help="fastest rate the adapter supports")
+    args = parser.parse_args()
+
+    protocols = (args.protocol,) if args.protocol else (1.0, 2.0)
+    servos = discover(args.ports or None, protocols)
+    if not servos:
+        print("No Dynamixel found")
+    for servo in servos:
+        info = MODEL_INFO.get(servo.model_number)
+        print("%s  protocol %.1f  %7d baud  id %3d  %s" % (servo.port, servo.protocol, servo.baudrate, servo.dxl_id,
+              info.name if info else "model %d" % servo.model_number))
+
+    if args.upgrade:
+        buses = {}
+        for servo in servos:
+            buses.setdefault((servo.port, servo.protocol, servo.baudrate), []).append(servo)
+        for (port, _, _), bus_servos in sorted(buses.items()):
+            upgrade_Port(port, bus_servos, args.max_baud)
@@ -0,0 +1,458 @@
+# Model driven Dynamixel driver shared by kubi_wrapper and dyna_wrapper.
+#
+# A MODELS entry carries everything that differs between servo families: protocol, control table, Bus_Reader
+# fields, goal register encoding and the degree <-> tick scale. The wrappers pick a model once instead of
+# branching on it in every read and write.
+#
+# Goal writes are the hot path at controller rates, so they skip the SDK's packet building: Goal_Packet and
+# Sync_Write_Packet are built once, the value bytes are packed into the bytearray in place and the checksum /
+# CRC is finished from a precomputed prefix with the dyna_packet CRC table. Everything else (reads, pings,
+# EEPROM writes) still goes through the SDK.
+#
+# On models with indirect addressing (X series) map_Block points the Indirect Address registers at a chosen
+# set of fields, after which read_Block / write_Block move all of them in one transaction, decoded into a
+# namedtuple. Position, velocity, load, temperature and the Moving flag then cost the bus time of one read.
+#
+#   driver = Dynamixel_Driver('/dev/ttyUSB0', 'X_SERIES', [1])
+#   driver.write_Goal(1, driver.model.angle_To_Ticks(90))
+#   block = driver.map_Block(('present_position', 'moving', 'present_temperature'))
+#   state, dxl_comm_result = driver.read_Block(block, 1)          state.present_position, state.moving, ...
+
+import struct
+import time
+from collections import namedtuple
+
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from bus_reader import Bus_Reader, FIELDS_PROTOCOL_1, FIELDS_XL320, FIELDS_X_SERIES, decode_Value
+from bus_telemetry import instrument_Packet_Handler, PACKET_FIELDS
+from control_table import Control_Table_Mirror, CONTROL_TABLES, SIGNED_FIELDS, apply_Profile
+from dyna_discovery import scan_Bus, upgrade_Baud
+from dyna_packet import build_Packet, checksum, update_CRC
+from dyna_sim import make_Port_Handler
+
+FULL_REVOLUTION             = 360.0
+STUFFING_PATTERN            = b'\xff\xff\xfd'  # protocol 2.0 byte stuffing starts after this in the packet body
+STATUS_TIMEOUT_BYTES        = {1.0: 6, 2.0: 11}    # status packet length the SDK waits for after a write
+MAX_CONSECUTIVE_FAILURES    = 5                 # failed transactions in a row before the bus counts as lost
+RECONNECT_BACKOFF_MIN       = 0.01              # s before the second reconnect attempt, doubled after each failure
+RECONNECT_BACKOFF_MAX       = 2.0
+STRUCT_CODES                = {1: 'B', 2: 'H', 4: 'I'}     # register length -> unsigned struct code, lower case when signed
+
+
+class Connection_Error(Exception):
+    # raised instead of quitting by connect / init when the caller asked for it, e.g. while reconnecting
+    pass
+
+
+class Driver_Model:
+    def __init__(self, name, protocol, model_numbers, table, field_table, max_position, goal_format, group_read=True):
+        self.name = name
+        self.protocol = protocol
+        self.model_numbers = model_numbers      # dyna_discovery.MODEL_INFO numbers driven as this model
+        self.table = table                      # control_table.Control_Table
+        self.field_table = field_table          # bus_reader FIELDS_* table
+        self.max_position = float(max_position) # ticks per revolution as the wrappers have always scaled it
+        self.goal_format = goal_format          # struct format of the goal register
+        self.group_read = group_read            # answers Sync / Bulk Read; False skips the probe that would time out
+        self.goal_address = table.fields['goal_position'][0]
+        self.moving_address = table.fields['moving'][0]
+        self.field_names = dict((address, field) for field, (address, _) in table.fields.items())
+
+    def angle_To_Ticks(self, degrees):
+        return int(float(degrees) * self.max_position / FULL_REVOLUTION)
+
+    def ticks_To_Angle(self, ticks):
+        return float(ticks) / self.max_position * FULL_REVOLUTION
+
+
+MODELS = {
+    # the AX has no Bulk Read
+    'AX':       Driver_Model('AX', 1.0, (12, 18, 300), CONTROL_TABLES['AX-12A'], FIELDS_PROTOCOL_1, 1023, '<H', group_read=False),
+    'MX':       Driver_Model('MX', 1.0, (29, 310, 320), CONTROL_TABLES['MX-28'], FIELDS_PROTOCOL_1, 4095, '<H'),
+    'XL320':    Driver_Model('XL320', 2.0, (350,), CONTROL_TABLES['XL-320'], FIELDS_XL320, 1023, '<H'),
+    # signed goal, the X series runs in extended position control mode
+    'X_SERIES': Driver_Model('X_SERIES', 2.0, (1060, 1020, 1030, 1010), CONTROL_TABLES['XM430-W350'], FIELDS_X_SERIES, 4095, '<i'),
+}
+
+
+def model_For(model_number):
+    # the MODELS entry driving a discovered servo, None for unknown models
+    for model in MODELS.values():
+        if model_number in model.model_numbers:
+            return model
+    return None
+
+
+class Goal_Packet:
+    # Write instruction for one register (or a run of them, value_format with several codes) of one motor.
+    # fill() packs the values and finishes the checksum in place and returns the packet ready for the port
+    def __init__(self, protocol, dxl_id, address, value_format):
+        self.protocol = protocol
+        self.value_struct = struct.Struct(value_format)
+        if protocol == 1.0:
+            address_bytes = bytes((address,))
+        else:
+            address_bytes = bytes((address & 0xFF, address >> 8))
+        self.params = address_bytes + bytes(self.value_struct.size)
+        self.dxl_id = dxl_id
+        self.packet = build_Packet(protocol, dxl_id, INST_WRITE, self.params)
+        self.value_start = len(self.packet) - (1 if protocol == 1.0 else 2) - self.value_struct.size
+        self.value_end = self.value_start + self.value_struct.size
+        # checksum / CRC of everything before the value, the only bytes that change
+        if protocol == 1.0:
+            self.prefix = sum(self.packet[2:self.value_start])
+        else:
+            self.prefix = update_CRC(0, self.packet, 0, self.value_start)
+
+    def fill(self, *values):
+        packet = self.packet
+        self.value_struct.pack_into(packet, self.value_start, *values)
+        if self.protocol == 1.0:
+            total = self.prefix
+            for i in range(self.value_start, self.value_end):
+                total += packet[i]
+            packet[self.value_end] = ~total & 0xFF
+            return packet
+        if packet.find(STUFFING_PATTERN, self.value_start - 2, self.value_end) >= 0:
+            # the value needs byte stuffing, which changes the length; rare enough to build it the slow way
+            return build_Packet(2.0, self.dxl_id, INST_WRITE, bytes(packet[self.value_start - 2:self.value_end]))
+        crc = update_CRC(self.prefix, packet, self.value_start, self.value_end)
+        packet[self.value_end] = crc & 0xFF
+        packet[self.value_end + 1] = crc >> 8
+        return packet
+
+
+class Sync_Write_Packet:
+    # Sync Write of the same registers on a fixed set of motors, data_format packs one motor's registers
+    def __init__(self, protocol, ids, address, data_format):
+        self.protocol = protocol
+        self.data_struct = struct.Struct(data_format)
+        size = self.data_struct.size
+        if protocol == 1.0:
+            params = bytearray((address, size))
+        else:
+            params = bytearray((address & 0xFF, address >> 8, size & 0xFF, size >> 8))
+        header = 5 if protocol == 1.0 else 8  # bytes before the first parameter
+        self.offsets = []
+        for dxl_id in ids:
+            params.append(dxl_id)
+            self.offsets.append(header + len(params))
+            params += bytes(size)
+        self.packet = build_Packet(protocol, BROADCAST_ID, INST_SYNC_WRITE, params)
+        self.data_start = self.offsets[0]
+        self.data_end = len(self.packet) - (1 if protocol == 1.0 else 2)
+        if protocol == 2.0:
+            self.prefix = update_CRC(0, self.packet, 0, self.data_start)
+
+        # control table address of every packed value, for keeping the mirrors in step
+        self.addresses = []
+        for code in data_format.lstrip('<>=!@'):
+            self.addresses.append(address)
+            address += struct.calcsize('<' + code)
+
+    def fill(self, entries):
+        # entries: [(id, values)] in the order of the ids the packet was built for
+        packet = self.packet
+        pack_into = self.data_struct.pack_into
+        for offset, (_, values) in zip(self.offsets, entries):
+            pack_into(packet, offset, *values)
+        if self.protocol == 1.0:
+            packet[self.data_end] = checksum(memoryview(packet), 2, self.data_end)
+            return packet
+        if packet.find(STUFFING_PATTERN, self.data_start, self.data_end) >= 0:
+            return build_Packet(2.0, BROADCAST_ID, INST_SYNC_WRITE, bytes(packet[8:self.data_end]))
+        crc = update_CRC(self.prefix, packet, self.data_start, self.data_end)
+        packet[self.data_end] = crc & 0xFF
+        packet[self.data_end + 1] = crc >> 8
+        return packet
+
+
+class State_Block:
+    # fields mapped into the indirect data region from first_slot on, one byte per slot. records are a
+    # namedtuple of the fields in the order given
+    def __init__(self, model, fields, first_slot=0):
+        table = model.table
+        if table.indirect is None:
+            raise ValueError("%s has no indirect addressing" % model.name)
+        address_start, data_start, slots = table.indirect
+        self.fields = tuple(fields)
+        self.targets = []                       # control table address behind each indirect data byte
+        codes = []
+        for name in self.fields:
+            address, length = table.fields[name]
+            codes.append(STRUCT_CODES[length].lower() if name in SIGNED_FIELDS else STRUCT_CODES[length])
+            self.targets.extend(range(address, address + length))
+        if first_slot + len(self.targets) > slots:
+            raise ValueError("%d bytes from indirect slot %d do not fit the %d slots" % (len(self.targets), first_slot, slots))
+
+        self.format = '<' + ''.join(codes)
+        self.struct = struct.Struct(self.format)
+        self.size = self.struct.size
+        self.address = address_start + 2 * first_slot      # first Indirect Address register programmed
+        self.first_slot = first_slot
+        self.data_address = data_start + first_slot
+        self.address_bytes = b''.join(struct.pack('<H', target) for target in self.targets)
+        self.record = namedtuple('Servo_State', self.fields)
+
+    def decode(self, data):
+        return self.record._make(self.struct.unpack_from(data))
+
+    def profile(self):
+        # the mapping as control table fields, for apply_Profile: {'indirect_address_n': target address}
+        return dict(('indirect_address_%d' % (self.first_slot + offset + 1), target) for offset, target in enumerate(self.targets))
+
+
+class Dynamixel_Driver:
+    def __init__(self, port, model, ids, telemetry=None):
+        self.port = port
+        self.model = MODELS[model] if isinstance(model, str) else model
+        self.portHandler = make_Port_Handler(port)     # sim://... ports are served by dyna_sim
+        self.packetHandler = PacketHandler(self.model.protocol)
+        self.telemetry = telemetry
+        if telemetry is not None:
+            # latency / error / byte counters for every transaction on this port (bus_telemetry.Bus_Telemetry)
+            instrument_Packet_Handler(self.packetHandler, telemetry, port)
+        # status replies to the prebuilt packets are parsed by the SDK's own rxPacket, not the instrumented one;
+        # __transmit records them itself
+        self.rx_packet = getattr(type(self.packetHandler), 'rxPacket')
+        self.rx_args = () if self.model.protocol == 1.0 else (False,)
+        self.id_field, _, self.error_field = PACKET_FIELDS[self.model.protocol]
+        self.transport = None                   # dyna_async.Async_Transport while attach_Async is in effect
+        self.failures = 0                       # consecutive failed transactions, see healthy()
+        self.set_Ids(ids)
+
+    def set_Ids(self, ids):
+        self.ids = list(ids)
+        self.busReader = Bus_Reader(self.portHandler, self.packetHandler, self.ids, field_table=self.model.field_table,
+                                    group_read=self.model.group_read)
+        # cached copy of each motor's settings, profiles only write what differs
+        self.controlTables = dict((dxl_id, Control_Table_Mirror(self.portHandler, self.packetHandler, dxl_id, self.model.table))
+                                  for dxl_id in self.ids)
+        self.goalPackets = {}                   # id -> Goal_Packet, built on first use
+        self.syncPackets = {}                   # (ids, address, format) -> Sync_Write_Packet
+        self.blockPackets = {}                  # (id, data address, format) -> Goal_Packet of a State_Block
+
+    def discover(self, upgrade_baud=False):
+        # finds the rate (and for a single motor driver, the id) the servos answer on and optionally moves the
+        # bus to the fastest rate they support. returns the baud rate, None when nothing answered
+        scan_ids = self.ids if self.model.protocol == 1.0 else None
+        servos = scan_Bus(self.portHandler, self.packetHandler, ids=scan_ids)
+        if not servos:
+            print("No Dynamixel found on %s" % self.port)
+            return None
+        found = [servo.dxl_id for servo in servos]
+        if len(self.ids) == 1 and self.ids[0] not in found:
+            print("Dynamixel %d not found, using Dynamixel %d" % (self.ids[0], found[0]))
+            self.set_Ids([found[0]])
+        baudrate = servos[0].baudrate
+        if upgrade_baud:
+            upgraded = upgrade_Baud(self.portHandler, self.packetHandler, servos)
+            if upgraded is not None:
+                baudrate = upgraded
+        return baudrate
+
+    def note_Result(self, dxl_comm_result):
+        if dxl_comm_result == COMM_SUCCESS:
+            self.failures = 0
+        else:
+            self.failures += 1
+
+    def healthy(self):
+        return self.failures < MAX_CONSECUTIVE_FAILURES
+
+    def reopen(self):
+        # closes and reopens the port at its current rate after a fault. returns False while the device is gone
+        try:
+            self.portHandler.closePort()
+        except (OSError, AttributeError):
+            # AttributeError: a port that never opened has no serial object to close
+            pass
+        # a write that raised mid transaction left the port marked busy
+        self.portHandler.is_using = False
+        self.failures = 0
+        # the servos may have been power cycled along with the adapter
+        for controlTable in self.controlTables.values():
+            controlTable.invalidate()
+        try:
+            return self.portHandler.openPort()
+        except OSError:
+            return False
+
+    def read_State(self):
+        state, dxl_comm_result = self.busReader.read_State()
+        self.note_Result(dxl_comm_result)
+        return state, dxl_comm_result
+
+    def read_Moving(self, dxl_id):
+        dxl_moving, dxl_comm_result, dxl_error = self.packetHandler.read1ByteTxRx(self.portHandler, dxl_id, self.model.moving_address)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        return dxl_moving
+
+    def write_Goal(self, dxl_id, position):
+        # returns (comm result, status error) like the SDK write*TxRx calls
+        dxl_comm_result, dxl_error = self.__transmit(self.__goal_Packet(dxl_id).fill(position), dxl_id, INST_WRITE)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result == COMM_SUCCESS and dxl_error == 0:
+            self.controlTables[dxl_id].note('goal_position', position)
+        return dxl_comm_result, dxl_error
+
+    def map_Block(self, fields, first_slot=0):
+        # points the Indirect Address registers of every motor at fields. returns the State_Block, None when a
+        # motor refused. the registers only take writes with torque off, so apply_Profile drops torque around
+        # them when they differ; an init that sets torque itself folds block.profile() into its own profile instead
+        block = State_Block(self.model, fields, first_slot)
+        for dxl_id in self.ids:
+            apply_Profile(self.controlTables[dxl_id], block.profile())
+            if not self.block_Mapped(block, dxl_id):
+                print("Dynamixel %d refused the indirect mapping" % dxl_id)
+                return None
+        return block
+
+    def block_Mapped(self, block, dxl_id):
+        # True when the control table mirror saw the motor take (or already hold) every pointer of block
+        controlTable = self.controlTables[dxl_id]
+        return all(controlTable.cached(name) == target for name, target in block.profile().items())
+
+    def read_Block(self, block, dxl_id):
+        # every field of the block in one read. returns (record, comm result), record None when the read failed
+        data, dxl_comm_result, dxl_error = self.packetHandler.readTxRx(self.portHandler, dxl_id, block.data_address, block.size)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None, dxl_comm_result
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        return block.decode(bytes(data)), dxl_comm_result
+
+    def write_Block(self, block, dxl_id, values):
+        # values in block.fields order, every field writable. one prebuilt packet, like write_Goal
+        key = (dxl_id, block.data_address, block.format)
+        packet = self.blockPackets.get(key)
+        if packet is None:
+            packet = self.blockPackets[key] = Goal_Packet(self.model.protocol, dxl_id, block.data_address, block.format)
+        dxl_comm_result, dxl_error = self.__transmit(packet.fill(*values), dxl_id, INST_WRITE)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result == COMM_SUCCESS and dxl_error == 0:
+            for name, value in zip(block.fields, values):
+                self.controlTables[dxl_id].note(name, value)
+        return dxl_comm_result, dxl_error
+
+    def __goal_Packet(self, dxl_id):
+        goal = self.goalPackets.get(dxl_id)
+        if goal is None:
+            goal = self.goalPackets[dxl_id] = Goal_Packet(self.model.protocol, dxl_id, self.model.goal_address, self.model.goal_format)
+        return goal
+
+    def attach_Async(self, loop=None):
+        # hands the port to an asyncio transport on loop (default: the running one); use the *_Async calls
+        # from then on, blocking calls on this port get COMM_PORT_BUSY until detach_Async
+        if self.transport is None:
+            # asyncio is only imported by apps that use it, not on every startup
+            from dyna_async import Async_Transport
+            self.transport = Async_Transport(self.portHandler, self.model.protocol, loop, self.telemetry, self.port)
+        return self.transport
+
+    def detach_Async(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def write_Goal_Async(self, dxl_id, position):
+        dxl_comm_result, dxl_error = await self.transport.write_Packet(self.__goal_Packet(dxl_id).fill(position), dxl_id)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result == COMM_SUCCESS and dxl_error == 0:
+            self.controlTables[dxl_id].note('goal_position', position)
+        return dxl_comm_result, dxl_error
+
+    async def read_Position_Async(self, dxl_id):
+        # returns (present position, comm result), position None when the read failed
+        addr, length, encoding = self.model.field_table['position']
+        data, dxl_comm_result, dxl_error = await self.transport.read(dxl_id, addr, length)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result != COMM_SUCCESS:
+            return None, dxl_comm_result
+        return decode_Value(int.from_bytes(data, 'little'), length, encoding), dxl_comm_result
+
+    async def read_Block_Async(self, block, dxl_id):
+        data, dxl_comm_result, dxl_error = await self.transport.read(dxl_id, block.data_address, block.size)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result != COMM_SUCCESS:
+            return None, dxl_comm_result
+        return block.decode(data), dxl_comm_result
+
+    async def read_Moving_Async(self, dxl_id):
+        data, dxl_comm_result, dxl_error = await self.transport.read(dxl_id, self.model.moving_address, 1)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        return data[0]
+
+    def sync_Write(self, address, data_format, entries):
+        # entries: [(id, [register values])] packed with data_format starting at address; one broadcast packet,
+        # no status replies. returns the comm result
+        key = (tuple(dxl_id for dxl_id, _ in entries), address, data_format)
+        sync = self.syncPackets.get(key)
+        if sync is None:
+            sync = self.syncPackets[key] = Sync_Write_Packet(self.model.protocol, key[0], address, data_format)
+        dxl_comm_result, _ = self.__transmit(sync.fill(entries), BROADCAST_ID, INST_SYNC_WRITE)
+        self.note_Result(dxl_comm_result)
+        if dxl_comm_result == COMM_SUCCESS:
+            for dxl_id, values in entries:
+                controlTable = self.controlTables.get(dxl_id)
+                if controlTable is None:
+                    continue
+                for field_address, value in zip(sync.addresses, values):
+                    name = self.model.field_names.get(field_address)
+                    if name is not None:
+                        controlTable.note(name, value)
+        return dxl_comm_result
+
+    def __transmit(self, packet, dxl_id, instruction):
+        # the SDK txRxPacket sequence for a finished packet: send, then wait for the status unless broadcast
+        port = self.portHandler
+        if port.is_using:
+            return COMM_PORT_BUSY, 0
+        port.is_using = True
+        start = time.perf_counter()
+        rxpacket = None
+        dxl_error = 0
+        port.clearPort()
+        if port.writePort(packet) != len(packet):
+            port.is_using = False
+            dxl_comm_result = COMM_TX_FAIL
+        elif dxl_id == BROADCAST_ID:
+            port.is_using = False
+            dxl_comm_result = COMM_SUCCESS
+        else:
+            port.setPacketTimeout(STATUS_TIMEOUT_BYTES[self.model.protocol])
+            while True:
+                rxpacket, dxl_comm_result = self.rx_packet(self.packetHandler, port, *self.rx_args)
+                if dxl_comm_result != COMM_SUCCESS or rxpacket[self.id_field] == dxl_id:
+                    break
+            if dxl_comm_result == COMM_SUCCESS:
+                dxl_error = rxpacket[self.error_field]
+        if self.telemetry is not None:
+            self.telemetry.record(self.port, dxl_id, instruction, (time.perf_counter() - start) * 1000.0, dxl_comm_result,
+                                  dxl_error != 0, len(packet), len(rxpacket) if rxpacket else 0)
+        return dxl_comm_result, dxl_error
+
+
+def reconnect_With_Backoff(reconnect, keep_trying=lambda: True, sleep=time.sleep):
+    # calls reconnect() until it returns True, backing off from RECONNECT_BACKOFF_MIN to RECONNECT_BACKOFF_MAX
+    # between attempts. returns the seconds it took, None if keep_trying() turned False first
+    started = time.monotonic()
+    backoff = RECONNECT_BACKOFF_MIN
+    while keep_trying():
+        if reconnect():
+            return time.monotonic() - started
+        sleep(backoff)
+        backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+    return None
@@ -0,0 +1,157 @@
+# Dynamixel protocol 1.0 / 2.0 packet framing: checksum, table driven CRC16, byte stuffing,
+# packet building and an incremental parser that resynchronises on corrupt input.
+#
+# Protocol 1.0:  FF FF ID LEN INST|ERR PARAM... CHECKSUM                 LEN = params + 2
+# Protocol 2.0:  FF FF FD 00 ID LEN_L LEN_H INST PARAM... CRC_L CRC_H   LEN = params + 3 (stuffed)
+#                a status packet is INST 0x55 followed by the ERR byte and its params
+
+HEADER_1 = b'\xff\xff'
+HEADER_2 = b'\xff\xff\xfd\x00'
+
+INST_STATUS = 0x55
+BROADCAST_ID = 0xFE
+
+
+def make_CRC_Table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+CRC_TABLE = make_CRC_Table()
+
+
+def update_CRC(crc, data, start=0, end=None):
+    # CRC-16 (poly 0x8005, no reflection) as used by protocol 2.0
+    if end is None:
+        end = len(data)
+    table = CRC_TABLE
+    for i in range(start, end):
+        crc = ((crc << 8) ^ table[((crc >> 8) ^ data[i]) & 0xFF]) & 0xFFFF
+    return crc
+
+
+def checksum(data, start=0, end=None):
+    # protocol 1.0 checksum, ~(ID + LEN + INST + params)
+    if end is None:
+        end = len(data)
+    return ~sum(data[start:end]) & 0xFF
+
+
+def add_Stuffing(body):
+    # insert an extra 0xFD after every FF FF FD in the instruction + params part of a protocol 2.0 packet
+    out = bytearray()
+    for b in body:
+        out.append(b)
+        if b == 0xFD and len(out) >= 3 and out[-2] == 0xFF and out[-3] == 0xFF:
+            out.append(0xFD)
+    return out
+
+
+def remove_Stuffing(body):
+    out = bytearray()
+    i = 0
+    n = len(body)
+    while i < n:
+        b = body[i]
+        out.append(b)
+        if b == 0xFD and i + 1 < n and body[i + 1] == 0xFD and len(out) >= 3 and out[-2] == 0xFF and out[-3] == 0xFF:
+            i += 1
+        i += 1
+    return out
+
+
+def build_Packet(protocol, dxl_id, instruction, params=b''):
+    if protocol == 1.0:
+        packet = bytearray(HEADER_1)
+        packet.append(dxl_id)
+        packet.append(len(params) + 2)
+        packet.append(instruction)
+        packet += params
+        packet.append(checksum(packet, 2))
+        return packet
+
+    body = add_Stuffing(bytes((instruction,)) + bytes(params))
+    length = len(body) + 2
+    packet = bytearray(HEADER_2)
+    packet.append(dxl_id)
+    packet.append(length & 0xFF)
+    packet.append(length >> 8)
+    packet += body
+    crc = update_CRC(0, packet)
+    packet.append(crc & 0xFF)
+    packet.append(crc >> 8)
+    return packet
+
+
+def build_Status(protocol, dxl_id, error, params=b''):
+    if protocol == 1.0:
+        return build_Packet(1.0, dxl_id, error, params)
+    return build_Packet(2.0, dxl_id, INST_STATUS, bytes((error,)) + bytes(params))
+
+
+class Packet_Parser:
+    # Feed raw bytes in, get (id, instruction, params) tuples out. For protocol 1.0 status packets the
+    # instruction slot holds the error byte; protocol 2.0 status packets have INST_STATUS with params[0] the error.
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.buffer = bytearray()
+        self.corrupt_packets = 0
+
+    def reset(self):
+        # drop a partially received packet, e.g. the rest of a reply that timed out
+        del self.buffer[:]
+
+    def feed(self, data):
+        self.buffer += data
+        packets = []
+        while True:
+            packet = self.__next_Packet()
+            if packet is None:
+                return packets
+            packets.append(packet)
+
+    def __next_Packet(self):
+        buf = self.buffer
+        header = HEADER_1 if self.protocol == 1.0 else HEADER_2
+        while True:
+            start = buf.find(header)
+            if start < 0:
+                # keep a possible partial header at the end
+                del buf[:max(0, len(buf) - len(header) + 1)]
+                return None
+            if start:
+                del buf[:start]
+
+            if self.protocol == 1.0:
+                if len(buf) < 4:
+                    return None
+                if buf[2] > BROADCAST_ID:
+                    del buf[0]
+                    continue
+                total = buf[3] + 4
+                if len(buf) < total:
+                    return None
+                if checksum(buf, 2, total - 1) != buf[total - 1]:
+                    self.corrupt_packets += 1
+                    del buf[0]
+                    continue
+                packet = (buf[2], buf[4], bytes(buf[5:total - 1]))
+            else:
+                if len(buf) < 8:
+                    return None
+                total = (buf[5] | (buf[6] << 8)) + 7
+                if len(buf) < total:
+                    return None
+                if update_CRC(0, buf, 0, total - 2) != (buf[total - 2] | (buf[total - 1] << 8)):
+                    self.corrupt_packets += 1
+                    del buf[0]
+                    continue
+                body = remove_Stuffing(buf[7:total - 2])
+                packet = (buf[4], body[0], bytes(body[1:]))
+
+            del buf[:total]
+            return packet
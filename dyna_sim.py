@@ -0,0 +1,586 @@
+# In-process simulated Dynamixel bus, so the wrappers can be driven, profiled and tested without hardware.
+#
+# A port name of the form  sim://<preset>[?option=value&...]  gives a Sim_Port_Handler instead of a serial
+# PortHandler. It speaks protocol 1.0 or 2.0 packets to a set of Sim_Servo models, each with its own control
+# table, baud rate, return delay and first order motion dynamics.
+#
+#   sim://kubi                      two AX-12A (ids 1, 2), protocol 1.0, 1 Mbps  (kubi_wrapper)
+#   sim://x_series                  one XM430-W350 (id 1), protocol 2.0, 57600   (dyna_wrapper)
+#   sim://mx28?ids=1,2,3            MX-28s, protocol 1.0, Bulk Read capable
+#
+# options: ids=1,2  model=AX-12A  baud=1000000  tau=0.05 (motion time constant, s)  position=512
+#          timing=realtime|instant|virtual
+#            realtime  status packets arrive after their wire time + return delay, on the wall clock
+#            instant   no wire time at all
+#            virtual   wire time on a Virtual_Clock that jumps ahead whenever the SDK waits for a reply,
+#                      deterministic and as fast as the CPU allows
+#
+# The same URL always maps to the same bus, so a reopened port finds its servos where it left them.
+# get_Sim_Bus(url).unplug() makes the port raise OSError like a pulled USB adapter until plug().
+# Each bus counts the packets and bytes on its wire, and bus.listener sees every instruction packet.
+# X series servos implement indirect addressing (control_table.X_INDIRECT) for reads and writes; like EEPROM,
+# the Indirect Address registers refuse writes while torque is on.
+
+import math
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+from dynamixel_sdk import PortHandler
+from dynamixel_sdk import INST_PING, INST_READ, INST_WRITE, INST_REG_WRITE, INST_ACTION, INST_FACTORY_RESET
+from dynamixel_sdk import INST_REBOOT, INST_SYNC_READ, INST_SYNC_WRITE, INST_BULK_READ, INST_BULK_WRITE
+
+from dyna_packet import build_Status, Packet_Parser, BROADCAST_ID
+from control_table import AX_FIELDS, MX_FIELDS, X_FIELDS, X_INDIRECT
+
+SIM_SCHEME                  = 'sim'
+DEFAULT_TAU                 = 0.05              # s, first order motion time constant
+BAUD_TOLERANCE              = 0.03              # servos still decode a port rate within 3% of their own
+VIRTUAL_IDLE_STEP           = 0.001             # s the virtual clock moves when the SDK polls an empty port
+BITS_PER_BYTE               = 10                # 8N1
+
+# protocol 1.0 error bits
+ERRBIT_RANGE                = 0x08
+ERRBIT_INSTRUCTION          = 0x40
+# protocol 2.0 error numbers
+ERRNUM_INSTRUCTION          = 2
+ERRNUM_DATA_LENGTH          = 5
+ERRNUM_ACCESS               = 7
+
+
+class Servo_Model:
+    def __init__(self, name, protocol, model_number, table_size, fields, defaults, read_only, eeprom_end,
+                 eeprom_locked, baud_rates, ticks_per_revolution, speed_field, speed_unit_rpm, max_rpm, bulk_read, indirect=None):
+        self.name = name
+        self.protocol = protocol
+        self.model_number = model_number
+        self.table_size = table_size
+        self.fields = fields                    # name -> (address, length)
+        self.defaults = defaults                # name -> value
+        self.read_only = read_only              # field names
+        self.eeprom_end = eeprom_end
+        self.eeprom_locked = eeprom_locked      # EEPROM can't be written while torque is on (X series)
+        self.baud_rates = baud_rates            # baud register value -> bps
+        self.ticks_per_revolution = ticks_per_revolution
+        self.speed_field = speed_field          # register limiting the motion speed, 0 means unlimited
+        self.speed_unit_rpm = speed_unit_rpm
+        self.max_rpm = max_rpm
+        self.bulk_read = bulk_read
+        self.indirect = indirect                # control_table.X_INDIRECT style region, None without one
+
+
+PROTOCOL_1_BAUD_RATES = dict((value, 2000000 // (value + 1)) for value in range(0, 250))
+PROTOCOL_1_BAUD_RATES.update({250: 2250000, 251: 2500000, 252: 3000000})
+X_BAUD_RATES = {0: 9600, 1: 57600, 2: 115200, 3: 1000000, 4: 2000000, 5: 3000000, 6: 4000000, 7: 4500000}
+
+PROTOCOL_1_READ_ONLY = ('model_number', 'firmware', 'present_position', 'present_speed', 'present_load',
+                        'present_voltage', 'present_temperature', 'registered', 'moving')
+X_READ_ONLY = PROTOCOL_1_READ_ONLY + ('model_information', 'hardware_error', 'realtime_tick', 'moving_status', 'present_pwm')
+
+SERVO_MODELS = {
+    'AX-12A': Servo_Model('AX-12A', 1.0, 12, 50, AX_FIELDS,
+        {'model_number': 12, 'firmware': 24, 'baud_rate': 1, 'return_delay': 250, 'max_position': 1023,
+         'status_return_level': 2, 'cw_compliance_margin': 1, 'ccw_compliance_margin': 1,
+         'cw_compliance_slope': 32, 'ccw_compliance_slope': 32, 'torque_limit': 1023,
+         'present_voltage': 120, 'present_temperature': 35},
+        PROTOCOL_1_READ_ONLY, 24, False, PROTOCOL_1_BAUD_RATES, 1024 * 360 / 300.0, 'moving_speed', 0.111, 114.0, False),
+    'MX-28': Servo_Model('MX-28', 1.0, 29, 75, MX_FIELDS,
+        {'model_number': 29, 'firmware': 30, 'baud_rate': 34, 'return_delay': 250, 'max_position': 4095,
+         'status_return_level': 2, 'p_gain': 32, 'torque_limit': 1023, 'present_voltage': 120, 'present_temperature': 35},
+        PROTOCOL_1_READ_ONLY, 24, False, PROTOCOL_1_BAUD_RATES, 4096, 'moving_speed', 0.114, 55.0, True),
+    'XM430-W350': Servo_Model('XM430-W350', 2.0, 1020, 661, X_FIELDS,
+        {'model_number': 1020, 'firmware': 45, 'baud_rate': 1, 'return_delay': 250, 'operating_mode': 3,
+         'max_position': 4095, 'status_return_level': 2, 'velocity_i_gain': 1920, 'velocity_p_gain': 100,
+         'position_p_gain': 800, 'present_voltage': 120, 'present_temperature': 35},
+        X_READ_ONLY, 64, True, X_BAUD_RATES, 4096, 'profile_velocity', 0.229, 46.0, True, X_INDIRECT),
+}
+
+SIM_PRESETS = {
+    'kubi':     {'model': 'AX-12A', 'ids': [1, 2], 'baud': 1000000, 'position': 518},
+    'x_series': {'model': 'XM430-W350', 'ids': [1], 'baud': 57600, 'position': 2048},
+    'mx28':     {'model': 'MX-28', 'ids': [1], 'baud': 57600, 'position': 2048},
+}
+
+OPERATING_MODE_EXTENDED     = 4
+EXTENDED_POSITION_LIMIT     = 256 * 4096
+
+
+class Virtual_Clock:
+    def __init__(self, start=0.0):
+        self.t = start
+
+    def __call__(self):
+        return self.t
+
+    def advance(self, dt):
+        self.t += dt
+
+    def advance_To(self, t):
+        if t > self.t:
+            self.t = t
+
+
+class Sim_Servo:
+    def __init__(self, model, dxl_id, clock, baudrate=None, position=None, tau=DEFAULT_TAU):
+        self.model = model
+        self.clock = clock
+        self.tau = tau
+        self.table = bytearray(model.table_size)
+        self.reset_Table(dxl_id, baudrate)
+
+        if position is None:
+            position = self.get('max_position') // 2
+        self.position = float(position)
+        self.velocity = 0.0
+        self.set('present_position', int(position))
+        self.set('goal_position', int(position))
+        self.last_update = clock()
+        self.registered = None
+
+    def reset_Table(self, dxl_id, baudrate=None):
+        self.table[:] = bytes(len(self.table))
+        for name, value in self.model.defaults.items():
+            self.set(name, value)
+        self.set('id', dxl_id)
+        if self.model.indirect is not None:
+            # Indirect Address n points at Indirect Data n by default, so the data bytes act as plain memory
+            address_start, data_start, slots = self.model.indirect
+            for slot in range(slots):
+                self.table[address_start + 2 * slot:address_start + 2 * slot + 2] = (data_start + slot).to_bytes(2, 'little')
+        if baudrate is not None:
+            self.set('baud_rate', baud_Register(self.model, baudrate))
+
+    # control table access
+    def get(self, name, signed=False):
+        addr, length = self.model.fields[name]
+        return int.from_bytes(self.table[addr:addr + length], 'little', signed=signed)
+
+    def set(self, name, value):
+        addr, length = self.model.fields[name]
+        self.table[addr:addr + length] = (value & ((1 << (8 * length)) - 1)).to_bytes(length, 'little')
+
+    @property
+    def dxl_id(self):
+        return self.table[self.model.fields['id'][0]]
+
+    @property
+    def baudrate(self):
+        return self.model.baud_rates.get(self.get('baud_rate'), 0)
+
+    @property
+    def return_Delay(self):
+        return self.get('return_delay') * 2e-6
+
+    def hears(self, baudrate):
+        return abs(self.baudrate - baudrate) <= BAUD_TOLERANCE * baudrate
+
+    def read(self, addr, length):
+        # returns (error, data)
+        self.update()
+        if addr + length > len(self.table):
+            return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS), b''
+        data = bytearray(self.table[addr:addr + length])
+        for offset, target in self.__indirect_Targets(addr, addr + length):
+            data[offset] = self.table[target]
+        return 0, bytes(data)
+
+    def write(self, addr, data):
+        self.update()
+        end = addr + len(data)
+        if end > len(self.table) or self.__touches_Read_Only(addr, end):
+            return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS)
+        if self.model.eeprom_locked and addr < self.model.eeprom_end and self.get('torque_enable'):
+            return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS)
+        if self.model.indirect is not None and self.get('torque_enable'):
+            # the Indirect Address registers are locked like EEPROM
+            address_start, _, slots = self.model.indirect
+            if addr < address_start + 2 * slots and address_start < end:
+                return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS)
+
+        redirected = self.__indirect_Targets(addr, end)
+        for offset, target in redirected:
+            if target >= len(self.table) or self.__touches_Read_Only(target, target + 1):
+                return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS)
+            if self.model.eeprom_locked and target < self.model.eeprom_end and self.get('torque_enable'):
+                return self.__error(ERRBIT_RANGE, ERRNUM_ACCESS)
+
+        self.table[addr:end] = data
+        for offset, target in redirected:
+            self.table[target] = data[offset]
+        goal_addr, goal_length = self.model.fields['goal_position']
+        if self.model.protocol == 1.0 and addr < goal_addr + goal_length and goal_addr < end:
+            # protocol 1.0 servos switch torque on by themselves when given a goal
+            self.set('torque_enable', 1)
+        return 0
+
+    def __indirect_Targets(self, addr, end):
+        # [(offset into the access, control table address)] for the indirect data bytes in [addr, end)
+        if self.model.indirect is None:
+            return []
+        address_start, data_start, slots = self.model.indirect
+        targets = []
+        for data_addr in range(max(addr, data_start), min(end, data_start + slots)):
+            pointer = address_start + 2 * (data_addr - data_start)
+            targets.append((data_addr - addr, self.table[pointer] | self.table[pointer + 1] << 8))
+        return targets
+
+    def __touches_Read_Only(self, addr, end):
+        for name in self.model.read_only:
+            field_addr, field_length = self.model.fields[name]
+            if addr < field_addr + field_length and field_addr < end:
+                return True
+        return False
+
+    def __error(self, protocol_1_error, protocol_2_error):
+        return protocol_1_error if self.model.protocol == 1.0 else protocol_2_error
+
+    # first order motion towards the goal, speed capped by the model and its speed register
+    def update(self):
+        now = self.clock()
+        dt = now - self.last_update
+        if dt <= 0:
+            return
+        self.last_update = now
+
+        model = self.model
+        if self.get('torque_enable'):
+            goal = self.get('goal_position', signed=model.protocol == 2.0)
+            rpm = model.max_rpm
+            speed = self.get(model.speed_field)
+            if speed:
+                rpm = min(rpm, speed * model.speed_unit_rpm)
+            max_step = rpm * model.ticks_per_revolution / 60.0 * dt
+
+            step = (goal - self.position) * (1.0 - math.exp(-dt / self.tau))
+            step = max(-max_step, min(max_step, step))
+            if abs(goal - (self.position + step)) < 0.5:
+                step = goal - self.position
+            self.position += step
+            self.velocity = step / dt
+        else:
+            self.velocity = 0.0
+
+        self.position = min(max(self.position, self.__min_Position()), self.__max_Position())
+        self.set('present_position', int(round(self.position)))
+        self.set('present_speed', self.__encode_Speed(self.velocity))
+        self.set('moving', 1 if abs(self.get('goal_position', signed=model.protocol == 2.0) - self.position) >= 1.0 and self.get('torque_enable') else 0)
+
+    def __min_Position(self):
+        if self.model.protocol == 2.0:
+            if self.get('operating_mode') == OPERATING_MODE_EXTENDED:
+                return -EXTENDED_POSITION_LIMIT
+            return self.get('min_position', signed=True)
+        return self.get('min_position')
+
+    def __max_Position(self):
+        if self.model.protocol == 2.0:
+            if self.get('operating_mode') == OPERATING_MODE_EXTENDED:
+                return EXTENDED_POSITION_LIMIT
+            return self.get('max_position', signed=True)
+        return self.get('max_position')
+
+    def __encode_Speed(self, velocity):
+        units = int(round(abs(velocity) * 60.0 / self.model.ticks_per_revolution / self.model.speed_unit_rpm))
+        if self.model.protocol == 1.0:
+            # sign-magnitude, bit 10 set when turning clockwise (decreasing position)
+            units = min(units, 1023)
+            return units | 0x400 if velocity < 0 else units
+        return -units if velocity < 0 else units
+
+
+def baud_Register(model, baudrate):
+    best = None
+    for value, rate in model.baud_rates.items():
+        if best is None or abs(rate - baudrate) < abs(model.baud_rates[best] - baudrate):
+            best = value
+    return best
+
+
+class Sim_Bus:
+    def __init__(self, protocol, servos, clock, timing='realtime'):
+        self.protocol = protocol
+        self.servos = servos
+        self.clock = clock
+        self.timing = timing
+        self.lock = threading.Lock()
+        self.plugged = True                     # unplug() makes the port act like a pulled USB adapter
+        self.packets = 0                        # instruction packets received
+        self.status_packets = 0                 # status packets sent back
+        self.wire_bytes = 0                     # both directions
+        self.listener = None                    # called as listener(dxl_id, instruction, params) for every instruction packet
+
+    def unplug(self):
+        self.plugged = False
+
+    def plug(self):
+        self.plugged = True
+
+    def find(self, dxl_id, baudrate):
+        for servo in self.servos:
+            if servo.dxl_id == dxl_id and servo.hears(baudrate):
+                return servo
+        return None
+
+    def listening(self, baudrate):
+        return [servo for servo in sorted(self.servos, key=lambda s: s.dxl_id) if servo.hears(baudrate)]
+
+    def handle(self, dxl_id, instruction, params, baudrate):
+        # returns [(servo, status packet bytes)] in the order the servos answer
+        with self.lock:
+            if instruction == INST_PING:
+                return self.__ping(dxl_id, baudrate)
+            elif instruction in (INST_SYNC_WRITE, INST_BULK_WRITE):
+                self.__group_Write(instruction, params, baudrate)
+                return []
+            elif instruction in (INST_SYNC_READ, INST_BULK_READ):
+                return self.__group_Read(instruction, params, baudrate)
+            elif instruction == INST_ACTION:
+                return self.__action(dxl_id, baudrate)
+
+            if dxl_id == BROADCAST_ID:
+                targets = self.listening(baudrate)
+            else:
+                servo = self.find(dxl_id, baudrate)
+                targets = [servo] if servo is not None else []
+
+            replies = []
+            for servo in targets:
+                error, data, level = self.__unicast(servo, instruction, params)
+                if dxl_id != BROADCAST_ID and servo.get('status_return_level') >= level:
+                    replies.append((servo, build_Status(self.protocol, servo.dxl_id, error, data)))
+            return replies
+
+    def __unicast(self, servo, instruction, params):
+        # returns (error, status params, status return level needed for a reply)
+        p1 = self.protocol == 1.0
+        if instruction == INST_READ:
+            if p1:
+                addr, length = params[0], params[1]
+            else:
+                addr, length = params[0] | (params[1] << 8), params[2] | (params[3] << 8)
+            error, data = servo.read(addr, length)
+            return error, data, 1
+        elif instruction in (INST_WRITE, INST_REG_WRITE):
+            if p1:
+                addr, data = params[0], params[1:]
+            else:
+                addr, data = params[0] | (params[1] << 8), params[2:]
+            if instruction == INST_REG_WRITE:
+                servo.registered = (addr, bytes(data))
+                servo.set('registered', 1)
+                return 0, b'', 2
+            return servo.write(addr, data), b'', 2
+        elif instruction == INST_FACTORY_RESET:
+            servo.reset_Table(servo.dxl_id if not p1 else 1)
+            return 0, b'', 2
+        elif instruction == INST_REBOOT and not p1:
+            servo.set('torque_enable', 0)
+            servo.set('hardware_error', 0)
+            return 0, b'', 2
+        return (ERRBIT_INSTRUCTION if p1 else ERRNUM_INSTRUCTION), b'', 0
+
+    def __ping(self, dxl_id, baudrate):
+        if dxl_id == BROADCAST_ID:
+            # protocol 1.0 has no broadcast ping
+            targets = self.listening(baudrate) if self.protocol == 2.0 else []
+        else:
+            servo = self.find(dxl_id, baudrate)
+            targets = [servo] if servo is not None else []
+
+        replies = []
+        for servo in targets:
+            params = b''
+            if self.protocol == 2.0:
+                params = bytes((servo.model.model_number & 0xFF, servo.model.model_number >> 8, servo.get('firmware')))
+            replies.append((servo, build_Status(self.protocol, servo.dxl_id, 0, params)))
+        return replies
+
+    def __action(self, dxl_id, baudrate):
+        replies = []
+        for servo in self.listening(baudrate):
+            if dxl_id not in (BROADCAST_ID, servo.dxl_id) or servo.registered is None:
+                continue
+            addr, data = servo.registered
+            servo.registered = None
+            servo.set('registered', 0)
+            error = servo.write(addr, data)
+            if dxl_id != BROADCAST_ID and servo.get('status_return_level') >= 2:
+                replies.append((servo, build_Status(self.protocol, servo.dxl_id, error)))
+        return replies
+
+    def __group_Write(self, instruction, params, baudrate):
+        if instruction == INST_SYNC_WRITE:
+            if self.protocol == 1.0:
+                addr, length, offset = params[0], params[1], 2
+            else:
+                addr, length, offset = params[0] | (params[1] << 8), params[2] | (params[3] << 8), 4
+            while offset + 1 + length <= len(params):
+                servo = self.find(params[offset], baudrate)
+                if servo is not None:
+                    servo.write(addr, params[offset + 1:offset + 1 + length])
+                offset += 1 + length
+        else:
+            offset = 0
+            while offset + 5 <= len(params):
+                addr = params[offset + 1] | (params[offset + 2] << 8)
+                length = params[offset + 3] | (params[offset + 4] << 8)
+                servo = self.find(params[offset], baudrate)
+                if servo is not None:
+                    servo.write(addr, params[offset + 5:offset + 5 + length])
+                offset += 5 + length
+
+    def __group_Read(self, instruction, params, baudrate):
+        requests = []
+        if instruction == INST_SYNC_READ:
+            if self.protocol == 1.0:
+                return []
+            addr, length = params[0] | (params[1] << 8), params[2] | (params[3] << 8)
+            requests = [(dxl_id, addr, length) for dxl_id in params[4:]]
+        elif self.protocol == 1.0:
+            for i in range(1, len(params) - 2, 3):
+                requests.append((params[i + 1], params[i + 2], params[i]))
+        else:
+            for i in range(0, len(params) - 4, 5):
+                requests.append((params[i], params[i + 1] | (params[i + 2] << 8), params[i + 3] | (params[i + 4] << 8)))
+
+        replies = []
+        for dxl_id, addr, length in requests:
+            servo = self.find(dxl_id, baudrate)
+            if servo is None:
+                # later servos wait for this one's answer, so the rest of the chain stays quiet too
+                break
+            if instruction == INST_BULK_READ and not servo.model.bulk_read:
+                break
+            if servo.get('status_return_level') < 1:
+                continue
+            error, data = servo.read(addr, length)
+            replies.append((servo, build_Status(self.protocol, servo.dxl_id, error, data)))
+        return replies
+
+
+class Sim_Port_Handler(PortHandler):
+    # PortHandler look-alike: the SDK packet handlers and group classes use it unchanged
+    def __init__(self, port_name):
+        PortHandler.__init__(self, port_name)
+        self.bus = get_Sim_Bus(port_name)
+        self.parser = Packet_Parser(self.bus.protocol)
+        self.pending = deque()                  # (time the bytes are readable, bytes)
+        self.rx = bytearray()
+
+    def setupPort(self, cflag_baud):
+        if not self.bus.plugged:
+            raise OSError("simulated device %s is unplugged" % self.port_name)
+        self.is_open = True
+        self.tx_time_per_byte = (1000.0 / self.baudrate) * BITS_PER_BYTE
+        self.clearPort()
+        return True
+
+    def closePort(self):
+        self.is_open = False
+
+    def clearPort(self):
+        self.pending.clear()
+        del self.rx[:]
+
+    def getCurrentTime(self):
+        return self.bus.clock() * 1000.0
+
+    def getBytesAvailable(self):
+        self.__collect()
+        return len(self.rx)
+
+    def readPort(self, length):
+        self.__collect()
+        if not self.rx and self.bus.timing == 'virtual':
+            # nothing yet: jump the virtual clock to the next reply, or let a timeout run down
+            clock = self.bus.clock
+            clock.advance_To(self.pending[0][0] if self.pending else clock() + VIRTUAL_IDLE_STEP)
+            self.__collect()
+        data = bytes(self.rx[:length])
+        del self.rx[:length]
+        return data
+
+    def writePort(self, packet):
+        data = bytes(packet)
+        if not self.bus.plugged:
+            # pyserial raises SerialException (an OSError) once the adapter is gone
+            raise OSError("simulated device %s is unplugged" % self.port_name)
+        if not self.is_open:
+            return 0
+
+        byte_time = BITS_PER_BYTE / float(self.baudrate)
+        ready = self.bus.clock()
+        if self.bus.timing != 'instant':
+            ready += len(data) * byte_time
+
+        bus = self.bus
+        bus.wire_bytes += len(data)
+        for dxl_id, instruction, params in self.parser.feed(data):
+            bus.packets += 1
+            if bus.listener is not None:
+                bus.listener(dxl_id, instruction, params)
+            for servo, status in bus.handle(dxl_id, instruction, params, self.baudrate):
+                if bus.timing != 'instant':
+                    ready += servo.return_Delay + len(status) * byte_time
+                self.pending.append((ready, status))
+                bus.status_packets += 1
+                bus.wire_bytes += len(status)
+        return len(data)
+
+    def __collect(self):
+        now = self.bus.clock()
+        while self.pending and self.pending[0][0] <= now:
+            self.rx += self.pending.popleft()[1]
+
+
+SIM_BUSES = {}
+SIM_BUSES_LOCK = threading.Lock()
+
+
+def is_Sim_Port(port):
+    return isinstance(port, str) and port.startswith(SIM_SCHEME + '://')
+
+
+def get_Sim_Bus(url):
+    with SIM_BUSES_LOCK:
+        if url not in SIM_BUSES:
+            SIM_BUSES[url] = make_Sim_Bus(url)
+        return SIM_BUSES[url]
+
+
+def reset_Sim_Buses():
+    with SIM_BUSES_LOCK:
+        SIM_BUSES.clear()
+
+
+def make_Sim_Bus(url):
+    parsed = urlparse(url)
+    preset = parsed.netloc or parsed.path.strip('/')
+    if preset not in SIM_PRESETS:
+        raise ValueError("unknown simulated bus %r, expected one of %s" % (preset, ", ".join(sorted(SIM_PRESETS))))
+
+    options = dict(SIM_PRESETS[preset])
+    for key, values in parse_qs(parsed.query).items():
+        options[key] = values[-1]
+
+    model = SERVO_MODELS[options['model']]
+    ids = options['ids']
+    if isinstance(ids, str):
+        ids = [int(dxl_id) for dxl_id in ids.split(',')]
+    timing = options.get('timing', 'realtime')
+    if timing not in ('realtime', 'instant', 'virtual'):
+        raise ValueError("unknown sim timing %r" % timing)
+    clock = Virtual_Clock() if timing == 'virtual' else time.monotonic
+
+    servos = [Sim_Servo(model, dxl_id, clock, baudrate=int(options['baud']), position=int(options['position']),
+                        tau=float(options.get('tau', DEFAULT_TAU)))
+              for dxl_id in ids]
+    return Sim_Bus(model.protocol, servos, clock, timing)
+
+
+def make_Port_Handler(port):
+    # serial PortHandler for a device path, Sim_Port_Handler for a sim:// URL
+    if is_Sim_Port(port):
+        return Sim_Port_Handler(port)
+    return PortHandler(port)
@@ -2,7 +2,10 @@
 # Dynamixel Wrapper code taken from DYNAMIXEL protocol 2 exmaple
 # angles must be in degrees 
 
+import asyncio
 import os
+import threading
+from concurrent.futures import Future
 
 if os.name == 'nt':
     import msvcrt
@@ -10,9 +13,10 @@ if os.name == 'nt':
         return msvcrt.getch().decode()
 else:
     import sys, tty, termios
-    fd = sys.stdin.fileno()
-    old_settings = termios.tcgetattr(fd)
     def getch():
+        # terminal settings are read here rather than at import, so the wrapper also loads without a tty
+        fd = sys.stdin.fileno()
+        old_settings = termios.tcgetattr(fd)
         try:
             tty.setraw(sys.stdin.fileno())
             ch = sys.stdin.read(1)
@@ -21,152 +25,401 @@ else:
         return ch
     
 from dynamixel_sdk import * # Uses Dynamixel SDK library
+from dyna_driver import Dynamixel_Driver, State_Block, Connection_Error, reconnect_With_Backoff
+from control_table import apply_Profile
+from recorder import KIND_GOAL, KIND_PRESENT
+from startup import startup_Phase
 
-MY_DXL = 'X_SERIES'
+MY_DXL = 'X_SERIES'                 # dyna_driver.MODELS entry: 'X_SERIES', 'XL320', 'MX' or 'AX'
 
-ADDR_TORQUE_ENABLE          = 64
-ADDR_GOAL_POSITION          = 116
-ADDR_PRESENT_POSITION       = 132
-DXL_MINIMUM_POSITION_VALUE  = 0         # Refer to the Minimum Position Limit of product eManual
-DXL_MAXIMUM_POSITION_VALUE  = 4095     # Refer to the Maximum Position Limit of product eManual
 BAUDRATE                    = 57600
 
-ADDR_OPERATING_MODE = 11
-ADDR_GOAL_VELOCITY = 104
-
 
 OPERATING_MODE              = 4     # Extended Position Control Mode
 TORQUE_ENABLE               = 1     # Value for enabling the torque
 TORQUE_DISABLE              = 0     # Value for disabling the torque
 DXL_MOVING_STATUS_THRESHOLD = 10    # Dynamixel moving status threshold
+MOTION_POLL_INTERVAL        = 0.02  # seconds between completion polls of a pending motion
+MOTION_STOPPED_POLLS        = 2     # polls with the Moving flag clear before a motion that fell short counts as settled
 
 DXL_ID                      = 1
-PROTOCOL_VERSION            = 2.0
+
+# read together in one transaction (read_State) through the indirect data region, on models that have one
+STATE_FIELDS                = ('present_position', 'moving', 'present_speed', 'present_load', 'present_temperature', 'hardware_error')
 
 FULL_REVOLUTION             = 360
 
 class Dynamixel_Servo:
-    def __init__(self, port):
+    def __init__(self, port, telemetry=None, dxl_id=DXL_ID, baudrate=BAUDRATE, discover=False, upgrade_baud=False, profile=None,
+                 recorder=None, record_slot=0, state_fields=STATE_FIELDS, startup=None):
         self.port = port
-        self.portHandler = PortHandler(port)
-        self.packetHandler = PacketHandler(PROTOCOL_VERSION)
+        self.baudrate = baudrate
+        self.discover = discover                        # scan baud rates / ids at init instead of trusting the above
+        self.upgrade_baud = upgrade_baud                # then move the bus to the fastest rate it supports
+        # control table, Bus_Reader and prebuilt goal packets for MY_DXL (dyna_driver)
+        self.driver = Dynamixel_Driver(port, MY_DXL, [dxl_id], telemetry)
+        self.model = self.driver.model
+        self.portHandler = self.driver.portHandler
+        self.packetHandler = self.driver.packetHandler
+        self.profile = profile                          # control_table.PROFILES entry applied at init
+        self.recorder = recorder                        # recorder.Recorder for goals and present positions
+        self.record_slot = record_slot
+        self.startup = startup                          # startup.Startup_Timer timing the connect / init phases
         self.dxl_goal_position = 0
+        self.state_fields = state_fields if self.model.table.indirect is not None else None
+        self.state_block = None                         # dyna_driver.State_Block, mapped by init_Dynamixel
+
+        # the serial port is shared between the caller and the motion poller thread
+        self.busLock = threading.RLock()
+        self.motion_future = None
+        self.motion_event = threading.Event()
+        self.motion_poller = None
+        self.polling = False
+        self.async_motion = None                        # settle task of the pending *_Async motion
     
-    def connect_Dynamixel(self):
-        if self.portHandler.openPort():
+    def connect_Dynamixel(self, exit_on_failure=True):
+        # exit_on_failure=False raises dyna_driver.Connection_Error instead of waiting for a key and quitting
+        with startup_Phase(self.startup, self.port + " open"):
+            opened = self.portHandler.openPort()
+        if opened:
             print("Succeeded to open the port")
         else:
             print("Failed to open the port")
+            if not exit_on_failure:
+                raise Connection_Error("Failed to open %s" % self.port)
             print("Press any key to terminate...")
             getch()
             quit()
 
-    def init_Dynamixel(self):
+    @property
+    def dxl_id(self):
+        # discovery may move the driver to the id that actually answered
+        return self.driver.ids[0]
+
+    @property
+    def controlTable(self):
+        # cached copy of the servo's settings, init and profiles only write what differs
+        return self.driver.controlTables[self.dxl_id]
+
+    def discover_Dynamixel(self):
+        # find the rate (and, if DXL_ID is not there, the id) the servo answers on
+        baudrate = self.driver.discover(self.upgrade_baud)
+        if baudrate is None:
+            return False
+        self.baudrate = baudrate
+        return True
+
+    def init_Dynamixel(self, exit_on_failure=True, discover=None):
+        # discover: override self.discover, a reconnect already knows the rate
+        if self.discover if discover is None else discover:
+            with startup_Phase(self.startup, self.port + " discover"):
+                self.discover_Dynamixel()
+
         # Set port baudrate
-        if self.portHandler.setBaudRate(BAUDRATE):
+        with startup_Phase(self.startup, self.port + " baud"):
+            baud_set = self.portHandler.setBaudRate(self.baudrate)
+        if baud_set:
             print("Succeeded to change the baudrate")
         else:
             print("Failed to change the baudrate")
+            if not exit_on_failure:
+                raise Connection_Error("Failed to set %s to %d baud" % (self.port, self.baudrate))
             print("Press any key to terminate...")
             getch()
             quit()
 
         
-        # Disable Dynamixel Torque
-        dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, DXL_ID, ADDR_TORQUE_ENABLE, TORQUE_DISABLE)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        
+        # the servo may have been power cycled since it was last seen
+        self.controlTable.invalidate()
 
-        # Switch to Extended Posiiton Control Mode
-        dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, DXL_ID, ADDR_OPERATING_MODE, OPERATING_MODE)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        else:
+        # Extended Position Control Mode, the indirect mapping of the state block and torque on, plus the profile
+        # if there is one. Only registers that differ are written, so torque is only dropped when the (EEPROM)
+        # operating mode or the (torque locked) Indirect Address registers actually change
+        config = dict(self.profile or {})
+        config['operating_mode'] = OPERATING_MODE
+        state_block = State_Block(self.model, self.state_fields) if self.state_fields else None
+        if state_block is not None:
+            config.update(state_block.profile())
+        config['torque_enable'] = TORQUE_ENABLE
+        with startup_Phase(self.startup, self.port + " profile"):
+            written = apply_Profile(self.controlTable, config)
+        if 'operating_mode' in written:
             print("Dynamixel has been set to extended position control mode")
-
-
-        # Enable Dynamixel Torque
-        dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, DXL_ID, ADDR_TORQUE_ENABLE, TORQUE_ENABLE)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        else:
-            print("Dynamixel has been successfully connected")
+        self.state_block = None
+        if state_block is not None:
+            if self.driver.block_Mapped(state_block, self.dxl_id):
+                self.state_block = state_block
+            else:
+                print("Dynamixel %d refused the indirect mapping, state reads fall back to single fields" % self.dxl_id)
         
         # set intial position
-        if (MY_DXL == 'XL320'): # XL320 uses 2 byte Position Data, Check the size of data in your DYNAMIXEL's control table
-                dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
+        with startup_Phase(self.startup, self.port + " position"):
+            dxl_present_position = self.read_Position()
+        if self.driver.failures:
+            if not exit_on_failure:
+                raise Connection_Error("Dynamixel %d on %s did not answer" % (self.dxl_id, self.port))
         else:
-            dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read4ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+            print("Dynamixel has been successfully connected")
         
         self.dxl_goal_position = dxl_present_position
 
+    def reconnect_Dynamixel(self):
+        # reopens the port and reinitialises after a fault (pulled adapter, servo power loss), without quitting.
+        # returns False while the bus is still gone; a pending motion is sent on towards its goal
+        goal_position = self.dxl_goal_position
+        with self.busLock:
+            try:
+                if not self.driver.reopen():
+                    return False
+                self.init_Dynamixel(exit_on_failure=False, discover=False)
+            except (Connection_Error, OSError) as error:
+                print("Reconnect of %s failed: %s" % (self.port, error))
+                return False
+            if self.motion_future is not None:
+                self.dxl_goal_position = goal_position
+                self.driver.write_Goal(self.dxl_id, goal_position)
+        return True
+
+    def __recover(self, reason):
+        print("%s: bus lost (%s), reconnecting" % (self.port, reason))
+        elapsed = reconnect_With_Backoff(self.reconnect_Dynamixel, lambda: self.polling)
+        if elapsed is not None:
+            print("%s: reconnected in %.1f ms" % (self.port, elapsed * 1000.0))
+
+
+    def read_Position(self):
+        with self.busLock:
+            state, dxl_comm_result = self.driver.read_State()
+        if self.recorder is not None:
+            self.recorder.record(KIND_PRESENT, (state[0, 0],), self.dxl_id, self.record_slot)
+        return int(state[0, 0])
+
+    def read_Moving(self):
+        with self.busLock:
+            return self.driver.read_Moving(self.dxl_id)
+
+    def read_State(self):
+        # STATE_FIELDS as a namedtuple from one read, None when the read failed or the model has no indirect region
+        if self.state_block is None:
+            return None
+        with self.busLock:
+            state, dxl_comm_result = self.driver.read_Block(self.state_block, self.dxl_id)
+        if state is not None and self.recorder is not None and 'present_position' in self.state_block.fields:
+            self.recorder.record(KIND_PRESENT, (state.present_position,), self.dxl_id, self.record_slot)
+        return state
+
+    def __read_Position_Moving(self):
+        # (present position, Moving flag) from the state block in one read; the flag is None when the block
+        # does not hold both and it needs a read of its own
+        block = self.state_block
+        if block is not None and 'present_position' in block.fields and 'moving' in block.fields:
+            state = self.read_State()
+            if state is None:
+                return None, None
+            return state.present_position, state.moving
+        return self.read_Position(), None
+
 
     def __rotate_Motor(self, angle):
         # print("Press any key to continue! (or press ESC to quit!)")
         # if getch() == chr(0x1b):
         #     quit()
 
-        # Write goal position
-        if (MY_DXL == 'XL320'): # XL320 uses 2 byte Position Data, Check the size of data in your DYNAMIXEL's control table
-            dxl_comm_result, dxl_error = self.packetHandler.write2ByteTxRx(self.portHandler, DXL_ID, ADDR_GOAL_POSITION, self.dxl_goal_position)
-        else:
-            dxl_comm_result, dxl_error = self.packetHandler.write4ByteTxRx(self.portHandler, DXL_ID, ADDR_GOAL_POSITION, self.dxl_goal_position)
+        # Write goal position, the driver sizes it for the model and notes it in the control table mirror
+        with self.busLock:
+            dxl_comm_result, dxl_error = self.driver.write_Goal(self.dxl_id, self.dxl_goal_position)
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
         elif dxl_error != 0:
             print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        if self.recorder is not None:
+            self.recorder.record(KIND_GOAL, (self.dxl_goal_position,), self.dxl_id, self.record_slot)
 
-        while 1:
-            # Read present position
-            if (MY_DXL == 'XL320'): # XL320 uses 2 byte Position Data, Check the size of data in your DYNAMIXEL's control table
-                dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
-            else:
-                dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read4ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
-            if dxl_comm_result != COMM_SUCCESS:
-                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-            elif dxl_error != 0:
-                print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-
-            currAngle = ((dxl_present_position * FULL_REVOLUTION) // DXL_MAXIMUM_POSITION_VALUE) % FULL_REVOLUTION
-            #print("[ID:%03d] GoalAngle:%03d  PresAngle:%03d" % (DXL_ID, angle % FULL_REVOLUTION, currAngle))
-            if not abs(self.dxl_goal_position  - (dxl_present_position) ) > DXL_MOVING_STATUS_THRESHOLD:
-                return
+        # a new goal preempts the pending motion; its future is cancelled
+        future = Future()
+        with self.busLock:
+            if self.motion_future is not None:
+                self.motion_future.cancel()
+            self.motion_future = future
+        self.__start_Motion_Poller()
+        self.motion_event.set()
+        return future
+
+    def __start_Motion_Poller(self):
+        if self.motion_poller is not None and self.motion_poller.is_alive():
+            return
+        self.polling = True
+        self.motion_poller = threading.Thread(target=self.__poll_Motion, name="dxl-motion-poller", daemon=True)
+        self.motion_poller.start()
+
+    def stop_Motion_Poller(self):
+        self.polling = False
+        self.motion_event.set()
+        if self.motion_poller is not None:
+            self.motion_poller.join()
+            self.motion_poller = None
+
+    def __poll_Motion(self):
+        stopped_polls = 0
+        while self.polling:
+            if self.motion_future is None:
+                self.motion_event.wait()
+                self.motion_event.clear()
+                stopped_polls = 0
+                continue
+
+            # rate limited, so the bus stays free for other traffic between polls
+            if self.motion_event.wait(MOTION_POLL_INTERVAL):
+                self.motion_event.clear()
+                stopped_polls = 0
+
+            try:
+                with self.busLock:
+                    future = self.motion_future
+                    if future is None:
+                        continue
+                    goal_position = self.dxl_goal_position
+                    dxl_present_position, dxl_moving = self.__read_Position_Moving()
+                    if self.driver.failures:
+                        # no fresh position, try again next poll (or reconnect below)
+                        settled = False
+                    else:
+                        settled = not abs(goal_position - dxl_present_position) > DXL_MOVING_STATUS_THRESHOLD
+                        if not settled:
+                            # the Moving flag catches a motor that stopped short of the threshold (blocked, compliance)
+                            if dxl_moving is None:
+                                dxl_moving = self.read_Moving()
+                            stopped_polls = stopped_polls + 1 if dxl_moving == 0 else 0
+                            settled = stopped_polls >= MOTION_STOPPED_POLLS
+                    if settled:
+                        self.motion_future = None
+            except OSError as error:
+                # the serial device went away under a transaction
+                self.__recover(error)
+                continue
+            if not self.driver.healthy():
+                self.__recover("%d failed transactions in a row" % self.driver.failures)
+                continue
+
+            if settled and future.set_running_or_notify_cancel():
+                future.set_result(dxl_present_position)
     
 
     def rotate_Degrees(self, degrees):
-        self.dxl_goal_position = (self.dxl_goal_position + int(float(degrees) * float(DXL_MAXIMUM_POSITION_VALUE) / float(FULL_REVOLUTION)))
-        self.__rotate_Motor(self.dxl_goal_position) 
+        # returns a concurrent.futures.Future resolving to the settled position,
+        # use asyncio.wrap_future() to await it from the ARENA event loop
+        self.dxl_goal_position = self.dxl_goal_position + self.model.angle_To_Ticks(degrees)
+        return self.__rotate_Motor(self.dxl_goal_position) 
 
     def rotate_To_Angle(self, angle):
-        if (MY_DXL == 'XL320'): # XL320 uses 2 byte Position Data, Check the size of data in your DYNAMIXEL's control table
-            dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
+        # once a goal has been written the motor is heading there, so measure from the goal and skip the read
+        if self.controlTable.cached('goal_position') is not None:
+            dxl_present_position = self.dxl_goal_position
         else:
-            dxl_present_position, dxl_comm_result, dxl_error = self.packetHandler.read4ByteTxRx(self.portHandler, DXL_ID, ADDR_PRESENT_POSITION)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+            dxl_present_position = self.read_Position()
 
-        prev_angle = int(float(dxl_present_position % DXL_MAXIMUM_POSITION_VALUE) / float(DXL_MAXIMUM_POSITION_VALUE) * FULL_REVOLUTION) 
+        return self.rotate_Degrees(self.__displacement_To(angle, dxl_present_position))
+
+    def __displacement_To(self, angle, dxl_present_position):
+        # shortest way round from the present position to angle, in whole degrees
+        prev_angle = int(self.model.ticks_To_Angle(dxl_present_position % self.model.max_position))
         displacement = (angle-prev_angle)
 
         if displacement < 0 and (displacement%FULL_REVOLUTION) < -1 * displacement:
             displacement = (displacement%FULL_REVOLUTION)
         elif FULL_REVOLUTION - displacement < displacement:
             displacement = -1 * (FULL_REVOLUTION - displacement)
-    
-        self.rotate_Degrees(int(displacement))
+
+        return int(displacement)
+
+    def attach_Async(self, loop=None):
+        # moves the port onto an asyncio transport (dyna_async) on the ARENA event loop; use the *_Async
+        # methods from then on, blocking ones report the port busy until detach_Async
+        self.stop_Motion_Poller()
+        return self.driver.attach_Async(loop)
+
+    def detach_Async(self):
+        if self.async_motion is not None:
+            self.async_motion.cancel()
+            self.async_motion = None
+        self.driver.detach_Async()
+
+    async def read_Position_Async(self):
+        position, dxl_comm_result = await self.driver.read_Position_Async(self.dxl_id)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None
+        if self.recorder is not None:
+            self.recorder.record(KIND_PRESENT, (position,), self.dxl_id, self.record_slot)
+        return position
+
+    async def read_State_Async(self):
+        if self.state_block is None:
+            return None
+        state, dxl_comm_result = await self.driver.read_Block_Async(self.state_block, self.dxl_id)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            return None
+        if self.recorder is not None and 'present_position' in self.state_block.fields:
+            self.recorder.record(KIND_PRESENT, (state.present_position,), self.dxl_id, self.record_slot)
+        return state
+
+    async def __read_Position_Moving_Async(self):
+        block = self.state_block
+        if block is not None and 'present_position' in block.fields and 'moving' in block.fields:
+            state = await self.read_State_Async()
+            if state is None:
+                return None, None
+            return state.present_position, state.moving
+        return await self.read_Position_Async(), None
+
+    async def rotate_Degrees_Async(self, degrees):
+        # awaits the settled position; a newer motion cancels this one (CancelledError), like rotate_Degrees' future
+        self.dxl_goal_position = self.dxl_goal_position + self.model.angle_To_Ticks(degrees)
+        return await self.__rotate_Motor_Async()
+
+    async def rotate_To_Angle_Async(self, angle):
+        if self.controlTable.cached('goal_position') is not None:
+            dxl_present_position = self.dxl_goal_position
+        else:
+            dxl_present_position = await self.read_Position_Async()
+            if dxl_present_position is None:
+                return None
+        return await self.rotate_Degrees_Async(self.__displacement_To(angle, dxl_present_position))
+
+    async def __rotate_Motor_Async(self):
+        goal_position = self.dxl_goal_position
+        dxl_comm_result, dxl_error = await self.driver.write_Goal_Async(self.dxl_id, goal_position)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+        elif dxl_error != 0:
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        if self.recorder is not None:
+            self.recorder.record(KIND_GOAL, (goal_position,), self.dxl_id, self.record_slot)
+
+        if self.async_motion is not None:
+            self.async_motion.cancel()
+        motion = self.async_motion = asyncio.ensure_future(self.__settle_Async(goal_position))
+        return await motion
+
+    async def __settle_Async(self, goal_position):
+        # __poll_Motion for the event loop: the same threshold / Moving flag rules, reads through the transport
+        stopped_polls = 0
+        while True:
+            await asyncio.sleep(MOTION_POLL_INTERVAL)
+            dxl_present_position, dxl_moving = await self.__read_Position_Moving_Async()
+            if dxl_present_position is None:
+                continue
+            if not abs(goal_position - dxl_present_position) > DXL_MOVING_STATUS_THRESHOLD:
+                break
+            if dxl_moving is None:
+                dxl_moving = await self.driver.read_Moving_Async(self.dxl_id)
+            stopped_polls = stopped_polls + 1 if dxl_moving == 0 else 0
+            if stopped_polls >= MOTION_STOPPED_POLLS:
+                break
+        if self.async_motion is asyncio.current_task():
+            self.async_motion = None
+        return dxl_present_position
         
     
 
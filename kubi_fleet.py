@@ -0,0 +1,135 @@
+# Drives any number of Kubi stands, each on its own serial port with its own Servo_Controller thread,
+# so one slow port never holds up the others.
+#
+# config maps a port to the ARENA scene and user slot the stand serves:
+#     {
+#         '/dev/ttyUSB0': {'scene': 'first_playground', 'slot': 0},
+#         '/dev/ttyUSB1': {'scene': 'first_playground', 'slot': 1},
+#         'sim://kubi':   {'scene': 'test_scene', 'slot': 0},
+#     }
+# 'scene' defaults to None (any scene), 'slot' to the stand's position in the config. 'profile' is a
+# control_table.PROFILES name (or a field -> value dict) applied to both motors at connect.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from kubi_wrapper import Dynamixel_Servo
+from dyna_driver import Connection_Error
+from servo_controller import Servo_Controller, CONTROL_RATE_HZ
+from tick_profiler import Tick_Profiler
+from trajectory import Pan_Tilt_Trajectory
+from control_table import PROFILES
+from pose_predictor import make_Predictor
+
+
+class Stand:
+    def __init__(self, port, scene, slot, telemetry=None, profile=None, recorder=None, startup=None):
+        self.port = port
+        self.scene = scene
+        self.slot = slot
+        self.recorder = recorder
+        self.servo = Dynamixel_Servo(port, telemetry=telemetry, profile=profile, recorder=recorder, record_slot=slot, startup=startup)
+        self.controller = None
+
+    def connect(self, rate_hz, use_trajectory, predictor=None, measure_interval=None, supervise=False, profile_ticks=False):
+        # a missing stand must not end the others: supervised, its controller keeps reconnecting it, otherwise it
+        # is left out (controller None)
+        lost = None
+        try:
+            self.servo.connect_Dynamixel(exit_on_failure=False)
+            self.servo.init_Dynamixel(exit_on_failure=False)
+        except (Connection_Error, OSError) as error:
+            if not supervise:
+                print("%s: stand not connected (%s), left out" % (self.port, error))
+                return
+            print("%s: stand not connected (%s), reconnecting in the background" % (self.port, error))
+            lost = str(error)
+        trajectory = Pan_Tilt_Trajectory(*self.servo.pos) if use_trajectory else None
+        self.controller = Servo_Controller(self.servo, rate_hz=rate_hz, trajectory=trajectory,
+                                           predictor=make_Predictor(predictor) if predictor else None,
+                                           recorder=self.recorder, record_slot=self.slot, measure_interval=measure_interval,
+                                           supervise=supervise,
+                                           profiler=Tick_Profiler(1.0 / rate_hz, name=self.port, sample=True) if profile_ticks else None,
+                                           lost=lost)
+
+
+class Kubi_Fleet:
+    def __init__(self, config, rate_hz=CONTROL_RATE_HZ, use_trajectory=True, telemetry=None, predictor=None, recorder=None,
+                 measure_interval=None, supervise=False, startup=None, profile_ticks=False):
+        # one Bus_Telemetry shared by every stand, the port is part of each metric's labels
+        self.telemetry = telemetry
+        self.rate_hz = rate_hz
+        self.use_trajectory = use_trajectory
+        self.predictor = predictor                      # pose_predictor.PREDICTORS name, one instance per stand
+        self.recorder = recorder                        # recorder.Recorder shared by every stand, records carry the slot
+        self.measure_interval = measure_interval        # s between present pose reads on each controller, None = off
+        self.supervise = supervise                      # controllers reconnect their stand after a fault
+        self.profile_ticks = profile_ticks              # every controller gets a sampling tick_profiler.Tick_Profiler
+        self.stands = []
+        for index, (port, options) in enumerate(config.items()):
+            options = options or {}
+            profile = options.get('profile')
+            if isinstance(profile, str):
+                profile = PROFILES[profile]
+            self.stands.append(Stand(port, options.get('scene'), options.get('slot', index), telemetry, profile, recorder, startup))
+
+        self.by_slot = {}
+        for stand in self.stands:
+            if (stand.scene, stand.slot) in self.by_slot:
+                raise ValueError("two stands configured for scene %r slot %r" % (stand.scene, stand.slot))
+            self.by_slot[(stand.scene, stand.slot)] = stand
+
+    def connect_All(self):
+        # every port is opened and initialised in parallel, startup takes as long as the slowest stand
+        with ThreadPoolExecutor(max_workers=len(self.stands) or 1) as pool:
+            futures = [pool.submit(stand.connect, self.rate_hz, self.use_trajectory, self.predictor, self.measure_interval, self.supervise,
+                                   self.profile_ticks) for stand in self.stands]
+            for future in futures:
+                future.result()
+
+    def start(self):
+        for stand in self.stands:
+            if stand.controller is not None:
+                stand.controller.start()
+
+    def stop(self):
+        for stand in self.stands:
+            if stand.controller is not None:
+                stand.controller.stop()
+
+    def stand_For(self, slot, scene=None):
+        stand = self.by_slot.get((scene, slot))
+        if stand is None and scene is not None:
+            stand = self.by_slot.get((None, slot))
+        return stand
+
+    def stands_In_Scene(self, scene):
+        return [stand for stand in self.stands if stand.scene in (None, scene)]
+
+    def set_Target(self, slot, pan, tilt, scene=None, source=None):
+        # source: id of the user the stand follows, see Servo_Controller.set_Target
+        stand = self.stand_For(slot, scene)
+        if stand is not None and stand.controller is not None:
+            stand.controller.set_Target(pan, tilt, source)
+
+    def clear_Target(self, slot, scene=None):
+        stand = self.stand_For(slot, scene)
+        if stand is not None and stand.controller is not None:
+            stand.controller.clear_Target()
+
+    def measured_Poses(self):
+        # {(scene, slot): (pan, tilt, time)} of the latest measured pose of every stand, see measure_interval
+        poses = {}
+        for stand in self.stands:
+            if stand.controller is not None:
+                pose = stand.controller.measured.get()[1]
+                if pose is not None:
+                    poses[(stand.scene, stand.slot)] = pose
+        return poses
+
+    def get_Stats(self):
+        return dict((stand.port, stand.controller.get_Stats()) for stand in self.stands if stand.controller is not None)
+
+    def profile_Report(self):
+        # the tick profiler report of every stand, see profile_ticks
+        return "\n".join(stand.controller.profiler.report() for stand in self.stands
+                         if stand.controller is not None and stand.controller.profiler is not None)
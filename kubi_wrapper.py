@@ -37,9 +37,10 @@ if os.name == 'nt':
         return msvcrt.getch().decode()
 else:
     import sys, tty, termios
-    fd = sys.stdin.fileno()
-    old_settings = termios.tcgetattr(fd)
     def getch():
+        # terminal settings are read here rather than at import, so the wrapper also loads without a tty
+        fd = sys.stdin.fileno()
+        old_settings = termios.tcgetattr(fd)
         try:
             tty.setraw(sys.stdin.fileno())
             ch = sys.stdin.read(1)
@@ -48,14 +49,24 @@ else:
         return ch
 
 from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from dyna_driver import Dynamixel_Driver, Connection_Error
+from control_table import apply_Profile
+from recorder import KIND_GOAL, KIND_PRESENT
+from startup import startup_Phase
 
 # Control table address
 ADDR_TORQUE_ENABLE      = 24               # Control table address is different in Dynamixel model
 ADDR_GOAL_POSITION      = 30
+ADDR_MOVING_SPEED       = 32
 ADDR_PRESENT_POSITION   = 36
 
-# Protocol version
-PROTOCOL_VERSION            = 1.0               # See which protocol version is used in the Dynamixel
+# Data Byte Length
+LEN_GOAL_POSITION       = 2
+LEN_MOVING_SPEED        = 2
+SYNC_WRITE_FORMATS      = {1: '<H', 2: '<HH'}   # Goal Position, or Goal Position + Moving Speed, per motor
+
+# Servo model, protocol 1.0 AX-12A (dyna_driver.MODELS)
+MY_DXL                      = 'AX'
 
 # Default setting
 DXL_PAN_ID                  = 1                 # Dynamixel ID : 1
@@ -79,80 +90,172 @@ PAN_LOWER_BOUND             = 20
 TILT_UPPER_BOUND            = 660
 TILT_LOWER_BOUND            = 390
 
+MOVING_SPEED_UNIT_RPM       = 0.111             # rpm per Moving Speed unit
+TICKS_PER_REVOLUTION        = 1024 * 360 / 300.0    # the AX-12A resolves 300 degrees into 1024 ticks
+MIN_MOVING_SPEED            = 1                 # 0 means "no speed limit" in joint mode, never send it
+MAX_MOVING_SPEED            = 1023
+DEFAULT_MOVE_VELOCITY       = 600.0             # ticks / s used by move_Pan_Tilt
+
+GOAL_DEADBAND_TICKS         = 2                 # goal writes within this many ticks of the last acknowledged goal are skipped
+WRITE_INTERVAL              = 0.0               # s, goal updates arriving faster than this are merged into the latest one (0 = off)
+
 JUMP_THRESHOLD              = 50
 INIT_POS                    = 525
 
+class Write_Filter:
+    # remembers the last value each register acknowledged, so unchanged or dead-band sized writes can be dropped
+    def __init__(self, deadband=GOAL_DEADBAND_TICKS):
+        self.deadband = deadband
+        self.last = {}
+        self.written = 0
+        self.suppressed = 0
+
+    def changed(self, key, value, deadband=0):
+        last = self.last.get(key)
+        return last is None or abs(value - last) > deadband
+
+    def acknowledge(self, key, value):
+        self.last[key] = value
+        self.written += 1
+
+    def invalidate(self):
+        # forget everything, e.g. after a reconnect when the servo state is unknown
+        self.last.clear()
+
+
 class Dynamixel_Servo:
-    def __init__(self, port):
+    def __init__(self, port, telemetry=None, baudrate=BAUDRATE, discover=False, upgrade_baud=False, profile=None,
+                 recorder=None, record_slot=0, startup=None):
         self.port = port
-        self.portHandler = PortHandler(port)
-        self.packetHandler = PacketHandler(PROTOCOL_VERSION)
+        self.baudrate = baudrate
+        self.discover = discover                        # scan baud rates at init instead of trusting the above
+        self.upgrade_baud = upgrade_baud                # then move the bus to the fastest rate it supports
+        # Bus_Reader, control table mirrors and prebuilt goal / Sync Write packets for both motors (dyna_driver)
+        self.driver = Dynamixel_Driver(port, MY_DXL, [DXL_PAN_ID, DXL_TILT_ID], telemetry)
+        self.portHandler = self.driver.portHandler
+        self.packetHandler = self.driver.packetHandler
+        self.controlTables = self.driver.controlTables
+        self.profile = profile                          # control_table.PROFILES entry applied at init
+        self.recorder = recorder                        # recorder.Recorder for goals and present positions
+        self.record_slot = record_slot
+        self.startup = startup                          # startup.Startup_Timer timing the connect / init phases
         self.dxl_goal_position_pan = APPROX_CENTER_POS
         self.dxl_goal_position_tilt = APPROX_CENTER_POS
         self.pos = [INIT_POS, INIT_POS]
+
+        self.writeFilter = Write_Filter()
+        self.write_interval = WRITE_INTERVAL
+        self.last_write_time = 0.0
+        self.staged = None
     
-    def connect_Dynamixel(self):
-        if self.portHandler.openPort():
+    def connect_Dynamixel(self, exit_on_failure=True):
+        # exit_on_failure=False raises dyna_driver.Connection_Error instead of waiting for a key and quitting
+        with startup_Phase(self.startup, self.port + " open"):
+            opened = self.portHandler.openPort()
+        if opened:
             print("Succeeded to open the port")
         else:
             print("Failed to open the port")
+            if not exit_on_failure:
+                raise Connection_Error("Failed to open %s" % self.port)
             print("Press any key to terminate...")
             getch()
             quit()
 
-    def init_Dynamixel(self):
+    def discover_Dynamixel(self):
+        # find the rate the pan and tilt motors answer on
+        baudrate = self.driver.discover(self.upgrade_baud)
+        if baudrate is None:
+            return False
+        self.baudrate = baudrate
+        return True
+
+    def init_Dynamixel(self, exit_on_failure=True, discover=None):
+        # discover: override self.discover, a reconnect already knows the rate
+        if self.discover if discover is None else discover:
+            with startup_Phase(self.startup, self.port + " discover"):
+                self.discover_Dynamixel()
+
         # Set port baudrate
-        if self.portHandler.setBaudRate(BAUDRATE):
+        with startup_Phase(self.startup, self.port + " baud"):
+            baud_set = self.portHandler.setBaudRate(self.baudrate)
+        if baud_set:
             print("Succeeded to change the baudrate")
         else:
             print("Failed to change the baudrate")
+            if not exit_on_failure:
+                raise Connection_Error("Failed to set %s to %d baud" % (self.port, self.baudrate))
             print("Press any key to terminate...")
             getch()
             quit()
 
-        # Enable Dynamixel Torque
-        dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, DXL_PAN_ID, ADDR_TORQUE_ENABLE, TORQUE_ENABLE)
+        # the motors may have been power cycled since they were last seen. the profile only writes what differs
+        with startup_Phase(self.startup, self.port + " profile"):
+            for controlTable in self.controlTables.values():
+                controlTable.invalidate()
+                if self.profile:
+                    written = apply_Profile(controlTable, self.profile)
+                    if written:
+                        print("Dynamixel %d profile applied: %s" % (controlTable.dxl_id, ", ".join(written)))
+
+        # Enable Dynamixel Torque on both motors in one Sync Write, no status replies to wait for.
+        # the position read below tells whether they answer
+        with startup_Phase(self.startup, self.port + " torque"):
+            dxl_comm_result = self.driver.sync_Write(ADDR_TORQUE_ENABLE, '<B', [(DXL_PAN_ID, (TORQUE_ENABLE,)), (DXL_TILT_ID, (TORQUE_ENABLE,))])
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+         
+        # set intial position
+        with startup_Phase(self.startup, self.port + " position"):
+            dxl_present_position_pan, dxl_present_position_tilt = self.read_Pan_Tilt()
+        if self.driver.failures:
+            if not exit_on_failure:
+                raise Connection_Error("Dynamixel on %s did not answer" % self.port)
         else:
             print("Dynamixel Pan has been successfully connected")
-        
-        dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, DXL_TILT_ID, ADDR_TORQUE_ENABLE, TORQUE_ENABLE)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        else:
             print("Dynamixel Tilt has been successfully connected")
-        
-         
-        # set intial position
-        dxl_present_position_pan, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, DXL_PAN_ID, ADDR_PRESENT_POSITION)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        
+
         self.dxl_goal_position_pan = dxl_present_position_pan
         self.pos[0] = dxl_present_position_pan
 
-        dxl_present_position_tilt, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, DXL_TILT_ID, ADDR_PRESENT_POSITION)
-        if dxl_comm_result != COMM_SUCCESS:
-            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
-        elif dxl_error != 0:
-            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
-        
         self.dxl_goal_position_tilt = dxl_present_position_tilt
         self.pos[1] = dxl_present_position_tilt
+        self.writeFilter.invalidate()
        
         print("Dynamixel Intialized")
         #print(self.dxl_goal_position)
 
 
+    def reconnect_Dynamixel(self):
+        # reopens the port and reinitialises after a fault (pulled adapter, servo power loss), without quitting.
+        # returns False while the bus is still gone; dyna_driver.reconnect_With_Backoff retries it
+        try:
+            if not self.driver.reopen():
+                return False
+            self.init_Dynamixel(exit_on_failure=False, discover=False)
+        except (Connection_Error, OSError) as error:
+            print("Reconnect of %s failed: %s" % (self.port, error))
+            return False
+        return True
 
-    def __rotate_Motor(self, id):
+
+
+    def read_Pan_Tilt(self):
+        # present position of both motors in one Bulk Read
+        state, dxl_comm_result = self.driver.read_State()
+        if self.recorder is not None:
+            self.recorder.record(KIND_PRESENT, (state[0, 0], state[1, 0]), slot=self.record_slot)
+        return int(state[0, 0]), int(state[1, 0])
+
+
+    def read_Pan_Tilt_Angles(self):
+        # measured pose in the angles pan_To_Angle / tilt_To_Angle take
+        dxl_present_position_pan, dxl_present_position_tilt = self.read_Pan_Tilt()
+        return position_To_Angle(dxl_present_position_pan), position_To_Angle(dxl_present_position_tilt)
+
+
+    def __step_Motor(self, id):
+        # advance the tracked position one increment towards the goal and return the position to write
         jmp_incr = 2
         
         if id == DXL_PAN_ID :
@@ -162,48 +265,242 @@ class Dynamixel_Servo:
             curr_pos = self.pos[1]
             displacement = self.dxl_goal_position_tilt - curr_pos
 
-        if displacement < 0:
+        if abs(displacement) <= self.writeFilter.deadband:
+            # close enough, hold instead of dithering ±2 around the goal
+            jmp_incr = 0
+        elif displacement < 0:
             jmp_incr = -2
         else:
             jmp_incr = 2
 
-        dxl_comm_result, dxl_error = self.packetHandler.write2ByteTxRx(self.portHandler, id, ADDR_GOAL_POSITION, curr_pos % 1023)
+        write_pos = curr_pos % 1023
+        curr_pos += jmp_incr 
+
+        if id == DXL_PAN_ID :
+            self.pos[0] = curr_pos % 1023
+        else:
+            self.pos[1] = curr_pos % 1023
+
+        return write_pos
+
+
+    def __rotate_Motor(self, id):
+        write_pos = self.__step_Motor(id)
+        if not self.writeFilter.changed((id, ADDR_GOAL_POSITION), write_pos):
+            self.writeFilter.suppressed += 1
+            return
+
+        dxl_comm_result, dxl_error = self.driver.write_Goal(id, write_pos)
 
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
         elif dxl_error != 0:
             print("in rotate motor %s" % self.packetHandler.getRxPacketError(dxl_error))
-      
-        curr_pos += jmp_incr 
+        else:
+            self.writeFilter.acknowledge((id, ADDR_GOAL_POSITION), write_pos)
 
-        if id == DXL_PAN_ID :
-            self.pos[0] = curr_pos % 1023
+
+    async def __rotate_Motor_Async(self, id):
+        write_pos = self.__step_Motor(id)
+        if not self.writeFilter.changed((id, ADDR_GOAL_POSITION), write_pos):
+            self.writeFilter.suppressed += 1
+            return
+
+        dxl_comm_result, dxl_error = await self.driver.write_Goal_Async(id, write_pos)
+
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+        elif dxl_error != 0:
+            print("in rotate motor %s" % self.packetHandler.getRxPacketError(dxl_error))
         else:
-            self.pos[1] = curr_pos % 1023
+            self.writeFilter.acknowledge((id, ADDR_GOAL_POSITION), write_pos)
+
+
+    def __sync_Write(self, entries, goal_deadband, label):
+        # entries: [(id, [register values])], 2 byte registers starting at Goal Position.
+        # Motors whose values are all unchanged (goal within goal_deadband) are left out of the packet.
+        written = []
+        for dxl_id, values in entries:
+            changed = False
+            for i, value in enumerate(values):
+                deadband = goal_deadband if i == 0 else 0
+                if self.writeFilter.changed((dxl_id, ADDR_GOAL_POSITION + 2 * i), value, deadband):
+                    changed = True
+            if not changed:
+                self.writeFilter.suppressed += 1
+                continue
+            written.append((dxl_id, values))
+
+        if not written:
+            return
+
+        # the driver keeps one prebuilt packet per motor set and register layout
+        dxl_comm_result = self.driver.sync_Write(ADDR_GOAL_POSITION, SYNC_WRITE_FORMATS[len(written[0][1])], written)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s %s" % (label, self.packetHandler.getTxRxResult(dxl_comm_result)))
+            return
+        # Sync Write has no status packet, a clean transmit is as acknowledged as it gets
+        for dxl_id, values in written:
+            for i, value in enumerate(values):
+                self.writeFilter.acknowledge((dxl_id, ADDR_GOAL_POSITION + 2 * i), value)
+
+
+    def __coalesce(self, method, args):
+        # True when the update arrived within write_interval of the last one and was staged instead;
+        # a later update, flush_Due() or flush_Pending() sends only the newest staged one
+        if not self.write_interval:
+            return False
+        now = time.monotonic()
+        if now - self.last_write_time < self.write_interval:
+            self.staged = (method, args)
+            return True
+        self.staged = None
+        self.last_write_time = now
+        return False
+
+
+    def flush_Pending(self):
+        if self.staged is not None:
+            method, args = self.staged
+            self.staged = None
+            self.last_write_time = 0.0
+            method(*args)
+
+
+    def flush_Due(self):
+        # sends the staged update once write_interval has passed since the last write. the Servo_Controller
+        # calls it every tick, so the last update of a burst goes out even when no further update follows
+        if self.staged is not None and time.monotonic() - self.last_write_time >= self.write_interval:
+            self.flush_Pending()
 
 
     def pan_To_Angle(self, angle):
-        angle += HALF_REVOLUTION
-        self.dxl_goal_position_pan = (int(float(angle) * float(DXL_MAXIMUM_POSITION_VALUE) / float(FULL_REVOLUTION))) % DXL_MAXIMUM_POSITION_VALUE
-          
-        if PAN_UPPER_BOUND < self.dxl_goal_position_pan:
-            self.dxl_goal_position_pan = PAN_UPPER_BOUND
-        elif PAN_LOWER_BOUND > self.dxl_goal_position_pan:
-            self.dxl_goal_position_pan = PAN_LOWER_BOUND
+        self.dxl_goal_position_pan = pan_Angle_To_Position(angle)
        # print(self.dxl_goal_position_pan)
         self.__rotate_Motor(DXL_PAN_ID) 
     
 
     def tilt_To_Angle(self, angle):
-        angle += HALF_REVOLUTION
-        self.dxl_goal_position_tilt = (int(float(angle) * float(DXL_MAXIMUM_POSITION_VALUE) / float(FULL_REVOLUTION))) % DXL_MAXIMUM_POSITION_VALUE
-
-        if TILT_UPPER_BOUND < self.dxl_goal_position_tilt:
-            self.dxl_goal_position_tilt = TILT_UPPER_BOUND
-        elif TILT_LOWER_BOUND > self.dxl_goal_position_tilt:
-            self.dxl_goal_position_tilt = TILT_LOWER_BOUND
+        self.dxl_goal_position_tilt = tilt_Angle_To_Position(angle)
                 
         #print(self.dxl_goal_position_tilt)
         self.__rotate_Motor(DXL_TILT_ID) 
-        
-        
+
+
+    def attach_Async(self, loop=None):
+        # moves the port onto an asyncio transport (dyna_async) on the ARENA event loop; use the *_Async
+        # methods from then on, blocking ones report the port busy until detach_Async
+        return self.driver.attach_Async(loop)
+
+
+    def detach_Async(self):
+        self.driver.detach_Async()
+
+
+    async def pan_To_Angle_Async(self, angle):
+        self.dxl_goal_position_pan = pan_Angle_To_Position(angle)
+        await self.__rotate_Motor_Async(DXL_PAN_ID)
+
+
+    async def tilt_To_Angle_Async(self, angle):
+        self.dxl_goal_position_tilt = tilt_Angle_To_Position(angle)
+        await self.__rotate_Motor_Async(DXL_TILT_ID)
+
+
+    def set_Pan_Tilt(self, pan, tilt):
+        # Same as pan_To_Angle + tilt_To_Angle, but both goals go out in one Sync Write packet.
+        # Sync Write is broadcast, so the motors send no status packet and there is nothing to wait on.
+        if self.__coalesce(self.set_Pan_Tilt, (pan, tilt)):
+            return
+        self.dxl_goal_position_pan = pan_Angle_To_Position(pan)
+        self.dxl_goal_position_tilt = tilt_Angle_To_Position(tilt)
+
+        pan_pos = self.__step_Motor(DXL_PAN_ID)
+        tilt_pos = self.__step_Motor(DXL_TILT_ID)
+        if self.recorder is not None:
+            self.recorder.record(KIND_GOAL, (pan_pos, 0, tilt_pos, 0), slot=self.record_slot)
+
+        # steps are exact, the dead-band already stopped __step_Motor from dithering at the goal
+        self.__sync_Write([(DXL_PAN_ID, [pan_pos]), (DXL_TILT_ID, [tilt_pos])], 0, "in set pan tilt")
+
+
+    def set_Goal_Speed(self, pan_goal, pan_speed, tilt_goal, tilt_speed):
+        # goals in position ticks, speeds in Moving Speed units; the motors interpolate to the goal themselves
+        if self.__coalesce(self.set_Goal_Speed, (pan_goal, pan_speed, tilt_goal, tilt_speed)):
+            return
+        self.dxl_goal_position_pan = pan_goal
+        self.dxl_goal_position_tilt = tilt_goal
+        self.pos[0] = pan_goal
+        self.pos[1] = tilt_goal
+        if self.recorder is not None:
+            self.recorder.record(KIND_GOAL, (pan_goal, pan_speed, tilt_goal, tilt_speed), slot=self.record_slot)
+
+        # Goal Position and Moving Speed are adjacent, so one Sync Write carries both
+        self.__sync_Write([(DXL_PAN_ID, [pan_goal, pan_speed]), (DXL_TILT_ID, [tilt_goal, tilt_speed])],
+            self.writeFilter.deadband, "in set goal speed")
+
+
+    def set_Goal(self, pan_goal, tilt_goal):
+        # goals in position ticks, Moving Speed left as it is (set_Pan_Tilt's write, recorded with speed 0)
+        if self.__coalesce(self.set_Goal, (pan_goal, tilt_goal)):
+            return
+        self.dxl_goal_position_pan = pan_goal
+        self.dxl_goal_position_tilt = tilt_goal
+        self.pos[0] = pan_goal
+        self.pos[1] = tilt_goal
+        if self.recorder is not None:
+            self.recorder.record(KIND_GOAL, (pan_goal, 0, tilt_goal, 0), slot=self.record_slot)
+
+        self.__sync_Write([(DXL_PAN_ID, [pan_goal]), (DXL_TILT_ID, [tilt_goal])], 0, "in set goal")
+
+
+    def move_Pan_Tilt(self, pan, tilt, velocity=DEFAULT_MOVE_VELOCITY):
+        # one command for a whole reorientation, speeds scaled so both axes arrive together
+        pan_goal = pan_Angle_To_Position(pan)
+        tilt_goal = tilt_Angle_To_Position(tilt)
+        pan_dist = abs(pan_goal - self.pos[0])
+        tilt_dist = abs(tilt_goal - self.pos[1])
+        longest = max(pan_dist, tilt_dist, 1)
+
+        self.set_Goal_Speed(pan_goal, velocity_To_Moving_Speed(velocity * pan_dist / longest),
+            tilt_goal, velocity_To_Moving_Speed(velocity * tilt_dist / longest))
+
+
+def velocity_To_Moving_Speed(velocity):
+    # velocity in position ticks / s. the servo's real resolution, not the DXL_MAXIMUM_POSITION_VALUE per turn
+    # scale of angle_To_Position, which would command every speed about 20% too fast
+    rpm = abs(velocity) * 60.0 / TICKS_PER_REVOLUTION
+    speed = int(round(rpm / MOVING_SPEED_UNIT_RPM))
+    if speed < MIN_MOVING_SPEED:
+        return MIN_MOVING_SPEED
+    elif speed > MAX_MOVING_SPEED:
+        return MAX_MOVING_SPEED
+    return speed
+
+
+def angle_To_Position(angle):
+    angle += HALF_REVOLUTION
+    return (int(float(angle) * float(DXL_MAXIMUM_POSITION_VALUE) / float(FULL_REVOLUTION))) % DXL_MAXIMUM_POSITION_VALUE
+
+
+def position_To_Angle(position):
+    # inverse of angle_To_Position
+    return float(position) * FULL_REVOLUTION / DXL_MAXIMUM_POSITION_VALUE - HALF_REVOLUTION
+
+
+def pan_Angle_To_Position(angle):
+    position = angle_To_Position(angle)
+    if PAN_UPPER_BOUND < position:
+        position = PAN_UPPER_BOUND
+    elif PAN_LOWER_BOUND > position:
+        position = PAN_LOWER_BOUND
+    return position
+
+
+def tilt_Angle_To_Position(angle):
+    position = angle_To_Position(angle)
+    if TILT_UPPER_BOUND < position:
+        position = TILT_UPPER_BOUND
+    elif TILT_LOWER_BOUND > position:
+        position = TILT_LOWER_BOUND
+    return position
@@ -1,25 +1,61 @@
+from startup import Startup_Timer, preload, run_In_Background
+startup = Startup_Timer()
+# arena and its MQTT stack load on another thread while the stand initialises
+arena_loaded = preload('arena', startup=startup)
+
 from kubi_wrapper import *
-from arena import *
+from dyna_driver import Connection_Error
+from servo_controller import Servo_Controller, CONTROL_RATE_HZ
+from trajectory import Pan_Tilt_Trajectory
+from quat_euler import Euler_Converter
+from pose_predictor import Alpha_Beta_Predictor
+from recorder import Recorder
+from tick_profiler import Tick_Profiler
+from user_registry import User_Registry
 import random
-import scipy
-import math
+import os
+
+
+RECORD_PATH = None                # e.g. 'motor_cam_sync.npy' to record poses, targets and goals (recorder.py)
+recorder = Recorder(RECORD_PATH) if RECORD_PATH else None
 
+SERVO_PORT = os.environ.get('KUBI_PORT', '/dev/tty.usbserial-FT6RW6MQ')   # or a sim:// URL (dyna_sim.py), arena_bench.py sets it
 
-my_motor = Dynamixel_Servo('/dev/tty.usbserial-FT6RW6MQ')
+my_motor = Dynamixel_Servo(SERVO_PORT, recorder=recorder, startup=startup)
 
-my_motor.connect_Dynamixel()
-my_motor.init_Dynamixel()
+def start_Stand():
+    # returns None, or why the stand is not there; the supervised controller then keeps reconnecting it
+    try:
+        my_motor.connect_Dynamixel(exit_on_failure=False)
+        my_motor.init_Dynamixel(exit_on_failure=False)
+    except (Connection_Error, OSError) as error:
+        print("%s: stand not connected (%s), reconnecting in the background" % (SERVO_PORT, error))
+        return str(error)
+    return None
+
+# the serial init runs alongside the arena import and the MQTT connect below
+stand_ready = run_In_Background(start_Stand)
+
+arena_loaded.result()
+from arena import *
 
 ''' Camera-Dynamixel Sync
 '''
 MIN_DISPLACEMENT = 0.5
 LINE_TTL = 5
 HALF_REVOLUTION = 180
+POSE_SAMPLE_INTERVAL_MS = 75    # was every 15th tick of the old 5 ms motor loop
+EVENT_DRIVEN = True             # recompute the target from camera pose messages instead of sampling
+HOUSEKEEPING_INTERVAL_MS = 1000 # event driven mode still expires stale users on a slow timer
+PROFILE_TICKS = False           # time the control ticks and target updates by phase, snapshot overruns (tick_profiler.py)
+PROFILE_REPORT_INTERVAL_MS = 10000
+TARGET_BUDGET_MS = 5            # a target update should fit in the old motor tick
 
 class CameraState(Object):
     def __init__(self, camera):
         self.camera = camera
         self.prev_pos = None
+        self.last_pose = None
         self.line_color = Color(
                 random.randint(0,255),
                 random.randint(0,255),
@@ -49,53 +85,134 @@ class CameraState(Object):
         else:
             return 0
 
-cam_states = []
+    def pose_Changed(self):
+        # True when position or rotation differ from the last call
+        pos = self.curr_pos
+        rot = self.curr_rot
+        pose = (pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w)
+        if pose == self.last_pose:
+            return False
+        self.last_pose = pose
+        return True
 
-def user_join_callback(scene, cam, msg):
-    global cam_states
+# users currently in the scene, indexed on a grid so the video_ball query only visits nearby cells
+user_registry = User_Registry()
 
+def user_join_callback(scene, cam, msg):
     cam_state = CameraState(cam)
-    cam_states += [cam_state]
-
-scene = Scene(host="mqtt.arenaxr.org", scene="first_playground")
+    user_registry.add(cam_state.id, cam_state, cam_state.curr_pos.x, cam_state.curr_pos.z)
+
+def user_left_callback(scene, cam, msg):
+    user_registry.remove(cam.object_id)
+
+def delete_obj_callback(scene, obj, msg):
+    user_registry.remove(obj.object_id)
+
+def on_msg_callback(scene, obj, msg):
+    # every camera pose update moves the user in the grid and keeps it from expiring
+    object_id = getattr(obj, 'object_id', None)
+    if object_id == "video_ball":
+        if EVENT_DRIVEN:
+            update_Target()
+        return
+    cam_state = user_registry.get(object_id)
+    pos = obj.data.position
+    if cam_state is None:
+        if not isinstance(obj, Camera):
+            return
+        # a user expired for sitting still (USER_TTL) is tracked again from their next pose
+        cam_state = CameraState(obj)
+        user_registry.add(object_id, cam_state, pos.x, pos.z)
+    else:
+        user_registry.move(object_id, pos.x, pos.z)
+    if recorder is not None:
+        recorder.record_Pose(object_id, pos, obj.data.rotation)
+
+    # only a pose change of a user who is, or just was, in range can move the stand
+    if EVENT_DRIVEN and cam_state.pose_Changed() and (object_id in tracked_ids or user_In_Range(cam_state)):
+        update_Target()
+
+with startup.phase("scene connect"):
+    scene = Scene(host="mqtt.arenaxr.org", scene="first_playground")
 scene.user_join_callback = user_join_callback
-
-def rotation_quat2euler(quat):
-        rotq = scipy.spatial.transform.Rotation.from_quat(list(quat))
-        # do not change to xzy, weird things happen
-        return tuple(rotq.as_euler('xyz', degrees=True))
+scene.user_left_callback = user_left_callback
+scene.delete_obj_callback = delete_obj_callback
+scene.on_msg_callback = on_msg_callback
+
+# NumPy replacement for scipy's Rotation.as_euler('xyz'), do not change to xzy, weird things happen
+euler_converter = Euler_Converter()
+# the ARENA callbacks run on this thread, so that is the one the target profiler samples
+target_profiler = Tick_Profiler(TARGET_BUDGET_MS / 1000.0, name="target update", sample=True) if PROFILE_TICKS else None
+if target_profiler is not None:
+    target_profiler.attach()
 pos = 529
 
-call_index = 0
 rotation_x = 0
 rotation_y = 0
+tracked_ids = set()
+driving_id = None               # the user the stand follows, the controller resets its predictor when it changes
 
 
-@scene.run_forever(interval_ms=5)
-def cam_motor_sync():
-    global call_index
+def user_In_Range(cam_state):
+    vid_ball = scene.all_objects.get("video_ball")
+    if vid_ball is None:
+        return False
+    dx = vid_ball.data.position.x - cam_state.curr_pos.x
+    dz = vid_ball.data.position.z - cam_state.curr_pos.z
+    return dx * dx + dz * dz <= vid_ball.data.radius ** 2
+
+def update_Target():
     global rotation_x
     global rotation_y
-
-    vid_ball = scene.all_objects["video_ball"]
-    
-    call_index += 1
-    if(call_index % 15 == 0):
-        for cam_state in cam_states:
-            dx = vid_ball.data.position.x - cam_state.curr_pos.x
-            dz = vid_ball.data.position.z - cam_state.curr_pos.z
-            disp = math.sqrt(dx**2 + dz**2)
-            if vid_ball.data.radius < disp:
-                continue
-
-            # DO NOT CHANGE coordinate ordering
-            euler_cords = rotation_quat2euler((cam_state.curr_rot.y, 
-            cam_state.curr_rot.x, cam_state.curr_rot.z, cam_state.curr_rot.w))
-            
-            rotation_x = euler_cords[1]
-            rotation_y = euler_cords[0]
-                   
-    my_motor.pan_To_Angle(rotation_y)
-    my_motor.tilt_To_Angle(rotation_x)
-      
+    global tracked_ids
+    global driving_id
+
+    vid_ball = scene.all_objects.get("video_ball")
+    if vid_ball is None:
+        return
+    if target_profiler is not None:
+        target_profiler.begin_Tick()
+
+    tracked = user_registry.query_Radius(vid_ball.data.position.x, vid_ball.data.position.z, vid_ball.data.radius)
+    tracked_ids = set(cam_state.id for cam_state in tracked)
+    if target_profiler is not None:
+        target_profiler.mark("user scan")
+
+    if tracked:
+        # one vectorized conversion for every user in range, the last one drives the stand
+        euler_cords = euler_converter.convert_Cameras(tracked)[-1]
+        
+        rotation_x = float(euler_cords[1])
+        rotation_y = float(euler_cords[0])
+        driving_id = tracked[-1].id
+        if target_profiler is not None:
+            target_profiler.mark("quaternion conversion")
+
+    # the controller thread picks the new target up on its next tick
+    motor_controller.set_Target(rotation_y, rotation_x, driving_id)
+    if target_profiler is not None:
+        target_profiler.mark("set target")
+        target_profiler.end_Tick()
+
+
+@scene.run_forever(interval_ms=HOUSEKEEPING_INTERVAL_MS if EVENT_DRIVEN else POSE_SAMPLE_INTERVAL_MS)
+def cam_motor_sync():
+    if user_registry.expire() or not EVENT_DRIVEN:
+        update_Target()
+
+if PROFILE_TICKS:
+    @scene.run_forever(interval_ms=PROFILE_REPORT_INTERVAL_MS)
+    def profile_Report():
+        print(target_profiler.report())
+        print(motor_controller.profiler.report())
+
+stand_lost = stand_ready.result()
+
+# serial writes happen on the controller's own fixed rate thread, not in the ARENA loop.
+# the predictor leads the head pose by the ARENA + servo latency
+motor_controller = Servo_Controller(my_motor, trajectory=Pan_Tilt_Trajectory(*my_motor.pos), predictor=Alpha_Beta_Predictor(), recorder=recorder,
+                                    supervise=True, lost=stand_lost,
+                                    profiler=Tick_Profiler(1.0 / CONTROL_RATE_HZ, name="controller", sample=True) if PROFILE_TICKS else None)
+motor_controller.start()
+print(startup.report("tracking"))
 scene.run_tasks() # will block
@@ -0,0 +1,131 @@
+# Latency compensating prediction for head pose targets (pan, tilt in degrees).
+#
+# ARENA delivers a user's pose late (network, sampling) and the servo adds its own lag, so the stand ends up
+# behind the remote head. A predictor takes the timestamped targets as they arrive and, at any later time,
+# returns the pose extrapolated by `latency` seconds past that time. Servo_Controller runs it every tick.
+#
+# All predictors share one interface:
+#   update(t, pan, tilt)    a new measurement taken at time t (time.monotonic seconds)
+#   predict(t)              the (pan, tilt) to command at time t
+#   reset()                 forget the history, e.g. when tracking switches to another user (Servo_Controller
+#                           does this when the source id posted with the targets changes)
+#
+# When no measurement arrived for MAX_SAMPLE_AGE the user is taken to have stopped (event driven apps only
+# send changes), the velocity is dropped and the last measured pose is held.
+
+PREDICTION_LATENCY          = 0.10              # s, default lead: network + sampling + servo lag
+MAX_PREDICTION              = 0.25              # s, never extrapolate further than this
+MAX_SAMPLE_AGE              = 0.30              # s without a measurement before the pose is held
+LATENCY_SMOOTHING           = 0.1               # weight of a new observation in the measured latency
+HALF_REVOLUTION             = 180.0
+FULL_REVOLUTION             = 360.0
+
+
+def wrap_Angle(angle):
+    # into [-180, 180), so a pan crossing the seam is a small step, not a full turn
+    return (angle + HALF_REVOLUTION) % FULL_REVOLUTION - HALF_REVOLUTION
+
+
+class Passthrough_Predictor:
+    # no prediction, the stand chases the raw pose (the old behaviour)
+    def __init__(self, latency=PREDICTION_LATENCY):
+        self.latency = latency
+        self.pose = None
+
+    def reset(self):
+        self.pose = None
+
+    def observe_Latency(self, latency):
+        self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def update(self, t, pan, tilt):
+        self.pose = (pan, tilt)
+
+    def predict(self, t):
+        return self.pose
+
+
+class Constant_Velocity_Predictor(Passthrough_Predictor):
+    # velocity from the last two measurements, no smoothing
+    def __init__(self, latency=PREDICTION_LATENCY):
+        Passthrough_Predictor.__init__(self, latency)
+        self.t = None
+        self.pan_velocity = 0.0
+        self.tilt_velocity = 0.0
+
+    def reset(self):
+        Passthrough_Predictor.reset(self)
+        self.t = None
+        self.pan_velocity = 0.0
+        self.tilt_velocity = 0.0
+
+    def update(self, t, pan, tilt):
+        if self.pose is not None and t > self.t:
+            dt = t - self.t
+            self.pan_velocity = wrap_Angle(pan - self.pose[0]) / dt
+            self.tilt_velocity = (tilt - self.pose[1]) / dt
+        self.t = t
+        self.pose = (pan, tilt)
+
+    def predict(self, t):
+        if self.pose is None:
+            return None
+        age = t - self.t
+        if age > MAX_SAMPLE_AGE:
+            return self.pose
+        lead = min(age + self.latency, MAX_PREDICTION)
+        return (wrap_Angle(self.pose[0] + self.pan_velocity * lead), self.pose[1] + self.tilt_velocity * lead)
+
+
+class Alpha_Beta_Predictor(Constant_Velocity_Predictor):
+    # alpha-beta (g-h) filter: smooths measurement jitter, estimates velocity, then extrapolates like
+    # Constant_Velocity_Predictor. larger alpha / beta follow faster, smaller ones smooth more.
+    # beta near alpha^2 / (2 - alpha) is critically damped; with ~10 Hz pose updates a small beta lags
+    # badly behind head turns (the bias grows with acceleration * dt^2 / beta)
+    def __init__(self, latency=PREDICTION_LATENCY, alpha=0.8, beta=0.5):
+        Constant_Velocity_Predictor.__init__(self, latency)
+        self.alpha = alpha
+        self.beta = beta
+        self.measured = None
+
+    def reset(self):
+        Constant_Velocity_Predictor.reset(self)
+        self.measured = None
+
+    def update(self, t, pan, tilt):
+        self.measured = (pan, tilt)
+        if self.pose is None or t <= self.t:
+            if self.pose is None:
+                self.pose = (pan, tilt)
+            self.t = t
+            return
+
+        dt = t - self.t
+        pan_estimate = self.pose[0] + self.pan_velocity * dt
+        tilt_estimate = self.pose[1] + self.tilt_velocity * dt
+        pan_residual = wrap_Angle(pan - pan_estimate)
+        tilt_residual = tilt - tilt_estimate
+
+        self.pose = (wrap_Angle(pan_estimate + self.alpha * pan_residual), tilt_estimate + self.alpha * tilt_residual)
+        self.pan_velocity += self.beta * pan_residual / dt
+        self.tilt_velocity += self.beta * tilt_residual / dt
+        self.t = t
+
+    def predict(self, t):
+        if self.pose is not None and t - self.t > MAX_SAMPLE_AGE:
+            # settled user: hold where they actually are, not where the smoothed estimate lags
+            return self.measured
+        return Constant_Velocity_Predictor.predict(self, t)
+
+
+PREDICTORS = {
+    'none': Passthrough_Predictor,
+    'constant_velocity': Constant_Velocity_Predictor,
+    'alpha_beta': Alpha_Beta_Predictor,
+}
+
+
+def make_Predictor(name, **kwargs):
+    if name not in PREDICTORS:
+        raise ValueError("unknown predictor %r, expected one of %s" % (name, ", ".join(sorted(PREDICTORS))))
+    return PREDICTORS[name](**kwargs)
@@ -0,0 +1,130 @@
+# Publishes the measured pan / tilt of each stand back into the ARENA scene as an object update, so remote
+# users can see where a tablet is actually looking.
+#
+# Updates are cheap on MQTT: a stand is only sent when it moved more than `threshold` degrees since its last
+# published pose, publishing is capped at `rate_hz`, and all stands that changed go out together in one tick,
+# largest change first, at most `max_updates` per tick (the rest follow on the next tick).
+#
+#   publisher = Pose_Publisher(scene)
+#   publisher.add_Stand(stand_key, 'stand_pose_0', position=(0, 1, 0))
+#   publisher.publish({stand_key: (pan, tilt, t)})          e.g. from a run_forever task, with Kubi_Fleet.measured_Poses()
+#
+# The apps take pan from the user's camera as the turn about ARENA y (yaw) and tilt as the turn about ARENA x
+# (pitch), both with ARENA's signs (quat_euler on the (y, x, z, w) swapped quaternion), so the object is published
+# with rotation (tilt, pan, 0) and turns the way the user's head did. `python pose_publisher.py` checks the axes.
+
+import time
+
+POSE_PUBLISH_RATE_HZ        = 5                 # updates per second per stand at most
+POSE_THRESHOLD_DEG          = 1.0               # smaller pose changes are not published
+MAX_UPDATES_PER_TICK        = 8                 # object updates sent per publish call
+POSE_DECIMALS               = 1                 # published angles are rounded to this many decimals
+HALF_REVOLUTION             = 180.0
+FULL_REVOLUTION             = 360.0
+
+
+class Pose_Publisher:
+    def __init__(self, scene, rate_hz=POSE_PUBLISH_RATE_HZ, threshold=POSE_THRESHOLD_DEG, max_updates=MAX_UPDATES_PER_TICK,
+                 clock=time.monotonic):
+        self.scene = scene
+        self.min_interval = 1.0 / rate_hz
+        self.threshold = threshold
+        self.max_updates = max_updates
+        self.clock = clock
+        self.objects = {}                       # key -> ARENA Object
+        self.published = {}                     # key -> (pan, tilt) last sent
+        self.last_publish = None
+
+        self.updates = 0
+        self.suppressed = 0                     # poses within the threshold
+        self.deferred = 0                       # changes pushed to a later tick by max_updates
+
+    def add_Stand(self, key, object_id, position=(0, 0, 0), parent=None):
+        # arena is imported here, so the apps can load this module before their (background) arena import is done
+        from arena import Object
+        options = {"object_id": object_id, "position": position, "rotation": (0, 0, 0), "persist": False}
+        if parent is not None:
+            options["parent"] = parent
+        obj = Object(**options)
+        self.objects[key] = obj
+        self.scene.add_object(obj)
+        return obj
+
+    def remove_Stand(self, key):
+        obj = self.objects.pop(key, None)
+        self.published.pop(key, None)
+        if obj is not None:
+            self.scene.delete_object(obj)
+
+    def publish(self, poses):
+        # poses: {key: (pan, tilt, ...)}; returns the number of updates sent
+        now = self.clock()
+        if self.last_publish is not None and now - self.last_publish < self.min_interval:
+            return 0
+
+        changed = []
+        for key, pose in poses.items():
+            if key not in self.objects:
+                continue
+            pan, tilt = pose[0], pose[1]
+            last = self.published.get(key)
+            if last is None:
+                delta = FULL_REVOLUTION
+            else:
+                # pan may cross the ±180 seam
+                delta = max(abs((pan - last[0] + HALF_REVOLUTION) % FULL_REVOLUTION - HALF_REVOLUTION), abs(tilt - last[1]))
+            if delta < self.threshold:
+                self.suppressed += 1
+                continue
+            changed.append((delta, key, pan, tilt))
+        if not changed:
+            return 0
+
+        self.last_publish = now
+        changed.sort(key=lambda change: change[0], reverse=True)
+        for delta, key, pan, tilt in changed[:self.max_updates]:
+            self.scene.update_object(self.objects[key], rotation=(round(tilt, POSE_DECIMALS), round(pan, POSE_DECIMALS), 0))
+            self.published[key] = (pan, tilt)
+        sent = min(len(changed), self.max_updates)
+        self.updates += sent
+        self.deferred += len(changed) - sent
+        return sent
+
+    def get_Stats(self):
+        return {"updates": self.updates, "suppressed": self.suppressed, "deferred": self.deferred}
+
+
+def check_Axes():
+    # a head turned by an ARENA Euler rotation gives the stand (pan, tilt) through the apps' conversion; publishing
+    # that pose must give the object the same rotation back
+    import math
+    from quat_euler import rotation_quat2euler
+
+    class Recording_Scene:
+        def __init__(self):
+            self.updates = []
+
+        def update_object(self, obj, **options):
+            self.updates.append(options['rotation'])
+
+    def head_Quaternion(pitch, yaw):
+        # ARENA Euler degrees (x, y, 0) as an (x, y, z, w) quaternion, yaw applied after pitch
+        cx, sx = math.cos(math.radians(pitch) / 2), math.sin(math.radians(pitch) / 2)
+        cy, sy = math.cos(math.radians(yaw) / 2), math.sin(math.radians(yaw) / 2)
+        return (sx * cy, cx * sy, -sx * sy, cx * cy)
+
+    for pitch, yaw in ((0.0, 30.0), (20.0, 0.0), (-15.0, -40.0)):
+        x, y, z, w = head_Quaternion(pitch, yaw)
+        euler = rotation_quat2euler((y, x, z, w))              # the apps' (y, x, z, w) swap
+        pan, tilt = euler[0], euler[1]
+        scene = Recording_Scene()
+        publisher = Pose_Publisher(scene)
+        publisher.objects['stand'] = object()
+        publisher.publish({'stand': (pan, tilt)})
+        rotation = scene.updates[-1]
+        assert abs(rotation[0] - pitch) < 0.1 and abs(rotation[1] - yaw) < 0.1 and rotation[2] == 0, (pitch, yaw, rotation)
+    print("pan is published about y, tilt about x")
+
+
+if __name__ == '__main__':
+    check_Axes()
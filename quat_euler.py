@@ -0,0 +1,99 @@
+# NumPy only quaternion -> Euler conversion, a drop in for
+#     scipy.spatial.transform.Rotation.from_quat(q).as_euler('xyz', degrees=True)
+# so the example scripts do not pay for the scipy import or one Rotation object per camera per tick.
+#
+# Quaternions are scalar last (x, y, z, w) like scipy. The scripts feed ARENA rotations in as
+# (y, x, z, w); Euler_Converter keeps that ordering, DO NOT CHANGE it.
+
+import math
+
+import numpy as np
+
+
+def quat2euler_xyz(quats, out=None, scratch=None):
+    # quats: (N, 4) array, out: (N, 3) array of degrees, scratch: (4, N) array
+    # extrinsic xyz, i.e. R = Rz(c) @ Ry(b) @ Rx(a) -> (a, b, c)
+    n = quats.shape[0]
+    if out is None:
+        out = np.empty((n, 3))
+    if scratch is None:
+        scratch = np.empty((4, n))
+    x, y, z, w = quats[:, 0], quats[:, 1], quats[:, 2], quats[:, 3]
+    norm, num, den, tmp = scratch[0], scratch[1], scratch[2], scratch[3]
+
+    # squared norm, so non unit quaternions behave like scipy (which normalises)
+    np.multiply(x, x, out=norm)
+    norm += np.multiply(y, y, out=tmp)
+    norm += np.multiply(z, z, out=tmp)
+    norm += np.multiply(w, w, out=tmp)
+
+    # a = atan2(2(wx + yz), |q|^2 - 2(x^2 + y^2))
+    np.multiply(w, x, out=num)
+    num += np.multiply(y, z, out=tmp)
+    num *= 2.0
+    np.multiply(x, x, out=den)
+    den += np.multiply(y, y, out=tmp)
+    den *= -2.0
+    den += norm
+    np.arctan2(num, den, out=out[:, 0])
+
+    # b = asin(2(wy - zx) / |q|^2)
+    np.multiply(w, y, out=num)
+    num -= np.multiply(z, x, out=tmp)
+    num *= 2.0
+    num /= norm
+    np.clip(num, -1.0, 1.0, out=num)
+    np.arcsin(num, out=out[:, 1])
+
+    # c = atan2(2(wz + xy), |q|^2 - 2(y^2 + z^2))
+    np.multiply(w, z, out=num)
+    num += np.multiply(x, y, out=tmp)
+    num *= 2.0
+    np.multiply(y, y, out=den)
+    den += np.multiply(z, z, out=tmp)
+    den *= -2.0
+    den += norm
+    np.arctan2(num, den, out=out[:, 2])
+
+    np.degrees(out, out=out)
+    return out
+
+
+def rotation_quat2euler(quat):
+    # single quaternion version with the same signature as the scripts' old scipy helper
+    x, y, z, w = quat
+    norm = x * x + y * y + z * z + w * w
+    a = math.atan2(2.0 * (w * x + y * z), norm - 2.0 * (x * x + y * y))
+    b = math.asin(min(1.0, max(-1.0, 2.0 * (w * y - z * x) / norm)))
+    c = math.atan2(2.0 * (w * z + x * y), norm - 2.0 * (y * y + z * z))
+    return (math.degrees(a), math.degrees(b), math.degrees(c))
+
+
+class Euler_Converter:
+    # converts the rotation of many CameraStates per call into preallocated buffers
+    def __init__(self, capacity=16):
+        self.__allocate(capacity)
+
+    def __allocate(self, capacity):
+        self.capacity = capacity
+        self.quats = np.zeros((capacity, 4))
+        self.quats[:, 3] = 1.0
+        self.euler = np.zeros((capacity, 3))
+        self.scratch = np.empty((4, capacity))
+
+    def convert_Cameras(self, cam_states):
+        # returns an (N, 3) view of degrees, row i belongs to cam_states[i]; valid until the next call
+        n = len(cam_states)
+        if n > self.capacity:
+            self.__allocate(max(n, 2 * self.capacity))
+
+        quats = self.quats
+        for i, cam_state in enumerate(cam_states):
+            rot = cam_state.curr_rot
+            # DO NOT CHANGE coordinate ordering
+            quats[i, 0] = rot.y
+            quats[i, 1] = rot.x
+            quats[i, 2] = rot.z
+            quats[i, 3] = rot.w
+
+        return quat2euler_xyz(quats[:n], self.euler[:n], self.scratch[:, :n])
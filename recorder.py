@@ -0,0 +1,236 @@
+# Binary flight recorder for the pose -> target -> goal -> present position pipeline, and a replayer.
+#
+# Records are fixed size (RECORD_DTYPE, 42 bytes) and go into a memory mapped .npy file used as a ring buffer,
+# so recording costs one struct.pack_into (well under a microsecond) and the file never grows. The OS writes
+# the pages back in the background; a crash loses nothing that was recorded.
+#
+#   recorder = Recorder('stand.npy')
+#   my_motor = Dynamixel_Servo(port, recorder=recorder)           goals / present positions
+#   Servo_Controller(my_motor, recorder=recorder)                   targets
+#   recorder.record_Pose(cam_state.id, position, rotation)          camera poses (the apps do this)
+#
+#   python recorder.py stand.npy                                     summary
+#   python recorder.py --check                                       goal replay self-check on a sim stand
+#   python recorder.py stand.npy --replay goals --port sim://kubi?timing=virtual --speed 0
+#
+# Replay drives a wrapper (real or sim:// port) at the recorded speed, a multiple of it, or with speed 0 as
+# fast as possible, which on a timing=virtual sim bus makes latency benchmarks deterministic.
+
+import argparse
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+RECORD_DTYPE = np.dtype([
+    ('t', '<f8'),                               # time.monotonic() seconds
+    ('kind', 'u1'),                             # KIND_*
+    ('slot', 'u1'),                             # stand / user slot
+    ('id', '<u4'),                              # motor id, or crc32 of the camera object_id for poses
+    ('values', '<f4', (7,)),
+])
+RECORD_STRUCT = struct.Struct('<dBBI7f')
+
+KIND_EMPTY      = 0
+KIND_POSE       = 1                             # x, y, z, qx, qy, qz, qw
+KIND_TARGET     = 2                             # pan, tilt angles handed to the controller
+KIND_GOAL       = 3                             # pan goal, pan speed, tilt goal, tilt speed (ticks, speed 0 = not written)
+KIND_PRESENT    = 4                             # pan, tilt present position (ticks)
+KIND_NAMES = {KIND_POSE: 'pose', KIND_TARGET: 'target', KIND_GOAL: 'goal', KIND_PRESENT: 'present'}
+
+RECORD_CAPACITY = 1 << 20                       # records kept (42 MB), about 40 minutes of one stand at 200 Hz
+
+
+class Recorder:
+    def __init__(self, path, capacity=RECORD_CAPACITY, clock=time.monotonic):
+        self.path = path
+        self.capacity = capacity
+        self.clock = clock
+        self.records = np.lib.format.open_memmap(path, mode='w+', dtype=RECORD_DTYPE, shape=(capacity,))
+        self.raw = self.records.view(np.uint8)
+        self.lock = threading.Lock()
+        self.count = 0                          # records written so far, the ring index is count % capacity
+        self.enabled = True
+
+    def record(self, kind, values, dxl_id=0, slot=0, t=None):
+        if not self.enabled:
+            return
+        if t is None:
+            t = self.clock()
+        values = tuple(values) + (0.0,) * (7 - len(values))
+        with self.lock:
+            offset = (self.count % self.capacity) * RECORD_STRUCT.size
+            RECORD_STRUCT.pack_into(self.raw, offset, t, kind, slot, dxl_id, *values)
+            self.count += 1
+
+    def record_Pose(self, object_id, position, rotation, slot=0):
+        self.record(KIND_POSE, (position.x, position.y, position.z, rotation.x, rotation.y, rotation.z, rotation.w),
+                    object_Hash(object_id), slot)
+
+    def flush(self):
+        self.records.flush()
+
+    def close(self):
+        self.enabled = False
+        self.flush()
+
+
+def object_Hash(object_id):
+    return zlib.crc32(object_id.encode()) if isinstance(object_id, str) else int(object_id)
+
+
+def load_Recording(path):
+    # returns the recorded records in time order (ring buffer unrolled, unused slots dropped)
+    records = np.load(path, mmap_mode='r')
+    used = records[records['kind'] != KIND_EMPTY]
+    return np.array(used[np.argsort(used['t'], kind='stable')])
+
+
+class Replayer:
+    # calls handlers[kind](record) for every record, paced by the recorded timestamps / speed.
+    # speed 0 (or None) replays as fast as possible
+    def __init__(self, records, speed=1.0, clock=time.monotonic, sleep=time.sleep):
+        self.records = records
+        self.speed = speed
+        self.clock = clock
+        self.sleep = sleep
+        self.late = 0.0                         # worst lag behind the recorded schedule, s
+
+    def run(self, handlers):
+        if not len(self.records):
+            return 0
+        start = self.clock()
+        t0 = float(self.records[0]['t'])
+        played = 0
+        for record in self.records:
+            handler = handlers.get(int(record['kind']))
+            if handler is None:
+                continue
+            if self.speed:
+                due = start + (float(record['t']) - t0) / self.speed
+                now = self.clock()
+                if due > now:
+                    self.sleep(due - now)
+                else:
+                    self.late = max(self.late, now - due)
+            handler(record)
+            played += 1
+        return played
+
+
+def goal_Handler(servo):
+    # replays recorded goal writes on a kubi_wrapper.Dynamixel_Servo. speed 0 means the speeds were not
+    # written (set_Pan_Tilt); sending it would be Moving Speed 0, no speed limit, so those replay goals only
+    def handle(record):
+        pan_goal, pan_speed, tilt_goal, tilt_speed = [int(v) for v in record['values'][:4]]
+        if pan_speed == 0 and tilt_speed == 0:
+            servo.set_Goal(pan_goal, tilt_goal)
+        else:
+            servo.set_Goal_Speed(pan_goal, pan_speed, tilt_goal, tilt_speed)
+    return handle
+
+
+def target_Handler(set_Target, slot=None):
+    # replays recorded targets into Servo_Controller.set_Target / Kubi_Fleet style callables,
+    # or lambda pan, tilt: servo.rotate_To_Angle(pan) for dyna_wrapper
+    def handle(record):
+        if slot is None or record['slot'] == slot:
+            set_Target(float(record['values'][0]), float(record['values'][1]))
+    return handle
+
+
+def summarize(records):
+    lines = []
+    if not len(records):
+        return "empty recording"
+    duration = float(records[-1]['t'] - records[0]['t'])
+    lines.append("%d records over %.1f s" % (len(records), duration))
+    for kind, name in sorted(KIND_NAMES.items()):
+        selected = records[records['kind'] == kind]
+        if len(selected):
+            lines.append("  %-8s %8d  (%.1f / s)" % (name, len(selected), len(selected) / duration if duration else 0.0))
+    return "\n".join(lines)
+
+
+def check_Goal_Replay():
+    # goals recorded from set_Pan_Tilt carry speed 0 (not written); replaying them on a sim stand must leave the
+    # Moving Speed of the last set_Goal_Speed in place instead of writing 0, which is no speed limit at all
+    import os
+    import tempfile
+    from dyna_sim import get_Sim_Bus
+    from kubi_wrapper import Dynamixel_Servo, DXL_PAN_ID, DXL_TILT_ID
+
+    def sim_Stand(port, recorder=None):
+        servo = Dynamixel_Servo(port, recorder=recorder)
+        servo.connect_Dynamixel()
+        servo.init_Dynamixel()
+        bus = get_Sim_Bus(port)
+        servos = bus.servos if isinstance(bus.servos, dict) else dict((s.dxl_id, s) for s in bus.servos)
+        return servo, servos
+
+    path = os.path.join(tempfile.mkdtemp(), 'check.npy')
+    recorder = Recorder(path, capacity=64)
+    servo, _ = sim_Stand('sim://kubi?timing=instant&check=record', recorder)
+    servo.set_Goal_Speed(600, 100, 480, 80)
+    for angle in (5.0, 10.0, 15.0):
+        servo.set_Pan_Tilt(angle, -angle)
+    recorder.close()
+
+    records = load_Recording(path)
+    goals = records[records['kind'] == KIND_GOAL]
+    assert len(goals) == 4 and not goals[-1]['values'][1] and not goals[-1]['values'][3], goals
+    servo, servos = sim_Stand('sim://kubi?timing=instant&check=replay')
+    Replayer(records, 0).run({KIND_GOAL: goal_Handler(servo)})
+    assert servos[DXL_PAN_ID].get('moving_speed') == 100 and servos[DXL_TILT_ID].get('moving_speed') == 80, \
+        (servos[DXL_PAN_ID].get('moving_speed'), servos[DXL_TILT_ID].get('moving_speed'))
+    assert servos[DXL_PAN_ID].get('goal_position') == int(goals[-1]['values'][0]), servos[DXL_PAN_ID].get('goal_position')
+    print("goals recorded without a speed replay without touching Moving Speed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="inspect or replay a recorder.py recording")
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--check', action='store_true', help="check goal replay on a sim stand and exit")
+    parser.add_argument('--replay', choices=('goals', 'targets'), help="drive a Kubi stand from the recording")
+    parser.add_argument('--port', default='sim://kubi?timing=virtual', help="serial port or sim:// URL to replay on")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed, 0 = as fast as possible")
+    args = parser.parse_args()
+    if args.check:
+        check_Goal_Replay()
+        raise SystemExit
+    if args.path is None:
+        parser.error("a recording path is required")
+
+    records = load_Recording(args.path)
+    print(summarize(records))
+
+    if args.replay:
+        from kubi_wrapper import Dynamixel_Servo
+        from bus_telemetry import Bus_Telemetry
+
+        telemetry = Bus_Telemetry()
+        servo = Dynamixel_Servo(args.port, telemetry=telemetry)
+        servo.connect_Dynamixel()
+        servo.init_Dynamixel()
+
+        controller = None
+        if args.replay == 'goals':
+            handlers = {KIND_GOAL: goal_Handler(servo)}
+        else:
+            from servo_controller import Servo_Controller
+            controller = Servo_Controller(servo)
+            controller.start()
+            handlers = {KIND_TARGET: target_Handler(controller.set_Target)}
+
+        replayer = Replayer(records, args.speed)
+        started = time.perf_counter()
+        played = replayer.run(handlers)
+        elapsed = time.perf_counter() - started
+        if controller is not None:
+            controller.stop()
+
+        print("replayed %d records in %.3f s (max %.1f ms behind schedule)" % (played, elapsed, replayer.late * 1000.0))
+        for (port, dxl_id, instruction), stats in sorted(telemetry.snapshot().items()):
+            print("  id %3d %-10s %6d  mean %.3f ms  p99 %.3f ms" % (dxl_id, instruction, stats['count'], stats['mean_ms'], stats['p99_ms']))
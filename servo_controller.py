@@ -0,0 +1,257 @@
+# Fixed rate servo control loop for a kubi_wrapper.Dynamixel_Servo, running on its own thread.
+#
+# The ARENA side publishes target angles into a latest-value mailbox and never touches the serial port,
+# so MQTT handling and serial latency no longer steal time from each other.
+#
+# With supervise=True a lost port (the serial device raising) or MAX_CONSECUTIVE_FAILURES failed
+# transactions in a row make the loop reconnect and reinitialise the stand on this thread, with backoff.
+# The ARENA side keeps posting targets meanwhile; the latest one is picked up again once the stand is back.
+# Targets carry the id of the user they follow; when it changes the predictor is reset and the trajectory held,
+# so the jump to the next user is not read as head velocity and overshot.
+# Any other exception in a step (SDK, trajectory, predictor, recorder) is reported with its traceback; supervised,
+# the loop resets the predictor, holds the trajectory and carries on, otherwise the thread says it stopped.
+# A stand that was not there at launch starts supervised with lost=reason, and is connected the same way.
+#
+# An optional tick_profiler.Tick_Profiler times every tick by phase (predict, trajectory, goal write, measure)
+# against the period and samples this thread's stack for the ticks that overrun it.
+
+import threading
+import time
+import traceback
+
+from recorder import KIND_TARGET
+from dyna_driver import reconnect_With_Backoff
+
+CONTROL_RATE_HZ             = 200               # 5 ms, the rate cam_motor_sync used to drive the motors at
+MISS_REPORT_INTERVAL        = 5.0               # seconds between missed deadline reports
+MEASURE_INTERVAL            = 0.1               # s between present position reads when measuring is on
+HEALTH_CHECK_INTERVAL       = 0.5               # s between probe reads when supervising without measuring
+
+
+class Latest_Value:
+    # Single writer / single reader mailbox that only keeps the newest value.
+    # Replacing one tuple attribute is atomic in CPython, so neither side takes a lock.
+    def __init__(self, value=None):
+        self.slot = (0, value)
+
+    def put(self, value):
+        self.slot = (self.slot[0] + 1, value)
+
+    def get(self):
+        # returns (sequence number, value); the sequence number changes on every put
+        return self.slot
+
+
+class Servo_Controller:
+    def __init__(self, servo, rate_hz=CONTROL_RATE_HZ, on_deadline_miss=None, trajectory=None, predictor=None,
+                 recorder=None, record_slot=0, measure_interval=None, supervise=False, profiler=None, lost=None):
+        self.servo = servo
+        self.period = 1.0 / rate_hz
+        # optional trajectory.Pan_Tilt_Trajectory; without one the servo is stepped with set_Pan_Tilt
+        self.trajectory = trajectory
+        # optional pose_predictor predictor, extrapolates the targets past the ARENA / servo latency
+        self.predictor = predictor
+        self.recorder = recorder                        # recorder.Recorder for the incoming targets
+        self.record_slot = record_slot
+        self.target = Latest_Value()
+        self.on_deadline_miss = on_deadline_miss
+        # every measure_interval seconds the loop reads the present pose into measured as (pan, tilt, time),
+        # so other threads see where the stand is without touching the serial port
+        self.measure_interval = measure_interval
+        self.measured = Latest_Value()
+        # reconnect instead of dying on a lost port. sync writes get no reply, so a supervised loop also reads
+        # the pose every HEALTH_CHECK_INTERVAL if nothing else does
+        self.supervise = supervise
+        if supervise and measure_interval is None:
+            self.measure_interval = HEALTH_CHECK_INTERVAL
+        self.profiler = profiler                        # tick_profiler.Tick_Profiler, None = off
+        self.lost = lost                                # why the stand is not connected yet, the loop reconnects it first
+
+        self.running = False
+        self.thread = None
+
+        self.ticks = 0
+        self.step_seq = 0                       # mailbox sequence number of the target the last step was computed from
+        self.missed_deadlines = 0
+        self.max_overrun = 0.0
+        self.last_report = 0.0
+        self.reported_misses = 0
+        self.faults = 0
+        self.last_recovery = None               # s the last reconnect took
+        self.errors = 0                         # steps that raised something other than OSError
+        self.last_error = None
+        self.last_error_report = None
+        self.reported_errors = 0
+
+    def set_Target(self, pan, tilt, source=None):
+        # stamped on arrival, the predictor extrapolates from this time. source: the tracked user's id
+        now = time.monotonic()
+        self.target.put((pan, tilt, now, source))
+        if self.recorder is not None:
+            self.recorder.record(KIND_TARGET, (pan, tilt), slot=self.record_slot, t=now)
+
+    def clear_Target(self):
+        # stop commanding the motors, they hold the last written goal
+        self.target.put(None)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name="servo-controller-%s" % self.servo.port, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get_Stats(self):
+        return {
+            "ticks": self.ticks,
+            "missed_deadlines": self.missed_deadlines,
+            "max_overrun_ms": self.max_overrun * 1000.0,
+            "faults": self.faults,
+            "last_recovery_ms": self.last_recovery * 1000.0 if self.last_recovery is not None else None,
+            "errors": self.errors,
+            "last_error": repr(self.last_error) if self.last_error is not None else None,
+            "profile": self.profiler.get_Stats() if self.profiler is not None else None,
+        }
+
+    def control_Step(self, target, dt):
+        profiler = self.profiler
+        if self.trajectory is None:
+            self.servo.set_Pan_Tilt(target[0], target[1])
+        else:
+            goal = self.trajectory.update(target[0], target[1], dt)
+            if profiler is not None:
+                profiler.mark("trajectory")
+            self.servo.set_Goal_Speed(*goal)
+        if profiler is not None:
+            profiler.mark("goal write")
+
+    def __run(self):
+        if self.lost is not None:
+            self.__recover(self.lost)
+            self.lost = None
+        next_deadline = time.monotonic()
+        last_step = next_deadline
+        last_seq = None
+        last_source = None
+        next_measure = next_deadline
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.attach()
+        while self.running:
+            seq, target = self.target.get()
+            step_time = time.monotonic()
+            if profiler is not None:
+                profiler.begin_Tick(step_time - next_deadline)
+            if target is not None and target[3] != last_source:
+                # another user: their pose is no continuation of the last one's
+                if last_source is not None:
+                    if self.predictor is not None:
+                        self.predictor.reset()
+                    if self.trajectory is not None:
+                        self.trajectory.hold()
+                last_source = target[3]
+            try:
+                if self.predictor is not None:
+                    # the predictor only runs on this thread; the ARENA side just posts stamped targets
+                    if target is None:
+                        self.predictor.reset()
+                    else:
+                        if seq != last_seq:
+                            self.predictor.update(target[2], target[0], target[1])
+                        target = self.predictor.predict(step_time)
+                    if profiler is not None:
+                        profiler.mark("predict")
+                if target is not None:
+                    self.step_seq = seq
+                    self.control_Step(target, step_time - last_step)
+                # the newest update a write_interval burst staged
+                self.servo.flush_Due()
+                if self.measure_interval is not None and step_time >= next_measure:
+                    pan, tilt = self.servo.read_Pan_Tilt_Angles()
+                    if not self.servo.driver.failures:
+                        self.measured.put((pan, tilt, step_time))
+                    next_measure = step_time + self.measure_interval
+                    if profiler is not None:
+                        profiler.mark("measure")
+            except OSError as error:
+                # the serial device went away under a transaction
+                if not self.supervise:
+                    raise
+                self.__recover(error)
+                next_deadline = last_step = time.monotonic()
+                continue
+            except Exception as error:
+                self.errors += 1
+                self.last_error = error
+                if not self.supervise:
+                    print("%s: controller stopped, the stand no longer tracks" % self.servo.port)
+                    self.running = False
+                    raise
+                self.__report_Error(step_time)
+                # start the next step clean, the failed one may have left the predictor or trajectory half updated
+                if self.predictor is not None:
+                    self.predictor.reset()
+                if self.trajectory is not None:
+                    self.trajectory.hold()
+            if self.supervise and not self.servo.driver.healthy():
+                self.__recover("%d failed transactions in a row" % self.servo.driver.failures)
+                next_deadline = last_step = time.monotonic()
+                continue
+            last_step = step_time
+            last_seq = seq
+            self.ticks += 1
+            if profiler is not None:
+                profiler.end_Tick()
+
+            next_deadline += self.period
+            now = time.monotonic()
+            if now > next_deadline:
+                overrun = now - next_deadline
+                self.__deadline_Missed(overrun, now)
+                # drop the missed periods instead of bursting writes to catch up
+                next_deadline = now
+            else:
+                time.sleep(next_deadline - now)
+        if profiler is not None:
+            profiler.detach()
+
+    def __recover(self, reason):
+        self.faults += 1
+        print("%s: bus lost (%s), reconnecting" % (self.servo.port, reason))
+        elapsed = reconnect_With_Backoff(self.servo.reconnect_Dynamixel, lambda: self.running)
+        if elapsed is None:
+            return
+        self.last_recovery = elapsed
+        # carry on from where the motors are; the latest target is still in the mailbox
+        if self.trajectory is not None:
+            self.trajectory.reset(*self.servo.pos)
+        print("%s: reconnected in %.1f ms" % (self.servo.port, elapsed * 1000.0))
+
+    def __report_Error(self, now):
+        # the first traceback in full, then at most one count per MISS_REPORT_INTERVAL
+        if self.last_error_report is None:
+            print("%s: control step failed, carrying on\n%s" % (self.servo.port, traceback.format_exc().rstrip()))
+        elif now - self.last_error_report >= MISS_REPORT_INTERVAL:
+            print("%s: %d more failed control steps, last: %r" % (
+                self.servo.port, self.errors - self.reported_errors, self.last_error))
+        else:
+            return
+        self.last_error_report = now
+        self.reported_errors = self.errors
+
+    def __deadline_Missed(self, overrun, now):
+        self.missed_deadlines += 1
+        self.max_overrun = max(self.max_overrun, overrun)
+        if self.on_deadline_miss is not None:
+            self.on_deadline_miss(self, overrun)
+        elif now - self.last_report >= MISS_REPORT_INTERVAL:
+            print("%s: missed %d control deadlines (max overrun %.2f ms)" % (
+                self.servo.port, self.missed_deadlines - self.reported_misses, self.max_overrun * 1000.0))
+            self.last_report = now
+            self.reported_misses = self.missed_deadlines
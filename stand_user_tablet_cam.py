@@ -1,15 +1,39 @@
-from kubi_wrapper import *
-from arena import *
+from startup import Startup_Timer, preload, run_In_Background
+startup = Startup_Timer()
+# arena and its MQTT stack load on another thread while the stands initialise
+arena_loaded = preload('arena', startup=startup)
+
+from kubi_fleet import Kubi_Fleet
+from quat_euler import Euler_Converter
+from user_registry import User_Registry
+from recorder import Recorder
+from pose_publisher import Pose_Publisher, POSE_PUBLISH_RATE_HZ
+from tick_profiler import Tick_Profiler
 import random
-import scipy
-import math
 
-kubi_1 = Dynamixel_Servo('/dev/tty.usbserial-FT6RW6MQ')
-kubi_2 = Dynamixel_Servo('/dev/tty.usbserial-FT6RWE8K')
+# one Kubi stand per serial port, slot N follows the Nth user inside the video_ball radius.
+# each stand gets its own controller thread, so a slow port does not hold up the other
+FLEET_CONFIG = {
+    '/dev/tty.usbserial-FT6RW6MQ': {'slot': 0},
+    '/dev/tty.usbserial-FT6RWE8K': {'slot': 1},
+}
+
+PUBLISH_STAND_POSE = True         # stream each stand's measured pan / tilt into the scene (pose_publisher.py)
+PROFILE_TICKS = False             # time the controller ticks and target updates by phase, snapshot overruns (tick_profiler.py)
+PROFILE_REPORT_INTERVAL_MS = 10000
+TARGET_BUDGET_MS = 5              # a target update should fit in the old motor tick
 
+RECORD_PATH = None                # e.g. 'stand_user_tablet_cam.npy' to record poses, targets and goals (recorder.py)
+recorder = Recorder(RECORD_PATH) if RECORD_PATH else None
 
-kubi_1.connect_Dynamixel()
-kubi_1.init_Dynamixel()
+fleet = Kubi_Fleet(FLEET_CONFIG, predictor='alpha_beta', recorder=recorder,
+                   measure_interval=1.0 / POSE_PUBLISH_RATE_HZ if PUBLISH_STAND_POSE else None, supervise=True, startup=startup,
+                   profile_ticks=PROFILE_TICKS)
+# every stand initialises in parallel, alongside the arena import and the MQTT connect below
+stands_ready = run_In_Background(fleet.connect_All)
+
+arena_loaded.result()
+from arena import *
 
 
 ''' Camera-Dynamixel Sync
@@ -17,11 +41,15 @@ kubi_1.init_Dynamixel()
 MIN_DISPLACEMENT = 0.5
 LINE_TTL = 5
 HALF_REVOLUTION = 180
+POSE_SAMPLE_INTERVAL_MS = 75    # was every 15th tick of the old 5 ms motor loop
+EVENT_DRIVEN = True             # recompute the targets from camera pose messages instead of sampling
+HOUSEKEEPING_INTERVAL_MS = 1000 # event driven mode still expires stale users on a slow timer
 
 class CameraState(Object):
     def __init__(self, camera):
         self.camera = camera
         self.prev_pos = None
+        self.last_pose = None
         self.line_color = Color(
                 random.randint(0,255),
                 random.randint(0,255),
@@ -51,24 +79,71 @@ class CameraState(Object):
         else:
             return 0
 
-cam_states = []
+    def pose_Changed(self):
+        # True when position or rotation differ from the last call
+        pos = self.curr_pos
+        rot = self.curr_rot
+        pose = (pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w)
+        if pose == self.last_pose:
+            return False
+        self.last_pose = pose
+        return True
 
+# users currently in the scene, indexed on a grid so the video_ball query only visits nearby cells
+user_registry = User_Registry()
 
 def user_join_callback(scene, cam, msg):
-    global cam_states
-
     cam_state = CameraState(cam)
-    cam_states += [cam_state]
+    user_registry.add(cam_state.id, cam_state, cam_state.curr_pos.x, cam_state.curr_pos.z)
 
-    
+def user_left_callback(scene, cam, msg):
+    user_registry.remove(cam.object_id)
+
+def delete_obj_callback(scene, obj, msg):
+    user_registry.remove(obj.object_id)
 
-scene = Scene(host="arena-dev1.conix.io", scene="first_playground")
+def on_msg_callback(scene, obj, msg):
+    # every camera pose update moves the user in the grid and keeps it from expiring
+    object_id = getattr(obj, 'object_id', None)
+    if object_id == "video_ball":
+        if EVENT_DRIVEN:
+            update_Targets()
+        return
+    cam_state = user_registry.get(object_id)
+    pos = obj.data.position
+    if cam_state is None:
+        if not isinstance(obj, Camera):
+            return
+        # a user expired for sitting still (USER_TTL) is tracked again from their next pose
+        cam_state = CameraState(obj)
+        user_registry.add(object_id, cam_state, pos.x, pos.z)
+    else:
+        user_registry.move(object_id, pos.x, pos.z)
+    if recorder is not None:
+        recorder.record_Pose(object_id, pos, obj.data.rotation)
+
+    # only a pose change of a user who is, or just was, in range can move a stand
+    if EVENT_DRIVEN and cam_state.pose_Changed() and (object_id in tracked_ids or user_In_Range(cam_state)):
+        update_Targets()
+
+with startup.phase("scene connect"):
+    scene = Scene(host="arena-dev1.conix.io", scene="first_playground")
 scene.user_join_callback = user_join_callback
+scene.user_left_callback = user_left_callback
+scene.delete_obj_callback = delete_obj_callback
+scene.on_msg_callback = on_msg_callback
+
+pose_publisher = Pose_Publisher(scene)
+if PUBLISH_STAND_POSE:
+    for stand in fleet.stands:
+        pose_publisher.add_Stand((stand.scene, stand.slot), "stand_pose_%d" % stand.slot)
 
-def rotation_quat2euler(quat):
-        rotq = scipy.spatial.transform.Rotation.from_quat(list(quat))
-        # do not change to xzy, weird things happen
-        return tuple(rotq.as_euler('xyz', degrees=True))
+# NumPy replacement for scipy's Rotation.as_euler('xyz'), do not change to xzy, weird things happen
+euler_converter = Euler_Converter()
+# the ARENA callbacks run on this thread, so that is the one the target profiler samples
+target_profiler = Tick_Profiler(TARGET_BUDGET_MS / 1000.0, name="target update", sample=True) if PROFILE_TICKS else None
+if target_profiler is not None:
+    target_profiler.attach()
 
 
 
@@ -88,43 +163,78 @@ def cam_create(cam_state_id):
 
     scene.add_object(new_cam)
 
-call_index = 0
-rotation_x = 0
-rotation_y = 0
-@scene.run_forever(interval_ms=5)
-def cam_motor_sync():
-    global call_index
-    global rotation_x
-    global rotation_y
+tracked_ids = set()
+
+def user_In_Range(cam_state):
+    vid_ball = scene.all_objects.get("video_ball")
+    if vid_ball is None:
+        return False
+    dx = vid_ball.data.position.x - cam_state.curr_pos.x
+    dz = vid_ball.data.position.z - cam_state.curr_pos.z
+    return dx * dx + dz * dz <= vid_ball.data.radius ** 2
+
+def update_Targets():
     global user_entered
+    global tracked_ids
 
-    vid_ball = scene.all_objects["video_ball"]
-    
-    call_index += 1
-    if(call_index % 15 == 0):
-        for cam_state in cam_states:
-            dx = vid_ball.data.position.x - cam_state.curr_pos.x
-            dz = vid_ball.data.position.z - cam_state.curr_pos.z
-            disp = math.sqrt(dx**2 + dz**2)
-            if vid_ball.data.radius < disp:
-                user_entered = False
-                continue
-            user_entered = True
-            cam_create(cam_state.id)
-
-            # DO NOT CHANGE coordinate ordering
-            euler_cords = rotation_quat2euler((cam_state.curr_rot.y, 
-            cam_state.curr_rot.x, cam_state.curr_rot.z, cam_state.curr_rot.w))
-        
-            rotation_x = euler_cords[1]
-            rotation_y = euler_cords[0]
-    
+    vid_ball = scene.all_objects.get("video_ball")
+    if vid_ball is None:
+        return
+    if target_profiler is not None:
+        target_profiler.begin_Tick()
+
+    tracked = user_registry.query_Radius(vid_ball.data.position.x, vid_ball.data.position.z, vid_ball.data.radius)
+    tracked_ids = set(cam_state.id for cam_state in tracked)
+    user_entered = bool(tracked)
+    for cam_state in tracked:
+        cam_create(cam_state.id)
+    if target_profiler is not None:
+        target_profiler.mark("user scan")
 
     if not user_entered:
+        for stand in fleet.stands:
+            fleet.clear_Target(stand.slot)
+        if target_profiler is not None:
+            target_profiler.mark("set target")
+            target_profiler.end_Tick()
         return
 
-  
-    kubi_1.pan_To_Angle(rotation_y)
-    kubi_1.tilt_To_Angle(rotation_x)
-      
+    # one vectorized conversion for every user in range
+    euler_cords = euler_converter.convert_Cameras(tracked)
+    if target_profiler is not None:
+        target_profiler.mark("quaternion conversion")
+
+    # the controller threads pick the new targets up on their next tick
+    for stand in fleet.stands:
+        if stand.slot < len(tracked):
+            fleet.set_Target(stand.slot, float(euler_cords[stand.slot][0]), float(euler_cords[stand.slot][1]),
+                             source=tracked[stand.slot].id)
+        else:
+            fleet.clear_Target(stand.slot)
+    if target_profiler is not None:
+        target_profiler.mark("set target")
+        target_profiler.end_Tick()
+
+
+@scene.run_forever(interval_ms=HOUSEKEEPING_INTERVAL_MS if EVENT_DRIVEN else POSE_SAMPLE_INTERVAL_MS)
+def cam_motor_sync():
+    if user_registry.expire() or not EVENT_DRIVEN:
+        update_Targets()
+
+
+if PUBLISH_STAND_POSE:
+    @scene.run_forever(interval_ms=int(1000 / POSE_PUBLISH_RATE_HZ))
+    def publish_Stand_Poses():
+        # only stands that moved past the threshold are sent, all in this one tick
+        pose_publisher.publish(fleet.measured_Poses())
+
+if PROFILE_TICKS:
+    @scene.run_forever(interval_ms=PROFILE_REPORT_INTERVAL_MS)
+    def profile_Report():
+        print(target_profiler.report())
+        print(fleet.profile_Report())
+
+stands_ready.result()
+fleet.start()
+print(startup.report("tracking"))
 scene.run_tasks() # will block
@@ -0,0 +1,78 @@
+# Startup helpers for the apps: bring the stands up on background threads while the ARENA side imports and
+# connects, and time every phase so slow ones show up.
+#
+#   startup = Startup_Timer()
+#   arena_loaded = preload('arena', startup=startup)                 import on another thread
+#   stand_ready = run_In_Background(fleet.connect_All)               serial init meanwhile
+#   ...
+#   stand_ready.result()                                              re-raises anything the init raised
+#   print(startup.report("tracking"))
+#
+# The wrappers take startup= and record their own phases (port open, baud, profile, torque, position).
+# Phases overlap, so the report lists each with its start offset and duration.
+
+import importlib
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+
+
+class Startup_Timer:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.phases = []                        # (name, start s after started, duration s)
+        self.lock = threading.Lock()            # phases finish on several threads
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            end = self.clock()
+            with self.lock:
+                self.phases.append((name, start - self.started, end - start))
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def report(self, label="ready"):
+        lines = ["%s after %.1f ms" % (label, self.elapsed() * 1000.0)]
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        for name, start, duration in phases:
+            lines.append("  +%7.1f ms  %-40s %7.1f ms" % (start * 1000.0, name, duration * 1000.0))
+        return "\n".join(lines)
+
+
+def startup_Phase(startup, name):
+    # startup.phase(name), or nothing when there is no Startup_Timer
+    return startup.phase(name) if startup is not None else nullcontext()
+
+
+def run_In_Background(function, *args, name=None):
+    # runs function(*args) on a daemon thread, returns a concurrent.futures.Future of its result.
+    # BaseException is passed on too, so a quit() in the wrappers' init still ends the app at result()
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except BaseException as error:
+            future.set_exception(error)
+
+    threading.Thread(target=run, name=name or "startup-%s" % getattr(function, '__name__', 'task'), daemon=True).start()
+    return future
+
+
+def preload(*module_names, startup=None):
+    # imports the modules on a background thread; a later import of them waits for it and costs nothing more
+    def load():
+        for module_name in module_names:
+            with startup_Phase(startup, "import " + module_name):
+                importlib.import_module(module_name)
+    return run_In_Background(load, name="preload-" + ",".join(module_names))
@@ -0,0 +1,205 @@
+# Opt-in tick budget profiler for the control loops: per tick wall time broken down into phases, scheduling
+# jitter (how late a tick started against its deadline) and overruns of the budget. With sample=True a
+# sampling profiler watches the profiled thread, and every tick that overruns keeps a snapshot of the stacks
+# sampled while it ran, so a slow hot path shows where the time went.
+#
+#   profiler = Tick_Profiler(0.005, name="controller", sample=True)
+#   profiler.attach()                                   on the thread being profiled
+#   profiler.begin_Tick(late)                           late: s behind the tick's deadline, None if unscheduled
+#   ...; profiler.mark("trajectory")                    time since the previous mark (or the tick start)
+#   ...; profiler.mark("goal write")
+#   profiler.end_Tick()
+#   print(profiler.report())                            profiler.write_Snapshots('ticks.folded') for flamegraph.pl
+#
+# Servo_Controller(profiler=...) and Kubi_Fleet(profile_ticks=True) wire it into the controller threads, the
+# apps' PROFILE_TICKS also profiles the ARENA side target update. The sampler only gets the GIL at the
+# interpreter's switch interval while the profiled thread runs Python code (it gets it at once while the thread
+# waits on the serial port), so it is coarse for pure CPU ticks.
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+PROFILE_WINDOW              = 2000              # recent ticks kept for the percentiles
+SAMPLE_INTERVAL             = 0.0005            # s between stack samples
+SAMPLE_CAPACITY             = 4000              # samples kept, a few ticks worth at any rate
+MAX_STACK_DEPTH             = 40
+MAX_SNAPSHOTS               = 20                # overrun snapshots kept, the oldest are dropped
+REPORT_STACKS               = 5                 # stacks of the latest snapshot shown by report()
+
+
+def percentile(values, point):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(point / 100.0 * len(ordered)))]
+
+
+class Stack_Sampler:
+    # samples the stack of one thread from a background thread, keeping the most recent SAMPLE_CAPACITY
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, capacity=SAMPLE_CAPACITY, clock=time.perf_counter):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.clock = clock
+        self.samples = deque(maxlen=capacity)   # (time, collapsed stack)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name="tick-profiler-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def since(self, t):
+        return [stack for sampled, stack in list(self.samples) if sampled >= t]
+
+    def __run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples.append((self.clock(), collapse_Stack(frame)))
+            time.sleep(self.interval)
+
+
+def collapse_Stack(frame):
+    # "file:function;file:function;...;file:function:line", outermost first, the folded format of flamegraph.pl
+    names = ["%s:%s:%d" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno)]
+    frame = frame.f_back
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Tick_Profiler:
+    def __init__(self, budget, name="tick", sample=False, sample_interval=SAMPLE_INTERVAL, max_snapshots=MAX_SNAPSHOTS,
+                 window=PROFILE_WINDOW, clock=time.perf_counter):
+        self.budget = budget                    # s a tick may take
+        self.name = name
+        self.sample = sample
+        self.sample_interval = sample_interval
+        self.clock = clock
+        self.sampler = None
+
+        self.ticks = 0
+        self.overruns = 0
+        self.durations = deque(maxlen=window)   # s, recent ticks
+        self.max_duration = 0.0
+        self.jitter = deque(maxlen=window)      # s late, recent scheduled ticks
+        self.max_jitter = 0.0
+        self.phases = {}                        # name -> [count, total s, max s]
+        self.snapshots = deque(maxlen=max_snapshots)
+
+        self.tick_start = None
+        self.last_mark = None
+        self.tick_phases = {}                   # name -> s, this tick
+
+    def attach(self, thread=None):
+        # starts the sampler on thread (default: the calling thread) when sampling is on
+        if not self.sample or self.sampler is not None:
+            return
+        ident = thread.ident if thread is not None else threading.get_ident()
+        self.sampler = Stack_Sampler(ident, self.sample_interval, clock=self.clock)
+        self.sampler.start()
+
+    def detach(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def begin_Tick(self, late=None):
+        # a tick that is begun again without end_Tick (e.g. a reconnect in between) is dropped
+        now = self.clock()
+        self.tick_start = self.last_mark = now
+        self.tick_phases.clear()
+        if late is not None:
+            late = max(late, 0.0)
+            self.jitter.append(late)
+            self.max_jitter = max(self.max_jitter, late)
+
+    def mark(self, name):
+        if self.tick_start is None:
+            return
+        now = self.clock()
+        duration = now - self.last_mark
+        self.last_mark = now
+        self.tick_phases[name] = self.tick_phases.get(name, 0.0) + duration
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0.0, 0.0]
+        phase[0] += 1
+        phase[1] += duration
+        if duration > phase[2]:
+            phase[2] = duration
+
+    def end_Tick(self):
+        if self.tick_start is None:
+            return
+        start = self.tick_start
+        duration = self.clock() - start
+        self.tick_start = None
+        self.ticks += 1
+        self.durations.append(duration)
+        if duration > self.max_duration:
+            self.max_duration = duration
+        if duration > self.budget:
+            self.overruns += 1
+            if self.sampler is not None:
+                self.snapshots.append({
+                    "t": start,
+                    "tick_ms": duration * 1000.0,
+                    "phases_ms": dict((name, value * 1000.0) for name, value in self.tick_phases.items()),
+                    "stacks": Counter(self.sampler.since(start)).most_common(),
+                })
+
+    def get_Stats(self):
+        durations = list(self.durations)
+        jitter = list(self.jitter)
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "budget_ms": self.budget * 1000.0,
+            "tick_mean_ms": sum(durations) / len(durations) * 1000.0 if durations else None,
+            "tick_p99_ms": percentile(durations, 99) * 1000.0 if durations else None,
+            "tick_max_ms": self.max_duration * 1000.0,
+            "jitter_p99_ms": percentile(jitter, 99) * 1000.0 if jitter else None,
+            "jitter_max_ms": self.max_jitter * 1000.0,
+            "phases_ms": dict((name, {"count": count, "mean": total / count * 1000.0, "max": longest * 1000.0})
+                              for name, (count, total, longest) in self.phases.items()),
+            "snapshots": len(self.snapshots),
+        }
+
+    def report(self):
+        stats = self.get_Stats()
+        if not stats["ticks"]:
+            return "%s: no ticks" % self.name
+        lines = ["%s: %d ticks, %d over the %.2f ms budget, mean %.3f / p99 %.3f / max %.3f ms" % (
+            self.name, stats["ticks"], stats["overruns"], stats["budget_ms"], stats["tick_mean_ms"], stats["tick_p99_ms"],
+            stats["tick_max_ms"])]
+        if stats["jitter_p99_ms"] is not None:
+            lines.append("  start jitter p99 %.3f / max %.3f ms" % (stats["jitter_p99_ms"], stats["jitter_max_ms"]))
+        for name, phase in sorted(stats["phases_ms"].items(), key=lambda item: -item[1]["mean"]):
+            lines.append("  %-24s mean %.3f  max %.3f ms" % (name, phase["mean"], phase["max"]))
+        if self.snapshots:
+            snapshot = self.snapshots[-1]
+            lines.append("  latest overrun: %.3f ms, %s" % (snapshot["tick_ms"], ", ".join(
+                "%s %.3f" % (name, value) for name, value in snapshot["phases_ms"].items())))
+            for stack, count in snapshot["stacks"][:REPORT_STACKS]:
+                lines.append("    %4d  %s" % (count, stack))
+        return "\n".join(lines)
+
+    def write_Snapshots(self, path):
+        # the overrun snapshots as folded stacks (flamegraph.pl / speedscope), one comment line per tick
+        with open(path, 'w') as output:
+            for snapshot in list(self.snapshots):
+                output.write("# %s tick %.3f ms at %.6f\n" % (self.name, snapshot["tick_ms"], snapshot["t"]))
+                for stack, count in snapshot["stacks"]:
+                    output.write("%s %d\n" % (stack, count))
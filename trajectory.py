@@ -0,0 +1,95 @@
+# Velocity / acceleration limited pan-tilt trajectories for the Kubi stand.
+#
+# Each axis runs an online trapezoidal profile: it accelerates at max_acceleration up to max_velocity and
+# brakes so it stops on the goal. The goal may move between updates (head tracking), the profile
+# simply re-plans from its current state. The servo is sent the final goal together with the profile
+# velocity in its Moving Speed register, so it interpolates on its own instead of being stepped.
+
+import math
+
+from kubi_wrapper import pan_Angle_To_Position, tilt_Angle_To_Position, velocity_To_Moving_Speed
+from kubi_wrapper import PAN_LOWER_BOUND, PAN_UPPER_BOUND, TILT_LOWER_BOUND, TILT_UPPER_BOUND
+
+PAN_MAX_VELOCITY            = 1500.0            # ticks / s, about 73 rpm
+PAN_MAX_ACCELERATION        = 6000.0            # ticks / s^2
+TILT_MAX_VELOCITY           = 800.0
+TILT_MAX_ACCELERATION       = 4000.0
+
+
+class Trapezoid_Axis:
+    def __init__(self, position, max_velocity, max_acceleration, lower_bound, upper_bound):
+        self.position = float(position)
+        self.velocity = 0.0
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.lower_bound = lower_bound
+        self.upper_bound = upper_bound
+        self.goal = self.position
+
+    def update(self, goal, dt):
+        self.goal = min(max(goal, self.lower_bound), self.upper_bound)
+        error = self.goal - self.position
+
+        # fastest velocity that still stops on the goal with max_acceleration
+        stopping_velocity = math.sqrt(2.0 * self.max_acceleration * abs(error))
+        desired = math.copysign(min(self.max_velocity, stopping_velocity), error)
+
+        dv = self.max_acceleration * dt
+        if desired > self.velocity + dv:
+            self.velocity += dv
+        elif desired < self.velocity - dv:
+            self.velocity -= dv
+        else:
+            self.velocity = desired
+
+        self.position += self.velocity * dt
+        if (self.goal - self.position) * error <= 0:
+            # reached or crossed the goal this step
+            self.position = self.goal
+            self.velocity = 0.0
+        return self.position, self.velocity
+
+    def is_Settled(self):
+        return self.velocity == 0.0 and self.position == self.goal
+
+    def command_Speed(self):
+        # the Moving Speed velocity: the profile's while it moves. once it has settled the servo may still lag
+        # behind it, and velocity 0 would become Moving Speed 1 (0.1 rpm), so it gets max_velocity to catch up
+        if self.is_Settled():
+            return self.max_velocity
+        return self.velocity
+
+    def reset(self, position):
+        # restart from a measured position at rest, e.g. after a reconnect
+        self.position = float(position)
+        self.velocity = 0.0
+        self.goal = self.position
+
+
+class Pan_Tilt_Trajectory:
+    def __init__(self, pan_position, tilt_position,
+                 pan_max_velocity=PAN_MAX_VELOCITY, pan_max_acceleration=PAN_MAX_ACCELERATION,
+                 tilt_max_velocity=TILT_MAX_VELOCITY, tilt_max_acceleration=TILT_MAX_ACCELERATION):
+        self.pan = Trapezoid_Axis(pan_position, pan_max_velocity, pan_max_acceleration, PAN_LOWER_BOUND, PAN_UPPER_BOUND)
+        self.tilt = Trapezoid_Axis(tilt_position, tilt_max_velocity, tilt_max_acceleration, TILT_LOWER_BOUND, TILT_UPPER_BOUND)
+
+    def update(self, pan_angle, tilt_angle, dt):
+        # returns (pan goal, pan Moving Speed, tilt goal, tilt Moving Speed) for kubi_wrapper.set_Goal_Speed
+        pan_goal = pan_Angle_To_Position(pan_angle)
+        tilt_goal = tilt_Angle_To_Position(tilt_angle)
+        self.pan.update(pan_goal, dt)
+        self.tilt.update(tilt_goal, dt)
+        return (pan_goal, velocity_To_Moving_Speed(self.pan.command_Speed()),
+                tilt_goal, velocity_To_Moving_Speed(self.tilt.command_Speed()))
+
+    def is_Settled(self):
+        return self.pan.is_Settled() and self.tilt.is_Settled()
+
+    def reset(self, pan_position, tilt_position):
+        self.pan.reset(pan_position)
+        self.tilt.reset(tilt_position)
+
+    def hold(self):
+        # stop where the profile is, e.g. when tracking switches to another user: the next update plans towards
+        # the new user from rest instead of carrying the velocity that followed the old one
+        self.reset(self.pan.position, self.tilt.position)
@@ -0,0 +1,149 @@
+# Registry of the users (cameras) currently in an ARENA scene.
+#
+# Users are dropped on leave / delete events, when they have not sent a pose for USER_TTL seconds,
+# or (oldest first) when MAX_USERS is reached, so memory stays bounded over long sessions. An expired user
+# is only forgotten until their next pose: the apps add a camera they do not know back on its pose message.
+# A uniform grid over the x/z plane answers "who is within radius r of a point" by visiting only
+# the cells that overlap the circle, so the per tick cost depends on users nearby, not users ever seen.
+
+import math
+import time
+from collections import OrderedDict
+
+GRID_CELL_SIZE = 2.0            # metres per grid cell, roughly the video_ball radius
+USER_TTL = 60.0                 # seconds without a pose update before a user is expired, None to disable
+MAX_USERS = 256                 # least recently updated user is evicted past this
+
+
+class User_Entry:
+    __slots__ = ('object_id', 'state', 'x', 'z', 'cell', 'seq', 'last_seen')
+
+    def __init__(self, object_id, state, x, z, cell, seq, last_seen):
+        self.object_id = object_id
+        self.state = state
+        self.x = x
+        self.z = z
+        self.cell = cell
+        self.seq = seq
+        self.last_seen = last_seen
+
+
+class User_Registry:
+    def __init__(self, cell_size=GRID_CELL_SIZE, ttl=USER_TTL, max_users=MAX_USERS, clock=time.monotonic):
+        self.cell_size = float(cell_size)
+        self.ttl = ttl
+        self.max_users = max_users
+        self.clock = clock
+
+        # ordered by last update, so expiry and eviction only ever look at the front
+        self.entries = OrderedDict()
+        self.grid = {}
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, object_id):
+        return object_id in self.entries
+
+    def get(self, object_id):
+        entry = self.entries.get(object_id)
+        return entry.state if entry is not None else None
+
+    def states(self):
+        return [entry.state for entry in self.entries.values()]
+
+    def add(self, object_id, state, x, z):
+        # a rejoin with the same id replaces the old state but keeps its seq, its place in the join order
+        old = self.entries.get(object_id)
+        seq = old.seq if old is not None else self.next_seq
+        if old is not None:
+            self.__unlink(old)
+        else:
+            self.next_seq += 1
+
+        cell = self.__cell(x, z)
+        entry = User_Entry(object_id, state, x, z, cell, seq, self.clock())
+        self.entries[object_id] = entry
+        # just seen, so it goes behind every older entry for expiry and eviction
+        self.entries.move_to_end(object_id)
+        self.grid.setdefault(cell, set()).add(object_id)
+
+        while len(self.entries) > self.max_users:
+            _, oldest = self.entries.popitem(last=False)
+            self.__unlink(oldest)
+
+    def move(self, object_id, x, z):
+        entry = self.entries.get(object_id)
+        if entry is None:
+            return False
+        entry.x = x
+        entry.z = z
+        entry.last_seen = self.clock()
+        self.entries.move_to_end(object_id)
+
+        cell = self.__cell(x, z)
+        if cell != entry.cell:
+            self.__unlink(entry)
+            entry.cell = cell
+            self.grid.setdefault(cell, set()).add(object_id)
+        return True
+
+    def remove(self, object_id):
+        entry = self.entries.pop(object_id, None)
+        if entry is None:
+            return None
+        self.__unlink(entry)
+        return entry.state
+
+    def expire(self, now=None):
+        # returns the states that timed out
+        if self.ttl is None:
+            return []
+        if now is None:
+            now = self.clock()
+        expired = []
+        while self.entries:
+            object_id, entry = next(iter(self.entries.items()))
+            if now - entry.last_seen < self.ttl:
+                break
+            del self.entries[object_id]
+            self.__unlink(entry)
+            expired.append(entry.state)
+        return expired
+
+    def query_Radius(self, x, z, radius):
+        # states within radius (on the x/z plane) of (x, z), in join order
+        size = self.cell_size
+        min_i = int(math.floor((x - radius) / size))
+        max_i = int(math.floor((x + radius) / size))
+        min_k = int(math.floor((z - radius) / size))
+        max_k = int(math.floor((z + radius) / size))
+        radius_sq = radius * radius
+
+        found = []
+        grid = self.grid
+        entries = self.entries
+        for i in range(min_i, max_i + 1):
+            for k in range(min_k, max_k + 1):
+                cell = grid.get((i, k))
+                if not cell:
+                    continue
+                for object_id in cell:
+                    entry = entries[object_id]
+                    dx = entry.x - x
+                    dz = entry.z - z
+                    if dx * dx + dz * dz <= radius_sq:
+                        found.append(entry)
+        found.sort(key=lambda entry: entry.seq)
+        return [entry.state for entry in found]
+
+    def __cell(self, x, z):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(z / self.cell_size)))
+
+    def __unlink(self, entry):
+        cell = self.grid.get(entry.cell)
+        if cell is not None:
+            cell.discard(entry.object_id)
+            if not cell:
+                del self.grid[entry.cell]